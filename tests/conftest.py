@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules are imported as `from utils import ...`, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+from utils import area_calculator as ac
+
+GEOTRANSFORM = (75.0, 0.5, 0, 20.0, 0, -0.5)
+
+
+def ring_with_island():
+    """A pond with a hole holding a smaller pond, and a separate pond."""
+    mask = np.zeros((200, 200), np.uint8)
+    cv2.circle(mask, (70, 70), 50, 255, -1)
+    cv2.circle(mask, (70, 70), 30, 0, -1)
+    cv2.circle(mask, (70, 70), 10, 255, -1)
+    cv2.rectangle(mask, (150, 150), (180, 190), 255, -1)
+    return mask
+
+
+def test_vectorized_rows_match_contour_loop():
+    mask = ring_with_island()
+    # Degenerate contours too: a single pixel and a one-pixel-wide line have no area
+    mask[10, 190] = 255
+    mask[100:140, 195] = 255
+    contours = ac.find_contours(mask)
+    reference = ac.calculate_objects_data(contours, GEOTRANSFORM, None)
+    data = ac.calculate_objects_data_vectorized(mask, GEOTRANSFORM, None)
+
+    # The pond inside the hole has no external contour and is left out in both
+    assert len(data["Contour"]) == len(reference["Contour"]) == 4
+    for contour, expected in zip(data["Contour"], reference["Contour"]):
+        np.testing.assert_array_equal(contour, expected)
+    for name in ("Area", "Real_area", "Center_lat", "Center_long"):
+        np.testing.assert_allclose(data[name], reference[name], rtol=1e-9, err_msg=name)
+    for name in ("Center_X", "Center_Y"):
+        np.testing.assert_array_equal(data[name], reference[name], err_msg=name)
+
+
+def test_vectorized_handles_no_objects():
+    data = ac.calculate_objects_data_vectorized(np.zeros((20, 20), np.uint8), GEOTRANSFORM, None)
+    assert len(data["Contour"]) == len(data["Area"]) == len(data["Center_lat"]) == 0
+
+
+def test_transform_points_matches_transform_point():
+    xs, ys = np.array([0, 10, 35]), np.array([5, 0, 17])
+    lat, long = ac.transform_points(xs, ys, GEOTRANSFORM, None)
+    for x, y, la, lo in zip(xs, ys, lat, long):
+        assert (la, lo) == pytest.approx(ac.transform_point(x, y, GEOTRANSFORM, None))
+
+
+@pytest.mark.parametrize("block_size", [16, 37, 64])
+def test_stitch_blocks_matches_whole_image_labelling(block_size):
+    rng = np.random.default_rng(block_size)
+    image = (rng.random((150, 170)) < 0.45).astype(np.uint8) * 255
+    # An object touching only diagonally across a block corner
+    image[block_size - 1, block_size - 1] = image[block_size, block_size] = 255
+    image[block_size - 1, block_size] = image[block_size, block_size - 1] = 0
+
+    height, width = image.shape
+    blocks = []
+    for y in range(0, height, block_size):
+        for x in range(0, width, block_size):
+            block = ac.label_block(image[y:y + block_size, x:x + block_size])
+            block["x"], block["y"] = x, y
+            blocks.append(block)
+    area, center_x, center_y = ac.stitch_blocks(blocks, -(-height // block_size), -(-width // block_size))
+
+    count, _, stats, centroids = cv2.connectedComponentsWithStats((image > 1).astype(np.uint8), connectivity=8)
+    assert len(area) == count - 1
+    order = np.lexsort((center_y, center_x))
+    expected = np.lexsort((centroids[1:, 1], centroids[1:, 0]))
+    np.testing.assert_array_equal(area[order], stats[1:, cv2.CC_STAT_AREA][expected])
+    np.testing.assert_allclose(center_x[order], centroids[1:, 0][expected])
+    np.testing.assert_allclose(center_y[order], centroids[1:, 1][expected])
+
+
+def test_save_data_and_image_writes_to_the_given_paths(tmp_path):
+    import pandas as pd
+
+    mask = ring_with_island()
+    data = ac.calculate_objects_data(ac.find_contours(mask), GEOTRANSFORM, None)
+    ac.save_data_and_image(data, mask.copy(), str(tmp_path / "areas.csv"), str(tmp_path / "labeled.png"))
+    table = pd.read_csv(tmp_path / "areas.csv")
+    assert list(table["Label"]) == [1, 2] and "Contour" not in table
+    assert cv2.imread(str(tmp_path / "labeled.png")).shape[:2] == mask.shape
@@ -0,0 +1,54 @@
+import os
+import signal
+import time
+import pytest
+
+pytest.importorskip("osgeo")
+pytest.importorskip("skimage")
+from utils import benchmark
+
+
+def _killed_stage(work, params):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def _slow_stage(work, params):
+    time.sleep(60)
+
+
+def _quick_stage(work, params):
+    return 0.5, 10, "tiles"
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    # The child processes are forked, so they see the patched stages
+    monkeypatch.setitem(benchmark.STAGES, "killed", _killed_stage)
+    monkeypatch.setitem(benchmark.STAGES, "slow", _slow_stage)
+    monkeypatch.setitem(benchmark.STAGES, "quick", _quick_stage)
+
+
+def test_run_stage_reports_a_killed_child(stages, tmp_path):
+    result = benchmark.run_stage("killed", str(tmp_path), {}, poll_seconds=0.1)
+    assert "signal 9" in result["error"]
+
+
+def test_run_stage_times_out(stages, tmp_path):
+    result = benchmark.run_stage("slow", str(tmp_path), {}, timeout=0.5, poll_seconds=0.1)
+    assert "timed out" in result["error"]
+
+
+def test_run_stage_returns_the_measurement(stages, tmp_path):
+    result = benchmark.run_stage("quick", str(tmp_path), {})
+    assert result["throughput"] == 20 and result["peak_rss_bytes"] > 0
+
+
+def test_compare_reports_flags_slowdowns_and_failures():
+    baseline = {"results": [{"stage": "a", "size": 2048, "seconds": 1.0, "peak_rss_bytes": 100},
+                            {"stage": "b", "size": 2048, "seconds": 1.0, "peak_rss_bytes": 100},
+                            {"stage": "c", "size": 2048, "seconds": 1.0, "peak_rss_bytes": 100}]}
+    current = {"results": [{"stage": "a", "size": 2048, "seconds": 1.1, "peak_rss_bytes": 100},
+                           {"stage": "b", "size": 2048, "seconds": 1.5, "peak_rss_bytes": 100},
+                           {"stage": "c", "size": 2048, "error": "stage process exited with code -9 (signal 9)"}]}
+    regressions = benchmark.compare_reports(current, baseline, threshold=0.2)
+    assert [(r["stage"], r["metric"]) for r in regressions] == [("b", "seconds"), ("c", "error")]
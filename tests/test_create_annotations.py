@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("skimage")
+from utils import create_annotations as ca
+
+
+def loop_sub_masks(mask_image, width, height):
+    """The per-pixel loop create_sub_masks replaced."""
+    sub_masks = {}
+    for x in range(width):
+        for y in range(height):
+            pixel = mask_image.getpixel((x, y))[:3]
+            if pixel != (0, 0, 0):
+                pixel_str = str(pixel)
+                if sub_masks.get(pixel_str) is None:
+                    sub_masks[pixel_str] = Image.new("1", (width + 2, height + 2))
+                sub_masks[pixel_str].putpixel((x + 1, y + 1), 1)
+    return sub_masks
+
+
+def colour_mask():
+    array = np.zeros((40, 50, 3), np.uint8)
+    # Met column by column: blue at x=3, then white at x=5, then red at x=20
+    array[10:20, 20:30] = (255, 0, 0)
+    array[25:38, 5:15] = (255, 255, 255)
+    array[0:6, 3:8] = (0, 0, 255)
+    array[30:40, 44:50] = (255, 0, 0)
+    return Image.fromarray(array)
+
+
+def test_create_sub_masks_matches_pixel_loop():
+    mask = colour_mask()
+    expected = loop_sub_masks(mask, 50, 40)
+    sub_masks = ca.create_sub_masks(mask, 50, 40)
+    assert list(sub_masks) == list(expected) == ["(0, 0, 255)", "(255, 255, 255)", "(255, 0, 0)"]
+    for colour, sub_mask in sub_masks.items():
+        np.testing.assert_array_equal(np.array(sub_mask), np.array(expected[colour]), err_msg=colour)
+
+
+def test_images_annotations_info_matches_serial_tiles(tmp_path):
+    category_colors = {"(255, 0, 0)": 0, "(255, 255, 255)": 1, "(0, 0, 255)": 2}
+    colour_mask().save(tmp_path / "tile_0_0.png")
+    Image.fromarray(np.zeros((40, 50, 3), np.uint8)).save(tmp_path / "tile_50_0.png")
+    images, annotations, count = ca.images_annotations_info(str(tmp_path), category_colors, num_workers=2)
+
+    assert [image["file_name"] for image in images] == ["tile_0_0.png", "tile_50_0.png"]
+    assert [image["id"] for image in images] == [0, 1]
+    expected = []
+    for colour, sub_mask in loop_sub_masks(colour_mask(), 50, 40).items():
+        polygons, _ = ca.create_sub_mask_annotation(sub_mask)
+        expected += [(category_colors[colour], ca.create_annotation_format(polygon, [], 0, 0, 0)["bbox"])
+                     for polygon in polygons]
+    assert count == len(annotations) == len(expected) == 4
+    assert [annotation["id"] for annotation in annotations] == list(range(4))
+    assert [(annotation["category_id"], annotation["bbox"]) for annotation in annotations] == expected
+    assert all(annotation["image_id"] == 0 for annotation in annotations)
@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("detectron2")
+from detectron2.data import DatasetCatalog
+from utils import evaluation as ev
+
+
+@pytest.fixture
+def val_set(tmp_path):
+    records = []
+    for i in range(2):
+        path = str(tmp_path / f"{i}.png")
+        cv2.imwrite(path, np.full((8, 8, 3), i * 50, np.uint8))
+        records.append({"image_id": i, "file_name": path})
+    name = f"test_val_{tmp_path.name}"
+    DatasetCatalog.register(name, lambda: records)
+    json_file = tmp_path / "val.json"
+    json_file.write_text("first")
+    yield name, records, json_file
+    DatasetCatalog.remove(name)
+
+
+def test_val_cache_is_rebuilt_when_the_val_json_changes(val_set, tmp_path):
+    name, records, json_file = val_set
+    cache_dir = str(tmp_path / "cache")
+    digest = ev.build_val_cache(name, cache_dir, str(json_file))
+    assert [image.mean() for _, image in ev.load_val_cache(cache_dir)] == [0, 50]
+
+    records.append({"image_id": 2, "file_name": records[1]["file_name"]})
+    assert ev.build_val_cache(name, cache_dir, str(json_file)) == digest
+    assert len(list(ev.load_val_cache(cache_dir))) == 2
+
+    json_file.write_text("second")
+    assert ev.build_val_cache(name, cache_dir, str(json_file)) != digest
+    assert len(list(ev.load_val_cache(cache_dir))) == 3
+
+
+def test_find_best_model_only_considers_current_candidates(val_set, tmp_path):
+    name, _, json_file = val_set
+    cache_dir = str(tmp_path / "cache")
+    val_digest = ev.build_val_cache(name, cache_dir, str(json_file))
+    candidates = []
+    for n in (1, 2):
+        (tmp_path / f"model_{n}.pth").write_text(f"weights {n}")
+        (tmp_path / f"config_{n}.pkl").write_text("config")
+        candidates.append((str(tmp_path / f"model_{n}.pth"), str(tmp_path / f"config_{n}.pkl")))
+
+    db_path = str(tmp_path / "evaluation.sqlite")
+    conn = ev._open_results(db_path)
+    for (weights_path, config_path), key, ap in zip(candidates, ev._result_keys(candidates, val_digest, 0.7),
+                                                     (30.0, 60.0)):
+        conn.execute("INSERT INTO val_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (*key, weights_path, config_path, ap, ap, "{}", 0))
+    conn.commit()
+    conn.close()
+
+    assert ev.find_best_model(db_path, candidates, cache_dir) == (*candidates[1], 60.0)
+    # A retrained model_2.pth has not been scored yet
+    (tmp_path / "model_2.pth").write_text("retrained")
+    assert ev.find_best_model(db_path, candidates, cache_dir) == (*candidates[0], 30.0)
+    assert ev.find_best_model(db_path, candidates[:1], str(tmp_path / "other_cache")) == (None, None, -1)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+from utils import georeference as georef
+
+
+def loop_areas(longs, lats, starts):
+    """Per-polygon reference for _geodesic_polygon_areas."""
+    earth_radius = 6371008.8
+    ends = np.append(starts[1:], len(longs))
+    areas = []
+    for start, end in zip(starts, ends):
+        lat0 = np.radians(lats[start:end].mean())
+        x = np.radians(longs[start:end] - longs[start]) * np.cos(lat0) * earth_radius
+        y = np.radians(lats[start:end] - lats[start]) * earth_radius
+        areas.append(0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))))
+    return np.array(areas)
+
+
+def test_geodesic_polygon_areas_matches_per_polygon_loop():
+    rng = np.random.default_rng(0)
+    polygons = []
+    for _ in range(20):
+        n = rng.integers(3, 12)
+        angles = np.sort(rng.random(n) * 2 * np.pi)
+        center = rng.uniform([70, 10], [80, 30])
+        polygons.append(center + 0.001 * np.column_stack((np.cos(angles), np.sin(angles))))
+    vertices = np.concatenate(polygons)
+    starts = np.cumsum([0] + [len(p) for p in polygons[:-1]])
+    areas = georef._geodesic_polygon_areas(vertices[:, 0], vertices[:, 1], starts)
+    np.testing.assert_allclose(areas, loop_areas(vertices[:, 0], vertices[:, 1], starts), rtol=1e-9)
+
+
+def test_geodesic_polygon_area_of_a_square_at_the_equator():
+    side = 0.001
+    longs, lats = np.array([0, side, side, 0]), np.array([0, 0, side, side])
+    meters = np.radians(side) * 6371008.8
+    area, = georef._geodesic_polygon_areas(longs, lats, np.array([0]))
+    assert area == pytest.approx(meters ** 2, rel=1e-6)
+
+
+def test_add_gcp_recovers_an_affine_transform():
+    rng = np.random.default_rng(1)
+    pixels = rng.uniform(0, 5000, (8, 2))
+    longs = 75 + 1e-5 * pixels[:, 0] + 2e-7 * pixels[:, 1]
+    lats = 20 - 1e-5 * pixels[:, 1]
+    for method in ("polynomial", "tps"):
+        model = georef.add_gcp(np.column_stack((pixels, longs, lats)), method=method)
+        fitted_long, fitted_lat = georef.apply_gcp_transform(model, pixels[:, 0], pixels[:, 1])
+        np.testing.assert_allclose(fitted_long, longs, atol=1e-9)
+        np.testing.assert_allclose(fitted_lat, lats, atol=1e-9)
+
+
+def test_georeference_objects_skips_rows_without_contour():
+    model = georef.add_gcp([(0, 0, 75, 20), (1000, 0, 75.01, 20), (0, 1000, 75, 19.99)])
+    square = np.array([[[10, 10]], [[20, 10]], [[20, 20]], [[10, 20]]])
+    data = {"Contour": [square, None], "Area": [100.0, 5.0], "Real_area": [0.0, 0.0],
+            "Center_X": [15, 40], "Center_Y": [15, 40], "Center_lat": [0.0, 0.0], "Center_long": [0.0, 0.0]}
+    result = georef.georeference_objects(data, model)
+    assert len(result["Contour"]) == len(result["Real_area"]) == len(result["Center_lat"]) == 1
+    # 10 x 10 pixels of 1e-5 degrees
+    assert result["Real_area"][0] == pytest.approx((np.radians(1e-4) * 6371008.8) ** 2 * np.cos(np.radians(20)),
+                                                   rel=1e-3)
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("detectron2")
+from detectron2.config import get_cfg
+from utils.inference import ExportedPredictor
+
+
+def test_exported_score_threshold_must_match_config():
+    predictor = ExportedPredictor.__new__(ExportedPredictor)
+    predictor.meta = {"score_thresh": 0.7}
+    cfg = get_cfg()
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.7
+    predictor.check_config(cfg)
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
+    with pytest.raises(ValueError, match="score threshold 0.7"):
+        predictor.check_config(cfg)
@@ -0,0 +1,59 @@
+import json
+import pytest
+from utils import instrument
+
+
+@pytest.fixture
+def tracing():
+    instrument._events.clear()
+    instrument.enable()
+    yield
+    instrument.disable()
+    instrument._events.clear()
+
+
+@instrument.traced("test.work")
+def work(count):
+    instrument.add_items(count)
+    return bytearray(count)
+
+
+def test_disabled_tracing_records_nothing():
+    instrument._events.clear()
+    with instrument.span("test.outer") as span:
+        span.add_items(3)
+        work(5)
+    assert instrument.events() == []
+
+
+def test_spans_nest_and_export_a_chrome_trace(tracing, tmp_path):
+    with instrument.span("test.outer", tiles=2):
+        instrument.add_items(1)
+        work(10)
+        work(20)
+    with pytest.raises(KeyError):
+        with instrument.span("test.failing"):
+            raise KeyError("tile")
+
+    events = instrument.events()
+    # Spans are recorded as they close: the inner ones first
+    assert [event["name"] for event in events] == ["test.work", "test.work", "test.outer", "test.failing"]
+    inner, outer = events[:2], events[2]
+    assert [event["items"] for event in events] == [10, 20, 1, 0]
+    assert outer["args"] == {"tiles": 2} and events[3]["error"] == "KeyError"
+    for event in inner:
+        assert outer["start_s"] <= event["start_s"]
+        assert event["start_s"] + event["wall_s"] <= outer["start_s"] + outer["wall_s"]
+    assert all(event["process_peak_rss_bytes"] > 0 and event["rss_bytes"] > 0 for event in events)
+
+    log_path, trace_path = instrument.write_trace(str(tmp_path / "run" / "trace"))
+    with open(log_path) as file:
+        assert json.load(file) == json.loads(json.dumps(events))
+    with open(trace_path) as file:
+        trace = json.load(file)
+    assert [event["name"] for event in trace["traceEvents"]] == [event["name"] for event in events]
+    for event, recorded in zip(trace["traceEvents"], events):
+        assert event["ph"] == "X" and event["cat"] == "test"
+        assert event["ts"] == pytest.approx(recorded["start_s"] * 1e6)
+        assert event["dur"] == pytest.approx(recorded["wall_s"] * 1e6)
+        assert event["args"]["items"] == recorded["items"]
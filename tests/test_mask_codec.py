@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from utils import mask_codec
+
+
+def random_mask(rng, shape, density=0.3):
+    return rng.random(shape) < density
+
+
+def test_pack_unpack_round_trip_with_ragged_width():
+    rng = np.random.default_rng(0)
+    mask = random_mask(rng, (3, 17, 13))
+    packed = mask_codec.pack_mask(mask)
+    assert packed.shape == (3, 17, mask_codec.packed_width(13))
+    np.testing.assert_array_equal(mask_codec.unpack_mask(packed, 13), mask)
+
+
+def test_compress_round_trip():
+    rng = np.random.default_rng(1)
+    mask = random_mask(rng, (40, 37))
+    blob = mask_codec.compress_mask(mask)
+    np.testing.assert_array_equal(mask_codec.decompress_mask(blob, mask.shape), mask)
+    np.testing.assert_array_equal(mask_codec.decompress_packed(blob, mask.shape), mask_codec.pack_mask(mask))
+
+
+def test_union_masks():
+    rng = np.random.default_rng(2)
+    masks = random_mask(rng, (5, 20, 30), density=0.05)
+    union = mask_codec.unpack_mask(mask_codec.union_masks(masks), 30)
+    np.testing.assert_array_equal(union, masks.any(axis=0))
+
+
+@pytest.mark.parametrize("x, y", [(0, 0), (3, 5), (8, 2), (13, 0), (50, 40), (57, 61)])
+def test_or_packed_matches_unpacked_or(x, y):
+    rng = np.random.default_rng(x * 100 + y)
+    canvas = random_mask(rng, (64, 70), density=0.1)
+    tile = random_mask(rng, (21, 19))
+    expected = canvas.copy()
+    window = expected[y:y + tile.shape[0], x:x + tile.shape[1]]
+    window |= tile[:window.shape[0], :window.shape[1]]
+
+    packed_canvas = mask_codec.pack_mask(canvas)
+    mask_codec.or_packed(packed_canvas, mask_codec.pack_mask(tile), x, y)
+    np.testing.assert_array_equal(mask_codec.unpack_mask(packed_canvas, 70), expected)
+
+
+def test_packed_mask_canvas():
+    rng = np.random.default_rng(3)
+    canvas = mask_codec.PackedMask.create((30, 20))
+    tile = random_mask(rng, (10, 12))
+    canvas.or_tile(mask_codec.pack_mask(tile), 5, 4)
+    assert canvas.shape == (20, 30)
+    assert canvas.count_nonzero() == tile.sum()
+    np.testing.assert_array_equal(np.asarray(canvas)[4:14, 5:17], tile)
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+import pytest
+import shapely
+
+pytest.importorskip("skimage")
+from utils import monitor as mon
+from utils.pond_store import PondStore
+
+
+def smooth_tiles(num, seed=0, size=512):
+    rng = np.random.default_rng(seed)
+    return np.stack([cv2.GaussianBlur((rng.random((size, size, 3)) * 200).astype(np.uint8), (0, 0), 8)
+                     for _ in range(num)])
+
+
+def signatures(tiles):
+    return np.stack([mon.tile_signature(tile) for tile in tiles])
+
+
+def test_change_scores_ignore_brightness_and_contrast():
+    tiles = smooth_tiles(3)
+    brighter = np.clip(tiles.astype(np.float32) * 1.2 + 10, 0, 255).astype(np.uint8)
+    changed = brighter.copy()
+    # A new pond of about 80x80 pixels in the second tile
+    changed[1, 100:180, 100:180] = 255
+    scores = mon.change_scores(signatures(tiles), signatures(changed))
+    assert scores[0] < 5 and scores[2] < 5
+    assert scores[1] > 15
+
+
+def test_change_scores_see_a_pond_vanish_from_a_flat_tile():
+    flat = np.full((1, 512, 512, 3), 120, np.uint8)
+    with_pond = flat.copy()
+    cv2.circle(with_pond[0], (256, 256), 60, (40, 40, 40), -1)
+    assert mon.change_scores(signatures(with_pond), signatures(flat))[0] > 15
+    assert mon.change_scores(signatures(flat), signatures(with_pond))[0] > 15
+
+
+def test_phase_offset_sign():
+    rng = np.random.default_rng(0)
+    previous = cv2.GaussianBlur(rng.random((256, 256)).astype(np.float32), (0, 0), 3)
+    # Grid pixel (x, y) is pixel (x + 7, y + 5) of the current scene
+    current = np.roll(previous, (5, 7), axis=(0, 1))
+    assert mon.phase_offset(previous, current, 1) == (7, 5)
+    # On overviews the shift is scaled back to full-resolution pixels
+    dx, dy = mon.phase_offset(previous, current, 4)
+    assert abs(dx - 28) <= 2 and abs(dy - 20) <= 2
+
+
+def store(polygons):
+    polygons = np.asarray(polygons, dtype=object)
+    centers = shapely.centroid(polygons)
+    return PondStore({"Real_area": shapely.area(polygons), "Label": np.arange(1, len(polygons) + 1),
+                      "Center_lat": shapely.get_y(centers), "Center_long": shapely.get_x(centers)}, polygons)
+
+
+def test_match_ponds_statuses():
+    previous = store([shapely.box(0, 0, 10, 10), shapely.box(20, 0, 30, 10), shapely.box(50, 50, 60, 60),
+                      shapely.box(0, 40, 10, 50)])
+    current = store([shapely.box(0, 0, 10, 10.5), shapely.box(20, 0, 30, 14), shapely.box(80, 80, 85, 85),
+                     shapely.box(0, 40, 10, 48)])
+    changes = mon.match_ponds(previous, current)
+    assert changes["status"].tolist() == ["unchanged", "grown", "new", "shrunk", "vanished"]
+    assert changes["previous_label"].tolist() == [1, 2, -1, 4, 3]
+    np.testing.assert_allclose(changes["area_change"], [5, 40, 25, -20, -100])
+
+
+def test_match_ponds_with_an_empty_date():
+    empty = store(np.empty(0, dtype=object))
+    ponds = store([shapely.box(0, 0, 10, 10), shapely.box(20, 0, 30, 10)])
+    assert mon.match_ponds(empty, ponds)["status"].tolist() == ["new", "new"]
+    assert mon.match_ponds(ponds, empty)["status"].tolist() == ["vanished", "vanished"]
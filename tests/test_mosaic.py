@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("skimage")
+from utils import mosaic as mosc
+
+
+def disk(size, cx, cy, r):
+    rows, cols = np.indices((size, size))
+    return (cols - cx) ** 2 + (rows - cy) ** 2 <= r ** 2
+
+
+def test_merge_instances_keeps_one_copy_of_a_pond_seen_by_two_tiles():
+    # The same pond at scene (600, 300), seen whole by the tile at x=256 and whole by the tile at x=0
+    left = disk(512, 600, 300, 40)[None]
+    right = disk(512, 600 - 256, 300, 40)[None]
+    kept = mosc.merge_instances([(0, 0, left, np.array([0.8])), (256, 0, right, np.array([0.9]))])
+    assert len(kept) == 1
+    assert kept[0]["score"] == 0.9
+
+
+def test_merge_instances_prefers_complete_instances_over_edge_cut_ones():
+    # The tile at x=0 sees the pond cut by its right edge, the tile at x=256 sees it whole
+    cut = disk(512, 500, 300, 40)[None]
+    whole = disk(512, 500 - 256, 300, 40)[None]
+    kept = mosc.merge_instances([(0, 0, cut, np.array([0.99])), (256, 0, whole, np.array([0.5]))])
+    assert len(kept) == 1
+    assert not kept[0]["edge"] and kept[0]["x0"] == 256 + 500 - 256 - 40
+
+
+def test_merge_instances_keeps_separate_ponds():
+    masks = np.stack([disk(512, 100, 100, 30), disk(512, 300, 300, 30)])
+    assert len(mosc.merge_instances([(0, 0, masks, np.array([0.9, 0.8]))])) == 2
+
+
+def test_tile_store_round_trip_and_packed_merge(tmp_path):
+    rng = np.random.default_rng(0)
+    tiles = {(x, y): rng.random((64, 60)) < 0.2 for y in (0, 48) for x in (0, 45, 90)}
+    store_path = str(tmp_path / "masks.tiles")
+    count = mosc.write_tile_store(((x, y, *tile.shape, mosc.pack_tile(tile)) for (x, y), tile in tiles.items()),
+                                  store_path)
+    assert count == len(tiles)
+    for x, y, tile in mosc.iterate_tile_store(store_path):
+        np.testing.assert_array_equal(tile, tiles[x, y])
+
+    # Tiles overhanging the 140 x 100 canvas are clipped
+    merged, failed = mosc.merge_tile_store(store_path, (140, 100))
+    packed, packed_failed = mosc.merge_tile_store(store_path, (140, 100), packed=True)
+    assert failed == packed_failed == []
+    np.testing.assert_array_equal(np.asarray(packed), merged)
+    expected = np.zeros((100, 140), bool)
+    for (x, y), tile in tiles.items():
+        expected[y:y + 64, x:x + 60] |= tile[:100 - y, :140 - x]
+    np.testing.assert_array_equal(merged.astype(bool), expected)
+
+
+def test_map_bounded_keeps_order_and_limits_tasks_in_flight():
+    from concurrent.futures import ThreadPoolExecutor
+
+    class CountingExecutor(ThreadPoolExecutor):
+        submitted = 0
+
+        def submit(self, *args, **kwargs):
+            CountingExecutor.submitted += 1
+            return super().submit(*args, **kwargs)
+
+    with CountingExecutor(max_workers=2) as executor:
+        results = []
+        for result in mosc.map_bounded(executor, lambda value: value * value, range(20), max_in_flight=3):
+            results.append(result)
+            assert CountingExecutor.submitted - len(results) <= 3 - 1
+    assert results == [value * value for value in range(20)]
+
+
+def scene_mask(path):
+    import cv2
+    from PIL import Image
+
+    mask = np.zeros((256, 256), np.uint8)
+    # Every pond lies inside one of the tiles that fit the scene; the cut pieces in the other
+    # tiles touch their border and are cleared
+    for x, y in [(30, 30), (150, 40), (100, 160), (170, 170)]:
+        cv2.rectangle(mask, (x, y), (x + 54, y + 54), 255, -1)
+    Image.fromarray(mask).save(path)
+    return mask
+
+
+def test_streamed_merge_matches_merge_from_disk(tmp_path):
+    pytest.importorskip("osgeo")
+    from utils import preprocess as prep
+
+    scene_path = str(tmp_path / "scene_mask.png")
+    mask = scene_mask(scene_path)
+
+    # The original round trip: PNG tiles, one .npy per tile, merged from the sorted file names
+    prep.divide_and_save_image(scene_path, str(tmp_path / "tiles"), 128, 128, stride=0.5)
+    mosc.process_directory(str(tmp_path / "tiles"), str(tmp_path / "arrays"))
+    filenames = mosc.load_and_sort_filenames(str(tmp_path / "arrays"))
+    on_disk, failed = mosc.merge_tiles(filenames, str(tmp_path / "arrays"), (256, 256))
+    # Tiles past the scene edge do not fit the canvas there; the stream clips them instead
+    assert sorted(failed) == sorted(f"tile_{x}_{y}.npy" for x, y in prep.tile_offsets(256, 256, 128, 128, 0.5)
+                                    if x == 192 or y == 192)
+
+    tiles = ((x, y, tile[:, :, 0]) for x, y, tile in
+             prep.iterate_tiles(scene_path, 128, 128, min_nonzero_fraction=0, as_bgr=False, stride=0.5))
+    streamed, stream_failed = mosc.merge_tile_stream(tiles, (256, 256), canvas_path=str(tmp_path / "canvas.npy"))
+    assert stream_failed == []
+    assert isinstance(streamed, np.memmap)
+    np.testing.assert_array_equal(streamed, on_disk)
+    np.testing.assert_array_equal(streamed, mask > 0)
+
+
+def test_chunked_png_decodes_to_save_merged_image(tmp_path):
+    from PIL import Image
+    from utils import mask_codec
+
+    rng = np.random.default_rng(1)
+    canvas = mosc.create_canvas((70, 45), str(tmp_path / "canvas.npy"))
+    canvas[:] = rng.random((45, 70)) < 0.3
+    mosc.save_merged_image(np.asarray(canvas), str(tmp_path / "whole.png"))
+    expected = np.asarray(Image.open(tmp_path / "whole.png"))
+    assert expected.shape == (45, 70, 4)
+    # Chunks that do not divide the height, from a memory-mapped and from a packed canvas
+    mosc.save_merged_image_chunked(canvas, str(tmp_path / "chunked.png"), chunk_rows=16)
+    np.testing.assert_array_equal(np.asarray(Image.open(tmp_path / "chunked.png")), expected)
+    packed = mask_codec.PackedMask(mask_codec.pack_mask(np.asarray(canvas)), 70)
+    mosc.save_merged_image_chunked(packed, str(tmp_path / "packed.png"), chunk_rows=7)
+    np.testing.assert_array_equal(np.asarray(Image.open(tmp_path / "packed.png")), expected)
@@ -0,0 +1,100 @@
+import os
+import types
+import pytest
+from utils import pipeline
+
+
+@pytest.fixture
+def args(tmp_path):
+    image = tmp_path / "scene.tif"
+    image.write_bytes(b"scene")
+    weights, config = tmp_path / "model_1.pth", tmp_path / "config_1.pkl"
+    weights.write_bytes(b"weights")
+    config.write_bytes(b"config")
+    return types.SimpleNamespace(image=str(image), weights=str(weights), config=str(config), exported=None,
+                                 prescreen=None, recall=0.99, tile_size=1024, stride=0.25, min_tile_bytes=0,
+                                 score_thresh=0.7, bounds=None, simplify=1.0, batch_size=4,
+                                 work=str(tmp_path / "work"))
+
+
+def keys(args, manifest, until="count"):
+    result = {}
+    for stage in pipeline.stage_order(until):
+        result[stage] = pipeline.stage_key(stage, args, result, manifest)
+    return result
+
+
+def test_stage_order():
+    assert pipeline.stage_order("count") == ["tile", "screen", "infer", "mosaic", "georeference", "count"]
+    assert pipeline.stage_order("vectorize") == ["tile", "screen", "infer", "vectorize"]
+
+
+def test_stage_key_follows_params_inputs_and_dependencies(args):
+    manifest = {"digests": {}, "stages": {}}
+    base = keys(args, manifest)
+    assert keys(args, manifest) == base
+
+    # A speed-only argument changes nothing
+    args.batch_size = 16
+    assert keys(args, manifest) == base
+
+    # A parameter changes its stage and everything after it
+    args.bounds = [75.9, 19.9, 76.0, 19.8]
+    changed = keys(args, manifest)
+    assert [stage for stage in base if changed[stage] != base[stage]] == ["georeference", "count"]
+    args.bounds = None
+
+    # So does the content of an input file
+    with open(args.weights, "wb") as file:
+        file.write(b"retrained weights")
+    changed = keys(args, manifest)
+    assert [stage for stage in base if changed[stage] != base[stage]] == ["infer", "mosaic", "georeference", "count"]
+
+
+def test_input_digest_is_remembered_by_size_and_mtime(args):
+    manifest = {"digests": {}, "stages": {}}
+    digest = pipeline.input_digest(args.image, manifest)
+    entry = manifest["digests"][os.path.abspath(args.image)]
+    entry["digest"] = "remembered"
+    assert pipeline.input_digest(args.image, manifest) == "remembered"
+    with open(args.image, "wb") as file:
+        file.write(b"another scene")
+    assert pipeline.input_digest(args.image, manifest) not in ("remembered", digest)
+
+
+def test_run_pipeline_skips_finished_stages_and_resumes_after_a_failure(args, monkeypatch):
+    calls = []
+
+    def fake_run(stage):
+        def run(run_args, inputs, output_dir):
+            calls.append(stage)
+            if stage == "mosaic" and run_args.fail:
+                raise RuntimeError("mosaic failed")
+            with open(os.path.join(output_dir, "done"), "w") as file:
+                file.write(stage)
+        return run
+
+    for stage in pipeline.stage_order("count"):
+        monkeypatch.setitem(pipeline.STAGES, stage, dict(pipeline.STAGES[stage], run=fake_run(stage)))
+
+    args.fail = True
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline(args)
+    assert calls == ["tile", "screen", "infer", "mosaic"]
+
+    calls.clear()
+    args.fail = False
+    outputs = pipeline.run_pipeline(args)
+    assert calls == ["mosaic", "georeference", "count"]
+    assert all(os.path.exists(os.path.join(outputs[stage], "done")) for stage in outputs)
+
+    calls.clear()
+    pipeline.run_pipeline(args, force=("infer",))
+    assert calls == ["infer", "mosaic", "georeference", "count"]
+
+
+@pytest.mark.parametrize("stride", ["0", "1.5", "256"])
+def test_main_rejects_strides_in_pixels(tmp_path, stride, capsys):
+    with pytest.raises(SystemExit):
+        pipeline.main(["--image", "scene.tif", "--work", str(tmp_path), "--until", "tile", "--stride", stride])
+    assert "fraction of the tile size" in capsys.readouterr().err
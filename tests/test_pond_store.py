@@ -0,0 +1,58 @@
+import numpy as np
+import shapely
+from utils.pond_store import PondStore
+
+# Pixel size 1 with the origin at (100, 200): world x = 100 + col, world y = 200 - row
+GEOTRANSFORM = (100.0, 1.0, 0.0, 200.0, 0.0, -1.0)
+
+
+def square(x, y, size):
+    return np.array([[x, y], [x + size, y], [x + size, y + size], [x, y + size]]).reshape(-1, 1, 2)
+
+
+def make_store():
+    data = {"Contour": [square(0, 0, 10), None, square(50, 50, 4), square(20, 0, 2)],
+            "Area": np.array([100, 0, 16, 4]), "Real_area": np.array([1.0, 0.0, 0.16, 0.04])}
+    return PondStore.from_objects_data(data, geotransform=GEOTRANSFORM)
+
+
+def test_from_objects_data_places_outlines():
+    store = make_store()
+    assert len(store) == 4
+    assert store.geometries[1] is None
+    np.testing.assert_array_equal(store.columns["Label"], [1, 2, 3, 4])
+    assert store.geometries[0].equals(shapely.box(100, 190, 110, 200))
+    assert store.geometries[2].area == 16
+
+
+def test_save_load_round_trip(tmp_path):
+    store = make_store()
+    store.save(tmp_path / "ponds.npz")
+    loaded = PondStore.load(tmp_path / "ponds.npz")
+    assert len(loaded) == len(store)
+    assert loaded.geometries[1] is None
+    for before, after in zip(store.geometries[[0, 2, 3]], loaded.geometries[[0, 2, 3]]):
+        assert before.equals(after)
+    for name, values in store.columns.items():
+        np.testing.assert_array_equal(loaded.columns[name], values)
+
+
+def test_spatial_queries():
+    store = make_store()
+    np.testing.assert_array_equal(store.query_bbox(95, 185, 125, 199), [0, 3])
+    np.testing.assert_array_equal(store.query_polygon(shapely.box(140, 140, 160, 160)), [2])
+
+    point_indices, pond_indices, distances = store.nearest(np.array([[105.0, 195.0], [152.0, 130.0]]))
+    np.testing.assert_array_equal(point_indices, [0, 1])
+    np.testing.assert_array_equal(pond_indices, [0, 2])
+    np.testing.assert_allclose(distances, [0, 16])
+    assert len(store.nearest(np.array([[152.0, 130.0]]), max_distance=1)[0]) == 0
+
+
+def test_aggregate_by_region_counts_each_pond_once():
+    store = make_store()
+    # The first two regions overlap on pond 0; the last one is empty
+    regions = [shapely.box(90, 180, 115, 205), shapely.box(100, 180, 130, 205), shapely.box(0, 0, 1, 1)]
+    totals = store.aggregate_by_region(regions)
+    np.testing.assert_array_equal(totals["count"], [1, 1, 0])
+    np.testing.assert_allclose(totals["Real_area_sum"], [1.0, 0.04, 0])
@@ -0,0 +1,73 @@
+import time
+import numpy as np
+from utils import prediction_cache as pc
+
+
+def prediction(seed, num=3, size=32):
+    rng = np.random.default_rng(seed)
+    return (rng.random((num, size, size)) < 0.2, rng.random(num).astype(np.float32),
+            np.arange(num), rng.random((num, 4)).astype(np.float32))
+
+
+def test_encode_decode_round_trip():
+    masks, scores, classes, boxes = prediction(0)
+    decoded = pc.decode_prediction(pc.encode_prediction(masks, scores, classes, boxes))
+    np.testing.assert_array_equal(decoded["masks"], masks)
+    np.testing.assert_array_equal(decoded["scores"], scores)
+    np.testing.assert_array_equal(decoded["classes"], classes)
+    np.testing.assert_array_equal(decoded["boxes"], boxes)
+
+
+def test_tile_key_depends_on_pixels_shape_and_model():
+    tile = np.zeros((4, 4, 3), np.uint8)
+    key = pc.tile_key(tile, "model a")
+    assert pc.tile_key(tile.copy(), "model a") == key
+    assert pc.tile_key(tile, "model b") != key
+    assert pc.tile_key(tile.reshape(4, 12, 1), "model a") != key
+    changed = tile.copy()
+    changed[0, 0, 0] = 1
+    assert pc.tile_key(changed, "model a") != key
+
+
+def test_cache_hits_misses_and_lru_eviction(tmp_path):
+    cache = pc.PredictionCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get("a") is None
+    cache.put("a", *prediction(1))
+    np.testing.assert_array_equal(cache.get("a")["masks"], prediction(1)[0])
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    # Room for about two entries: the least recently used one goes
+    cache.max_bytes = int(cache.stats()["bytes"] * 2.5)
+    cache.put("b", *prediction(2))
+    time.sleep(0.01)
+    cache.get("a")
+    time.sleep(0.01)
+    cache.put("c", *prediction(3))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+    cache.close()
+
+
+def test_cache_size_and_access_times_survive_replace_and_reopen(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "cache.sqlite")
+    cache = pc.PredictionCache(path)
+    cache.put("a", *prediction(1))
+    size = cache.stats()["bytes"]
+    cache.put("a", *prediction(1))
+    assert cache.stats()["bytes"] == size
+    cache.put("b", *prediction(2))
+    total = cache.stats()["bytes"]
+    time.sleep(0.01)
+    cache.get("a")
+    cache.close()
+
+    # The hit on "a" was buffered and written on close
+    with sqlite3.connect(path) as conn:
+        order = [key for key, in conn.execute("SELECT key FROM predictions ORDER BY last_access")]
+    assert order == ["b", "a"]
+    reopened = pc.PredictionCache(path)
+    assert reopened.stats()["bytes"] == total and reopened.stats()["entries"] == 2
+    reopened.close()
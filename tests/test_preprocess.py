@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+from utils import preprocess as prep
+
+
+def test_tile_offsets_fractional_stride():
+    offsets = prep.tile_offsets(2048, 1024, 1024, 1024, stride=0.25)
+    assert offsets[:5] == [(0, 0), (256, 0), (512, 0), (768, 0), (1024, 0)]
+    assert len(offsets) == 8 * 4
+    assert max(x for x, _ in offsets) == 1792
+
+
+def test_tile_offsets_whole_tile_stride_and_overlap():
+    # An int 1 is the same fraction as 1.0, not a 1 pixel step
+    assert prep.tile_offsets(1000, 500, 500, 500, stride=1) == prep.tile_offsets(1000, 500, 500, 500, stride=1.0) \
+        == [(0, 0), (500, 0)]
+    # A fixed overlap in pixels overrides the stride
+    assert prep.tile_offsets(1000, 400, 500, 500, stride=0.25, overlap=100) == [(0, 0), (400, 0), (800, 0)]
+
+
+@pytest.mark.parametrize("stride", [0, -0.5, 1.5, 256])
+def test_tile_offsets_rejects_strides_outside_unit_interval(stride):
+    with pytest.raises(ValueError, match="fraction"):
+        prep.tile_offsets(1000, 1000, 512, 512, stride=stride)
+
+
+def test_tile_offsets_rejects_non_positive_step():
+    with pytest.raises(ValueError):
+        prep.tile_offsets(1000, 1000, 512, 512, overlap=512)
+
+
+def scene_png(path, bands=3):
+    from PIL import Image
+    rng = np.random.default_rng(bands)
+    array = rng.integers(1, 256, (200, 300, bands), dtype=np.uint8)
+    Image.fromarray(array[:, :, 0] if bands == 1 else array).save(path)
+    return array
+
+
+@pytest.mark.parametrize("bands", [1, 3, 4])
+def test_windowed_tiler_matches_divide_and_save_image(tmp_path, bands):
+    from PIL import Image
+
+    image_path = str(tmp_path / "scene.png")
+    scene_png(image_path, bands)
+    prep.divide_and_save_image(image_path, str(tmp_path / "pil"), 128, 128, stride=0.5)
+    written = prep.divide_and_save_image_windowed(image_path, str(tmp_path / "gdal"), 128, 128, num_workers=2,
+                                                  max_in_flight=3, stride=0.5)
+
+    names = sorted(os.listdir(tmp_path / "pil"))
+    assert sorted(os.listdir(tmp_path / "gdal")) == names and written == len(names)
+    # Tiles past the right and bottom edges are padded with zeros in both
+    assert "tile_256_192.png" in names
+    for name in names:
+        expected, tile = Image.open(tmp_path / "pil" / name), Image.open(tmp_path / "gdal" / name)
+        assert tile.mode == expected.mode and tile.size == expected.size == (128, 128)
+        np.testing.assert_array_equal(np.asarray(tile), np.asarray(expected), err_msg=name)
+
+
+def test_read_tile_window_rejects_rasters_that_are_not_8_bit():
+    class Dataset:
+        RasterXSize, RasterYSize, RasterCount = 64, 64, 1
+
+        def ReadAsArray(self, x, y, width, height):
+            return np.full((height, width), 1000, np.uint16)
+
+    with pytest.raises(ValueError, match="8-bit"):
+        prep.read_tile_window(Dataset(), 0, 0, 32, 32)
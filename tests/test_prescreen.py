@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from utils.prescreen import PreScreen, fit_logistic
+
+
+def test_fit_logistic_separates_classes():
+    rng = np.random.default_rng(0)
+    # Unbalanced classes told apart by the first feature only
+    features = np.concatenate((rng.normal(0, 1, (200, 3)), rng.normal(0, 1, (20, 3)) + [8, 0, 0]))
+    labels = np.concatenate((np.zeros(200), np.ones(20)))
+    model = PreScreen(*fit_logistic(features, labels))
+    scores = model.score(features)
+    assert scores[labels == 1].min() > 0.5 > np.median(scores[labels == 0])
+    assert abs(model.weights[0]) > 5 * np.abs(model.weights[1:]).max()
+
+
+def test_threshold_for_recall():
+    model = PreScreen(np.zeros(1), np.ones(1), np.ones(1), 0.0)
+    model.calibrate([0.9, 0.8, 0.1, 0.5, 0.3], [1, 3, 5, 0, 1])
+    # Ponds by descending score: 1 (0.9), 3 (0.8), 1 (0.3), 5 (0.1) of 10
+    assert model.threshold_for_recall(0.1) == 0.9
+    assert model.threshold_for_recall(0.4) == 0.8
+    assert model.threshold_for_recall(0.45) == 0.3
+    assert model.threshold_for_recall(1.0) == 0.1
+    assert model.threshold_for_recall(0) == 0.0
+
+
+def test_save_load_keeps_calibration(tmp_path):
+    model = PreScreen(np.zeros(26), np.ones(26), np.ones(26), 0.5)
+    model.calibrate([0.9, 0.2], [2, 1])
+    model.save(tmp_path / "prescreen.json")
+    loaded = PreScreen.load(tmp_path / "prescreen.json")
+    assert loaded.threshold_for_recall(0.5) == model.threshold_for_recall(0.5) == 0.9
+
+
+@pytest.mark.parametrize("scores, ponds", [([], []), ([0.2, 0.7], [0, 0]), ([0.2], [1, 2])])
+def test_calibrate_rejects_sets_without_ponds(scores, ponds):
+    model = PreScreen(np.zeros(1), np.ones(1), np.ones(1), 0.0)
+    with pytest.raises(ValueError):
+        model.calibrate(scores, ponds)
+    with pytest.raises(ValueError, match="not calibrated"):
+        model.threshold_for_recall(0.99)
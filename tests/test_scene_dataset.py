@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+pytest.importorskip("osgeo")
+pytest.importorskip("skimage")
+pytest.importorskip("detectron2")
+from utils import preprocess as prep
+from utils import scene_dataset as sd
+from utils.create_annotations import mask_annotations_info
+
+TILE = 64
+COLORS = {"(255, 255, 255)": 1}
+
+
+@pytest.fixture
+def scene_mask(tmp_path):
+    """A train_mask.png-like scene: black ponds on white."""
+    array = np.full((128, 160, 3), 255, np.uint8)
+    array[10:30, 12:40] = 0
+    array[70:95, 100:118] = 0
+    path = str(tmp_path / "train_mask.png")
+    Image.fromarray(array).save(path)
+    return path
+
+
+def test_cache_scene_inverts_like_the_tile_masks(scene_mask, tmp_path):
+    cache_path = str(tmp_path / "scene_mask.npy")
+    mask = sd.cache_scene(scene_mask, cache_path, as_mask=True, strip_rows=50)
+    np.testing.assert_array_equal(mask, np.asarray(ImageOps.invert(Image.open(scene_mask).convert("L"))))
+    # Unchanged source: the memory map is reused, not rebuilt
+    modified = os.stat(cache_path).st_mtime_ns
+    assert isinstance(sd.cache_scene(scene_mask, cache_path, as_mask=True), np.memmap)
+    assert os.stat(cache_path).st_mtime_ns == modified
+
+
+def test_select_crops_keeps_crops_with_ponds(scene_mask, tmp_path):
+    mask = sd.cache_scene(scene_mask, str(tmp_path / "scene_mask.npy"), as_mask=True)
+    offsets = sd.select_crops(mask, TILE, TILE, stride=0.5, min_pond_fraction=0.01)
+    ponds = np.pad(np.asarray(mask) > 0, ((0, TILE), (0, TILE)))
+    expected = [(x, y) for x, y in prep.tile_offsets(160, 128, TILE, TILE, 0.5)
+                if ponds[y:y + TILE, x:x + TILE].mean() >= 0.01]
+    assert offsets == expected
+    assert (0, 0) in offsets and (96, 64) in offsets and (128, 0) not in offsets
+
+
+def test_crop_annotations_match_the_mask_tiles(scene_mask, tmp_path):
+    mask_cache = str(tmp_path / "scene_mask.npy")
+    mask = sd.cache_scene(scene_mask, mask_cache, as_mask=True)
+    offsets = sd.select_crops(mask, TILE, TILE, stride=0.5, min_pond_fraction=0.01)
+    cache_path = str(tmp_path / "annotations.json")
+    annotations = sd.crop_annotations(mask_cache, offsets, TILE, TILE, COLORS, cache_path=cache_path, num_workers=1)
+
+    # The tile route: mask tiles on the same grid, inverted in place, annotated one file at a time
+    tiles = str(tmp_path / "tiles")
+    prep.divide_and_save_image(scene_mask, tiles, TILE, TILE, stride=0.5)
+    prep.invert_image_colors(tiles)
+    for x, y in offsets:
+        _, width, height, objects = mask_annotations_info(os.path.join(tiles, f"tile_{x}_{y}.png"), COLORS)
+        assert (width, height) == (TILE, TILE)
+        crop = annotations[(x, y)]
+        assert len(crop) == len(objects) > 0
+        for annotation, (polygon, segmentation, category_id) in zip(crop, objects):
+            assert annotation["category_id"] == category_id
+            assert annotation["segmentation"] == segmentation
+            assert annotation["area"] == pytest.approx(polygon.area)
+
+    # A second call is served from the cache file, even without the mask
+    cached = sd.crop_annotations(str(tmp_path / "missing.npy"), offsets, TILE, TILE, COLORS, cache_path=cache_path)
+    assert cached == annotations
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("detectron2")
+from utils import search
+
+
+def test_rung_iterations():
+    assert search.rung_iterations(500, 16000, 4) == [500, 2000, 8000, 16000]
+    assert search.rung_iterations(1, 4, 4) == [1, 4]
+
+
+def test_completed_trials_are_numbered_after_existing_pairs(tmp_path):
+    parameter_folder, model_folder = tmp_path / "parameters", tmp_path / "model"
+    parameter_folder.mkdir()
+    model_folder.mkdir()
+    for num in (1, 2, 3):
+        (parameter_folder / f"config_{num}.pkl").write_text(f"random search {num}")
+    (model_folder / "model_1.pth").write_text("trained 1")
+
+    trials = []
+    for num, state in ((1, "completed"), (2, "stopped"), (3, "completed")):
+        output_dir = tmp_path / f"trial_{num}"
+        output_dir.mkdir()
+        (output_dir / "model_final.pth").write_text(f"trial {num}")
+        config_path = parameter_folder / f"asha_config_{num}.pkl"
+        config_path.write_text(f"asha {num}")
+        trials.append({"trial": num, "state": state, "output_dir": str(output_dir), "config_path": str(config_path)})
+
+    search.emit_completed_trials(trials, str(parameter_folder), str(model_folder))
+    assert (parameter_folder / "config_1.pkl").read_text() == "random search 1"
+    assert (model_folder / "model_4.pth").read_text() == "trial 1"
+    assert (parameter_folder / "config_4.pkl").read_text() == "asha 1"
+    assert (model_folder / "model_5.pth").read_text() == "trial 3"
+    assert (parameter_folder / "config_5.pkl").read_text() == "asha 3"
+    assert "model_path" not in trials[1]
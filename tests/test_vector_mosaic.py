@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import shapely
+
+pytest.importorskip("skimage")
+from utils.vector_mosaic import union_overlapping
+
+
+def test_union_overlapping_merges_chains_only():
+    polygons = [shapely.box(0, 0, 2, 2), shapely.box(5, 5, 6, 6), shapely.box(1, 1, 3, 3),
+                shapely.box(2.5, 2.5, 4, 4), shapely.box(10, 0, 11, 1)]
+    merged = union_overlapping(polygons)
+    areas = sorted(shapely.area(merged))
+    # Boxes 0, 2 and 3 overlap in a chain; the other two stay as they are
+    assert len(merged) == 3
+    np.testing.assert_allclose(areas, [1, 1, 4 + 4 - 1 + 2.25 - 0.25])
+
+
+def test_union_overlapping_splits_corner_contacts():
+    merged = union_overlapping([shapely.box(0, 0, 1, 1), shapely.box(1, 1, 2, 2)])
+    assert len(merged) == 2
+    assert all(polygon.geom_type == "Polygon" for polygon in merged)
+    assert len(union_overlapping([])) == 0
+
+
+def test_vectorize_tile_store_merges_tiles_and_skips_empty_ones(tmp_path):
+    from utils import mosaic as mosc
+    from utils import vector_mosaic as vmosc
+
+    scene = np.zeros((64, 96), np.uint8)
+    scene[20:40, 30:70] = 1
+    records = [(x, y, 64, 64, mosc.pack_tile(scene[y:y + 64, x:x + 64] if x < 96 else np.zeros((64, 64))))
+               for x, y in [(0, 0), (32, 0), (128, 0)]]
+    # The tile past the scene is empty and never reaches a worker
+    assert records[-1][-1] == vmosc._empty_blob(64, 64)
+    mosc.write_tile_store(records, tmp_path / "masks.tiles")
+
+    polygons = vmosc.vectorize_tile_store(str(tmp_path / "masks.tiles"), tolerance=0, num_workers=1,
+                                          max_in_flight=1)
+    assert len(polygons) == 1
+    minx, miny, maxx, maxy = polygons[0].bounds
+    assert (minx, miny) == pytest.approx((30, 20), abs=1) and (maxx, maxy) == pytest.approx((69, 39), abs=1)
@@ -1,16 +1,23 @@
 import cv2
 import os
 import math
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from osgeo import gdal, osr
+from utils import instrument
 
 
+@instrument.traced()
 def load_and_threshold_image(image_path):
     """Load an image and apply thresholding to segment white objects."""
     image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
     _, thresholded = cv2.threshold(image, 1, 255, cv2.THRESH_BINARY)
     return image, thresholded
 
+@instrument.traced()
 def find_contours(thresholded_image):
     """Find contours of white objects in the thresholded image."""
     contours, _ = cv2.findContours(thresholded_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -43,9 +50,11 @@ def setup_coordinate_transformation(image_path):
         return None, None
 
 
+@instrument.traced()
 def calculate_objects_data(contours, geotransform, transform):
     """Calculate area, center, and real-world coordinates for each object."""
     data = {"Contour": [], "Area": [], "Real_area": [], "Center_X": [], "Center_Y": [], "Center_lat": [], "Center_long": []}
+    instrument.add_items(len(contours))
     for contour in contours:
         M = cv2.moments(contour)
         center_x = int(M["m10"] / M["m00"]) if M["m00"] != 0 else 0
@@ -71,11 +80,205 @@ def transform_point(x, y, geotransform, transform):
         long, lat, _ = transform.TransformPoint(lat, long)
     return lat, long
 
-def save_data_and_image(data, image):
-    """Save the DataFrame as a CSV file and optionally save an image with labeled instances."""
-    df = pd.DataFrame(data)
+def transform_points(xs, ys, geotransform, transform):
+    """Transform arrays of pixel coordinates to real-world coordinates in one batched call."""
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    lat = geotransform[0] + xs * geotransform[1] + ys * geotransform[2]
+    long = geotransform[3] + xs * geotransform[4] + ys * geotransform[5]
+    if transform is not None and len(xs):
+        points = np.array(transform.TransformPoints(np.column_stack((lat, long)).tolist()))
+        long, lat = points[:, 0], points[:, 1]
+    return lat, long
+
+def _contour_moments(contours):
+    """
+    Zeroth and first moments (m00, m10, m01) of many contours at once, with the polygon
+    formulas cv2.contourArea and cv2.moments use. All vertices are handled in one pass:
+    the cross products of consecutive vertices are summed per contour with reduceat.
+    """
+    lengths = np.array([len(contour) for contour in contours], dtype=np.int64)
+    if len(contours) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    points = np.concatenate([contour.reshape(-1, 2) for contour in contours]).astype(np.float64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    contour = np.repeat(np.arange(len(contours)), lengths)
+    # Relative to the first vertex of each contour, so the cross products do not cancel out
+    origin = points[starts][contour]
+    x, y = (points - origin).T
+    # Next vertex of each vertex, wrapping around within its contour
+    following = np.arange(1, len(points) + 1)
+    following[starts + lengths - 1] = starts
+    cross = x * y[following] - y * x[following]
+    m00 = 0.5 * np.add.reduceat(cross, starts)
+    m10 = np.add.reduceat((x + x[following]) * cross, starts) / 6
+    m01 = np.add.reduceat((y + y[following]) * cross, starts) / 6
+    # Back to image coordinates: shifting by the origin adds m00 times its coordinates
+    m10 += m00 * points[starts, 0]
+    m01 += m00 * points[starts, 1]
+    return m00, m10, m01
+
+@instrument.traced()
+def calculate_objects_data_vectorized(thresholded_image, geotransform, transform, contours=None):
+    """
+    Calculate area, center, and real-world coordinates for each object without a per-contour
+    loop. Areas and centers come from the moments of all contours computed at once, and all
+    centers go through OSR in a single TransformPoints call.
+    The output matches calculate_objects_data: one row per external contour, with the
+    contourArea area (holes included) and the truncated moment center.
+    """
+    if contours is None:
+        contours = find_contours(thresholded_image)
+    instrument.add_items(len(contours))
+    m00, m10, m01 = _contour_moments(contours)
+
+    pixel_area = np.abs(m00)
+    nonzero = m00 != 0
+    center_x = np.where(nonzero, m10 / np.where(nonzero, m00, 1), 0).astype(int)
+    center_y = np.where(nonzero, m01 / np.where(nonzero, m00, 1), 0).astype(int)
+    real_area = pixel_area * geotransform[1] * abs(geotransform[5])
+    center_lat, center_long = transform_points(center_x, center_y, geotransform, transform)
+
+    return {"Contour": list(contours), "Area": pixel_area, "Real_area": real_area,
+            "Center_X": center_x, "Center_Y": center_y,
+            "Center_lat": center_lat, "Center_long": center_long}
+
+# block-wise counting
+
+_block_dataset = None
+
+def _open_block_dataset(image_path):
+    """Open the raster once per worker process."""
+    global _block_dataset
+    _block_dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+
+def label_block(block):
+    """
+    Label the objects of one block and summarise them.
+    Returns the per-label area and coordinate sums (local coordinates) and the labels along
+    the four block edges, which is all the seam stitching needs.
+    """
+    # Same segmentation as load_and_threshold_image: values above 1 are objects
+    binary = (block > 1).astype(np.uint8)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    # The coordinate sums follow from the centroids, without index planes the size of the block
+    area = stats[1:, cv2.CC_STAT_AREA].astype(np.int64)
+    sum_x = area * centroids[1:, 0]
+    sum_y = area * centroids[1:, 1]
+    edges = {"top": labels[0].copy(), "bottom": labels[-1].copy(),
+             "left": labels[:, 0].copy(), "right": labels[:, -1].copy()}
+    return {"count": num_labels - 1, "area": area, "sum_x": sum_x, "sum_y": sum_y, "edges": edges}
+
+def _label_window(x, y, width, height):
+    """Worker task: read and label one block of the worker's raster."""
+    block = _block_dataset.GetRasterBand(1).ReadAsArray(x, y, width, height)
+    result = label_block(block)
+    result["x"], result["y"] = x, y
+    return result
+
+def _seam_pairs(a, b):
+    """Pairs of touching labels across a seam with 8-connectivity (straight and diagonal)."""
+    pairs = [np.column_stack((a, b)), np.column_stack((a[1:], b[:-1])), np.column_stack((a[:-1], b[1:]))]
+    pairs = np.concatenate(pairs)
+    return pairs[(pairs[:, 0] > 0) & (pairs[:, 1] > 0)]
+
+def stitch_blocks(blocks, num_block_rows, num_block_cols):
+    """
+    Join objects that cross block seams with a union-find pass over the seam label pairs.
+
+    Parameters:
+    - blocks: Results of label_block in row-major block order, each with its x and y offset.
+    - num_block_rows, num_block_cols: Shape of the block grid.
+
+    Returns:
+    - Arrays of pixel area, center x and center y (scene coordinates) per stitched object.
+    """
+    offsets = np.cumsum([0] + [block["count"] for block in blocks])
+    total = offsets[-1]
+    grid = lambda r, c: r * num_block_cols + c
+
+    def global_labels(index, side):
+        local = blocks[index]["edges"][side].astype(np.int64)
+        return np.where(local > 0, local + offsets[index], 0)
+
+    pairs = []
+    for r in range(num_block_rows):
+        for c in range(num_block_cols):
+            if c + 1 < num_block_cols:
+                pairs.append(_seam_pairs(global_labels(grid(r, c), "right"), global_labels(grid(r, c + 1), "left")))
+            if r + 1 < num_block_rows:
+                pairs.append(_seam_pairs(global_labels(grid(r, c), "bottom"), global_labels(grid(r + 1, c), "top")))
+                # Diagonal neighbours across the block corners
+                if c + 1 < num_block_cols:
+                    pairs.append(_seam_pairs(global_labels(grid(r, c), "bottom")[-1:], global_labels(grid(r + 1, c + 1), "top")[:1]))
+                if c > 0:
+                    pairs.append(_seam_pairs(global_labels(grid(r, c), "bottom")[:1], global_labels(grid(r + 1, c - 1), "top")[-1:]))
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+
+    # Labels are 1-based, node 0 is unused
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(total + 1, total + 1))
+    _, roots = connected_components(graph, directed=False)
+    roots = roots[1:]
+
+    area = np.concatenate([block["area"] for block in blocks])
+    sum_x = np.concatenate([block["sum_x"] + block["area"] * block["x"] for block in blocks])
+    sum_y = np.concatenate([block["sum_y"] + block["area"] * block["y"] for block in blocks])
+    _, objects = np.unique(roots, return_inverse=True)
+    object_area = np.bincount(objects, weights=area)
+    center_x = np.bincount(objects, weights=sum_x) / object_area
+    center_y = np.bincount(objects, weights=sum_y) / object_area
+    return object_area, center_x, center_y
+
+@instrument.traced()
+def count_objects_blockwise(image_path, block_size=4096, num_workers=None):
+    """
+    Count objects in a georeferenced raster that may not fit in memory.
+    The GeoTIFF is read in blocks on a process pool, each block is labelled on its own and
+    objects crossing block seams are joined afterwards.
+
+    Parameters:
+    - image_path: Path to the georeferenced mask (e.g. georeferenced.tif).
+    - block_size: Width and height of the blocks; multiples of the GeoTIFF block size read best.
+    - num_workers: Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+    - dict: The area and center columns of calculate_objects_data_vectorized (without Contour),
+      but from pixel counts and pixel centroids, so holes are not part of the area. Objects
+      lying inside another object's hole are counted here too.
+    """
+    dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Failed to open the GeoTIFF file at {image_path}.")
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    dataset = None
+    geotransform, transform = setup_coordinate_transformation(image_path)
+
+    windows = [(x, y, min(block_size, width - x), min(block_size, height - y))
+               for y in range(0, height, block_size) for x in range(0, width, block_size)]
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_open_block_dataset,
+                             initargs=(image_path,)) as executor:
+        blocks = list(executor.map(_label_window, *zip(*windows)))
+
+    num_block_rows = math.ceil(height / block_size)
+    num_block_cols = math.ceil(width / block_size)
+    pixel_area, center_x, center_y = stitch_blocks(blocks, num_block_rows, num_block_cols)
+    center_x = center_x.astype(int)
+    center_y = center_y.astype(int)
+    real_area = pixel_area * geotransform[1] * abs(geotransform[5])
+    center_lat, center_long = transform_points(center_x, center_y, geotransform, transform)
+    return {"Area": pixel_area, "Real_area": real_area, "Center_X": center_x, "Center_Y": center_y,
+            "Center_lat": center_lat, "Center_long": center_long}
+
+@instrument.traced()
+def save_data_and_image(data, image, output_csv_path=None, output_image_path=None):
+    """
+    Save the DataFrame as a CSV file and an image with labeled instances.
+    The paths default to farmponds_data.csv and labeled_farmponds.png in ./output.
+    """
+    # Outlines are not written as text; keep them with pond_store.PondStore instead
+    df = pd.DataFrame({key: values for key, values in data.items() if key != "Contour"})
     df["Label"] = range(1, len(df) + 1)
-    output_csv_path = os.path.join('./output', 'farmponds_data.csv')
+    output_csv_path = output_csv_path or os.path.join('./output', 'farmponds_data.csv')
     df.to_csv(output_csv_path, index=False)
     print(f'Object data saved in "{output_csv_path}".')
 
@@ -85,7 +288,7 @@ def save_data_and_image(data, image):
         x, y, w, h = cv2.boundingRect(contour)
         cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), 2)
         cv2.putText(image, str(label), (data["Center_X"][i], data["Center_Y"][i]), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-    output_image_path = os.path.join('./output', 'labeled_farmponds.png')
+    output_image_path = output_image_path or os.path.join('./output', 'labeled_farmponds.png')
     cv2.imwrite(output_image_path, image)
     print(f'Labeled image saved in "{output_image_path}".')
 
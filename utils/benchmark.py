@@ -0,0 +1,275 @@
+"""
+Synthetic-scene benchmarks for the pipeline stages.
+A scene and its pond mask are generated with a chosen size and pond density, every stage
+runs in its own child process, and its wall time, throughput and peak RSS are saved as JSON.
+A previous JSON can be passed as a baseline to flag regressions.
+
+Usage:
+    python -m utils.benchmark --sizes 4096 8192 --output bench.json
+    python -m utils.benchmark --sizes 4096 --baseline bench.json --threshold 0.2
+"""
+
+import os, sys, json, time, queue, argparse, resource, tempfile, platform
+import multiprocessing as mp
+import numpy as np
+import cv2
+from PIL import Image
+
+from utils import preprocess as prep
+from utils import mosaic as mosc
+from utils import area_calculator as ac
+from utils import create_annotations as ca
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+def generate_scene(output_folder, width, height, ponds_per_megapixel=20, seed=0):
+    """
+    Write a synthetic scene.png (textured farmland) and mask.png (white ponds on black).
+
+    Returns:
+    - (scene_path, mask_path, number_of_ponds)
+    """
+    rng = np.random.default_rng(seed)
+    scene = rng.integers(60, 140, size=(height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    num_ponds = int(ponds_per_megapixel * width * height / 1e6)
+    for _ in range(num_ponds):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(20, 60)), int(rng.integers(20, 60)))
+        angle = float(rng.uniform(0, 180))
+        cv2.ellipse(mask, center, axes, angle, 0, 360, 255, -1)
+        cv2.ellipse(scene, center, axes, angle, 0, 360, (120, 60, 20), -1)
+
+    scene_path = os.path.join(output_folder, "scene.png")
+    mask_path = os.path.join(output_folder, "mask.png")
+    cv2.imwrite(scene_path, scene)
+    cv2.imwrite(mask_path, mask)
+    return scene_path, mask_path, num_ponds
+
+
+# Stages: each gets the work folder and the scene parameters, prepares its inputs,
+# and returns (seconds spent in the stage itself, work units, unit name).
+
+def stage_divide_and_save_image(work, params):
+    start = time.perf_counter()
+    prep.divide_and_save_image(os.path.join(work, "scene.png"), os.path.join(work, "tiles"),
+                               params["tile"], params["tile"])
+    prep.divide_and_save_image(os.path.join(work, "mask.png"), os.path.join(work, "mask_tiles"),
+                               params["tile"], params["tile"])
+    elapsed = time.perf_counter() - start
+    return elapsed, 2 * params["width"] * params["height"] / 1e6, "megapixels"
+
+
+def stage_create_sub_masks(work, params):
+    folder = os.path.join(work, "mask_tiles")
+    files = sorted(os.listdir(folder))[:params["max_annotation_tiles"]]
+    images = [Image.open(os.path.join(folder, f)).convert("RGB") for f in files]
+    start = time.perf_counter()
+    for image in images:
+        ca.create_sub_masks(image, *image.size)
+    return time.perf_counter() - start, len(images), "tiles"
+
+
+def stage_process_directory(work, params):
+    start = time.perf_counter()
+    mosc.process_directory(os.path.join(work, "mask_tiles"), os.path.join(work, "arrays"))
+    return time.perf_counter() - start, len(os.listdir(os.path.join(work, "arrays"))), "tiles"
+
+
+def stage_merge_tiles(work, params):
+    folder = os.path.join(work, "arrays")
+    start = time.perf_counter()
+    filenames = mosc.load_and_sort_filenames(folder)
+    merged, _ = mosc.merge_tiles(filenames, folder, (params["width"], params["height"]))
+    elapsed = time.perf_counter() - start
+    np.save(os.path.join(work, "merged.npy"), merged)
+    return elapsed, len(filenames), "tiles"
+
+
+def stage_save_merged_image(work, params):
+    merged = np.load(os.path.join(work, "merged.npy"))
+    start = time.perf_counter()
+    mosc.save_merged_image(merged, os.path.join(work, "merged.png"))
+    return time.perf_counter() - start, merged.size / 1e6, "megapixels"
+
+
+def stage_create_geotiff_copy(work, params):
+    from utils import georeference as georef
+    start = time.perf_counter()
+    dst_ds = georef.create_geotiff_copy(os.path.join(work, "merged.png"), os.path.join(work, "merged.tif"))
+    geotransform = georef.calculate_geotransform_parameters(dst_ds, 75.97936, 19.946435, 76.021714, 19.88961)
+    georef.assign_geotransform_and_projection(dst_ds, geotransform)
+    dst_ds = None
+    return time.perf_counter() - start, params["width"] * params["height"] / 1e6, "megapixels"
+
+
+def stage_calculate_objects_data(work, params):
+    merged = np.load(os.path.join(work, "merged.npy"))
+    thresholded = (merged > 0).astype(np.uint8) * 255
+    geotransform = (75.97936, 0.3 / 111320, 0, 19.946435, 0, -0.3 / 111320)
+    start = time.perf_counter()
+    contours = ac.find_contours(thresholded)
+    ac.calculate_objects_data(contours, geotransform, None)
+    return time.perf_counter() - start, len(contours), "objects"
+
+
+STAGES = {
+    "divide_and_save_image": stage_divide_and_save_image,
+    "create_sub_masks": stage_create_sub_masks,
+    "process_directory": stage_process_directory,
+    "merge_tiles": stage_merge_tiles,
+    "save_merged_image": stage_save_merged_image,
+    "create_geotiff_copy": stage_create_geotiff_copy,
+    "calculate_objects_data": stage_calculate_objects_data,
+}
+
+
+def _stage_child(stage, work, params, results):
+    try:
+        seconds, units, unit_name = STAGES[stage](work, params)
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        results.put({"seconds": seconds, "units": units, "unit": unit_name,
+                     "throughput": units / seconds if seconds else None, "peak_rss_bytes": peak_rss})
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_stage(stage, work, params, timeout=None, poll_seconds=1.0):
+    """
+    Run one stage in a fresh child process so its peak RSS is not hidden by earlier stages.
+    A child that dies without reporting (OOM-killed, segfault) or runs past timeout seconds
+    gives an error result instead of blocking the benchmark.
+    """
+    results = mp.Queue()
+    child = mp.Process(target=_stage_child, args=(stage, work, params, results))
+    child.start()
+    start = time.perf_counter()
+    while True:
+        try:
+            result = results.get(timeout=poll_seconds)
+            break
+        except queue.Empty:
+            pass
+        if not child.is_alive():
+            # The result may have been queued just before the child exited
+            try:
+                result = results.get(timeout=poll_seconds)
+            except queue.Empty:
+                signal = f" (signal {-child.exitcode})" if child.exitcode < 0 else ""
+                result = {"error": f"stage process exited with code {child.exitcode}{signal}"}
+            break
+        if timeout is not None and time.perf_counter() - start > timeout:
+            child.terminate()
+            result = {"error": f"stage timed out after {timeout} s"}
+            break
+    child.join()
+    return result
+
+
+def run_benchmarks(sizes, ponds_per_megapixel=20, tile=1024, stages=None, max_annotation_tiles=50, timeout=None):
+    """
+    Run the selected stages on synthetic scenes of each size.
+
+    Parameters:
+    - sizes: Scene sizes (square scenes of size x size pixels).
+    - ponds_per_megapixel: Pond density of the synthetic mask.
+    - tile: Tile width and height.
+    - stages: Names of the stages to run (default: all, in pipeline order).
+    - max_annotation_tiles: Number of mask tiles used by the create_sub_masks stage.
+    - timeout: Optional limit in seconds for each stage.
+
+    Returns:
+    - dict: Run metadata and a list of per-stage results.
+    """
+    stages = stages or list(STAGES)
+    report = {"created": time.time(), "python": platform.python_version(), "cpu_count": os.cpu_count(),
+              "results": []}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as work:
+            _, _, num_ponds = generate_scene(work, size, size, ponds_per_megapixel)
+            params = {"width": size, "height": size, "tile": tile, "ponds": num_ponds,
+                      "max_annotation_tiles": max_annotation_tiles}
+            for stage in STAGES:
+                if stage not in stages and not _required_by(stage, stages):
+                    continue
+                result = run_stage(stage, work, params, timeout)
+                if stage in stages:
+                    result.update({"stage": stage, "size": size, "ponds": num_ponds})
+                    report["results"].append(result)
+                    print(json.dumps(result))
+    return report
+
+
+def _required_by(stage, stages):
+    """Stages whose outputs a selected later stage reads."""
+    order = list(STAGES)
+    later = [s for s in stages if order.index(s) > order.index(stage)]
+    needs = {"divide_and_save_image": {"create_sub_masks", "process_directory", "merge_tiles",
+                                       "save_merged_image", "create_geotiff_copy", "calculate_objects_data"},
+             "process_directory": {"merge_tiles", "save_merged_image", "create_geotiff_copy", "calculate_objects_data"},
+             "merge_tiles": {"save_merged_image", "create_geotiff_copy", "calculate_objects_data"},
+             "save_merged_image": {"create_geotiff_copy"}}
+    return bool(needs.get(stage, set()) & set(later))
+
+
+def compare_reports(current, baseline, threshold=0.2):
+    """
+    Compare two reports stage by stage and size by size.
+
+    Returns:
+    - list: Regressions where wall time or peak RSS grew by more than threshold (0.2 = 20%),
+      and every stage that failed in the current run (metric "error").
+    """
+    reference = {(r["stage"], r["size"]): r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    for result in current["results"]:
+        old = reference.get((result["stage"], result["size"]))
+        if "error" in result:
+            regressions.append({"stage": result["stage"], "size": result["size"], "metric": "error",
+                                "baseline": old["seconds"] if old else None, "current": None,
+                                "error": result["error"]})
+            continue
+        if old is None:
+            continue
+        for metric in ("seconds", "peak_rss_bytes"):
+            if result[metric] > old[metric] * (1 + threshold):
+                regressions.append({"stage": result["stage"], "size": result["size"], "metric": metric,
+                                    "baseline": old[metric], "current": result[metric],
+                                    "change": result[metric] / old[metric] - 1})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pond pipeline stages on synthetic scenes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2048, 4096])
+    parser.add_argument("--density", type=float, default=20, help="ponds per megapixel")
+    parser.add_argument("--tile", type=int, default=1024)
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES))
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument("--timeout", type=float, help="seconds after which a stage is stopped and counted as failed")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sizes, args.density, args.tile, args.stages, timeout=args.timeout)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f'Benchmark results saved in "{args.output}".')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_reports(report, json.load(file), args.threshold)
+        for regression in regressions:
+            if regression["metric"] == "error":
+                print(f"REGRESSION {regression['stage']} @ {regression['size']}px failed: {regression['error']}")
+                continue
+            print(f"REGRESSION {regression['stage']} @ {regression['size']}px {regression['metric']}: "
+                  f"{regression['baseline']:.3g} -> {regression['current']:.3g} ({regression['change']:+.0%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,32 +4,39 @@ from skimage import measure                                # (pip install scikit
 from shapely.geometry import Polygon, MultiPolygon         # (pip install Shapely)
 import os
 import json
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from utils import instrument
 
 def create_sub_masks(mask_image, width, height):
     # Initialize a dictionary of sub-masks indexed by RGB colors
+    # Pack the RGB values of every pixel into one integer so that the
+    # colors can be found with a single np.unique instead of a per-pixel loop
+    rgb = np.asarray(mask_image.convert("RGB"), dtype=np.uint32)[:height, :width]
+    packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+
+    # Keep the colors in the order the original column by column scan met them,
+    # so the annotation ids stay the same
+    colors, first_seen = np.unique(packed.T.ravel(), return_index=True)
+    colors = colors[np.argsort(first_seen)]
+
     sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # Get the RGB values of the pixel
-            pixel = mask_image.getpixel((x,y))[:3]
-            # If the pixel is not black...
-            if pixel != (0, 0, 0):
-            # Check to see if we have created a sub-mask...
-                pixel_str = str(pixel)
-                sub_mask = sub_masks.get(pixel_str)
-                if sub_mask is None:
-                # Create a sub-mask (one bit per pixel) and add to the dictionary
-                    # Note: we add 1 pixel of padding in each direction
-                    # because the contours module doesn"t handle cases
-                    # where pixels bleed to the edge of the image
-                    sub_masks[pixel_str] = Image.new("1", (width+2, height+2))
-
-                # Set the pixel value to 1 (default is 0), accounting for padding
-                sub_masks[pixel_str].putpixel((x+1, y+1), 1)
+    for color in colors:
+        # If the pixel is not black...
+        if color == 0:
+            continue
+        pixel_str = str((int(color >> 16), int((color >> 8) & 255), int(color & 255)))
+        # Create a sub-mask (one bit per pixel)
+        # Note: we add 1 pixel of padding in each direction
+        # because the contours module doesn"t handle cases
+        # where pixels bleed to the edge of the image
+        sub_mask = np.zeros((height + 2, width + 2), dtype=bool)
+        sub_mask[1:-1, 1:-1] = packed == color
+        sub_masks[pixel_str] = Image.fromarray(sub_mask)
 
     return sub_masks
 
-def create_sub_mask_annotation(sub_mask):
+def create_sub_mask_annotation(sub_mask, tolerance=1.0):
     # Find contours (boundary lines) around each sub-mask
     # Note: there could be multiple contours if the object
     # is partially occluded. (E.g. an elephant behind a tree)
@@ -40,13 +47,11 @@ def create_sub_mask_annotation(sub_mask):
     for contour in contours:
         # Flip from (row, col) representation to (x, y)
         # and subtract the padding pixel
-        for i in range(len(contour)):
-            row, col = contour[i]
-            contour[i] = (col - 1, row - 1)
+        contour = contour[:, ::-1] - 1
 
         # Make a polygon and simplify it
         poly = Polygon(contour)
-        poly = poly.simplify(1.0, preserve_topology=False)
+        poly = poly.simplify(tolerance, preserve_topology=False)
         
         if(poly.is_empty):
             # Go to next iteration, dont save empty values in list
@@ -112,3 +117,61 @@ def get_coco_json_format():
     }
 
     return coco_format
+
+def mask_annotations_info(mask_image_path, category_colors, multipolygon_ids=()):
+    # Build the "images" entry and the polygons of one mask tile.
+    # Ids are left out so that tiles can be processed in any order and numbered afterwards
+    # The mask image is *.png but the original image is *.jpg.
+    # We make a reference to the original file in the COCO JSON file
+    original_file_name = os.path.basename(mask_image_path).split(".")[0] + ".png"
+    # Open the image and (to be sure) we convert it to RGB
+    mask_image_open = Image.open(mask_image_path).convert("RGB")
+    w, h = mask_image_open.size
+
+    return original_file_name, w, h, mask_objects(mask_image_open, category_colors, multipolygon_ids)
+
+def mask_objects(mask_image, category_colors, multipolygon_ids=()):
+    # Find the (polygon, segmentation, category_id) objects of one mask image,
+    # either a mask tile read from disk or a crop of the scene mask
+    w, h = mask_image.size
+    objects = []
+    sub_masks = create_sub_masks(mask_image, w, h)
+    for color, sub_mask in sub_masks.items():
+        category_id = category_colors[color]
+        polygons, segmentations = create_sub_mask_annotation(sub_mask)
+
+        # Check if we have classes that are a multipolygon
+        if category_id in multipolygon_ids:
+            # Combine the polygons to calculate the bounding box and area
+            objects.append((MultiPolygon(polygons), segmentations, category_id))
+        else:
+            for polygon in polygons:
+                # Cleaner to recalculate this variable
+                segmentation = [np.array(polygon.exterior.coords).ravel().tolist()]
+                objects.append((polygon, segmentation, category_id))
+
+    return objects
+
+@instrument.traced()
+def images_annotations_info(maskpath, category_colors, multipolygon_ids=(), num_workers=None):
+    # Get "images" and "annotations" info for every mask tile in a folder.
+    # Tiles are processed on a process pool; results are collected in sorted
+    # file order so the image and annotation ids are deterministic
+    mask_files = sorted(glob.glob(os.path.join(maskpath, "*.png")))
+    annotation_id = 0
+    annotations = []
+    images = []
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(mask_annotations_info, mask_files,
+                               [category_colors] * len(mask_files),
+                               [tuple(multipolygon_ids)] * len(mask_files),
+                               chunksize=8)
+        for image_id, (file_name, w, h, objects) in enumerate(results):
+            images.append(create_image_annotation(file_name, w, h, image_id))
+            for polygon, segmentation, category_id in objects:
+                annotations.append(create_annotation_format(polygon, segmentation, image_id, category_id, annotation_id))
+                annotation_id += 1
+
+    instrument.add_items(len(images))
+    return images, annotations, annotation_id
@@ -0,0 +1,240 @@
+"""
+Evaluation of candidate checkpoints on the validation set.
+The validation images are decoded once into a memory-mapped cache shared by all workers,
+checkpoints are scored on a process pool on CPU, and the COCO results are stored in a
+SQLite database so that checkpoint/config pairs that were already scored are skipped.
+"""
+
+import os, json, sqlite3, time, hashlib
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import torch
+from detectron2.data import DatasetCatalog
+from detectron2.data.datasets import register_coco_instances
+from detectron2.evaluation import COCOEvaluator
+from utils import helpers as hp
+from utils.inference import BatchPredictor
+from utils.prediction_cache import file_digest
+from utils.scene_dataset import read_crop
+
+
+def dataset_digest(dataset_name, json_file=None):
+    """
+    Digest of a validation set: of its COCO json when given, otherwise of its registered
+    records (e.g. the crops of scene_dataset.register_scene_dataset).
+    """
+    if json_file:
+        return file_digest(json_file)
+    records = DatasetCatalog.get(dataset_name)
+    return hashlib.sha256(json.dumps(records, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read_val_digest(cache_dir):
+    """
+    Digest of the validation set a cache was built from, or None if there is no usable cache.
+    """
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as file:
+        index = json.load(file)
+    # Caches written before the digest was stored hold a bare list
+    return index.get("digest") if isinstance(index, dict) else None
+
+
+def build_val_cache(dataset_name, cache_dir, json_file=None):
+    """
+    Decode every image of a registered dataset once into a single memory-mapped file.
+
+    Parameters:
+    - dataset_name: Registered dataset name, e.g. "pond_val" or a split of scene_dataset.register_scene_dataset.
+    - cache_dir: Folder for images.bin and index.json. An existing cache is reused if it was
+      built from the same validation set (see dataset_digest), and rebuilt otherwise.
+    - json_file: COCO json of the dataset, digested to tell whether the cache is stale.
+
+    Returns:
+    - The digest of the validation set.
+    """
+    digest = dataset_digest(dataset_name, json_file)
+    if read_val_digest(cache_dir) == digest:
+        return digest
+    os.makedirs(cache_dir, exist_ok=True)
+
+    images = []
+    offset = 0
+    with open(os.path.join(cache_dir, "images.bin"), "wb") as file:
+        for record in DatasetCatalog.get(dataset_name):
+            # Crops of register_scene_dataset come from the memory-mapped scene
+            image = read_crop(record) if "crop" in record else cv2.imread(record["file_name"])
+            file.write(image.tobytes())
+            images.append({"image_id": record["image_id"], "file_name": record["file_name"],
+                           "shape": list(image.shape), "offset": offset})
+            offset += image.nbytes
+    with open(os.path.join(cache_dir, "index.json"), "w") as file:
+        json.dump({"digest": digest, "images": images}, file)
+    return digest
+
+
+def load_val_cache(cache_dir):
+    """
+    Open the cache read-only. The pages are shared by every process reading it.
+
+    Yields:
+    - (image_id, BGR image) pairs.
+    """
+    with open(os.path.join(cache_dir, "index.json")) as file:
+        index = json.load(file)["images"]
+    images = np.memmap(os.path.join(cache_dir, "images.bin"), dtype=np.uint8, mode="r")
+    for entry in index:
+        size = int(np.prod(entry["shape"]))
+        yield entry["image_id"], images[entry["offset"]:entry["offset"] + size].reshape(entry["shape"])
+
+
+def _evaluate_checkpoint(weights_path, config_path, dataset_name, json_file, image_root, cache_dir,
+                         score_thresh, num_threads):
+    """
+    Worker task: score one checkpoint/config pair on the cached validation images.
+    """
+    torch.set_num_threads(num_threads)
+    if dataset_name not in DatasetCatalog.list():
+        register_coco_instances(dataset_name, {}, json_file, image_root)
+
+    cfg = hp.load_from_cloudpickle(config_path)
+    cfg.MODEL.WEIGHTS = weights_path
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_thresh
+    cfg.MODEL.DEVICE = "cpu"
+    predictor = BatchPredictor(cfg)
+
+    output_dir = os.path.join(cache_dir, "evaluator", os.path.splitext(os.path.basename(weights_path))[0])
+    results, _ = evaluate_predictor(predictor, dataset_name, cache_dir, output_dir)
+    return results
+
+
+def evaluate_predictor(predictor, dataset_name, cache_dir, output_dir):
+    """
+    Score a predictor on the cached validation images, one image at a time.
+
+    Parameters:
+    - predictor: A BatchPredictor or inference.ExportedPredictor (anything with preprocess and
+      a call on a list of inputs).
+    - dataset_name: Registered validation dataset, e.g. "pond_val".
+    - cache_dir: Folder of the validation cache (see build_val_cache).
+    - output_dir: Folder for the COCOEvaluator outputs.
+
+    Returns:
+    - (results, latencies): The COCO results and the seconds spent per image on preprocessing
+      and prediction.
+    """
+    evaluator = COCOEvaluator(dataset_name, output_dir=output_dir)
+    evaluator.reset()
+    latencies = []
+    for image_id, image in load_val_cache(cache_dir):
+        image = np.array(image)
+        start = time.perf_counter()
+        inputs = predictor.preprocess(image)
+        outputs = predictor([inputs])
+        latencies.append(time.perf_counter() - start)
+        inputs["image_id"] = image_id
+        evaluator.process([inputs], outputs)
+    return dict(evaluator.evaluate()), latencies
+
+
+def _open_results(db_path):
+    conn = sqlite3.connect(db_path)
+    # Results are keyed by the validation set as well; rows of the older results table have no digest and are ignored
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS val_results ("
+        "weights_digest TEXT, config_digest TEXT, val_digest TEXT, score_thresh REAL, "
+        "model_path TEXT, config_path TEXT, segm_ap REAL, bbox_ap REAL, results TEXT, created REAL, "
+        "PRIMARY KEY (weights_digest, config_digest, val_digest, score_thresh))"
+    )
+    return conn
+
+
+def _result_keys(candidates, val_digest, score_thresh):
+    """(weights_digest, config_digest, val_digest, score_thresh) of every candidate pair."""
+    return [(file_digest(weights_path), file_digest(config_path), val_digest, score_thresh)
+            for weights_path, config_path in candidates]
+
+
+def evaluate_checkpoints(candidates, dataset_name, json_file, image_root, cache_dir, db_path,
+                         score_thresh=0.7, num_workers=None):
+    """
+    Evaluate candidate checkpoints in parallel and record their COCO results.
+    A checkpoint/config pair is identified by the contents of both files, the validation set
+    and the score threshold, so pairs that were already scored are not evaluated again.
+
+    Parameters:
+    - candidates: Sequence of (weights_path, config_path) pairs, e.g. model_{n}.pth / config_{n}.pkl.
+    - dataset_name: Registered validation dataset, e.g. "pond_val".
+    - json_file, image_root: COCO json and image folder of the dataset, used to register it in workers.
+    - cache_dir: Folder of the validation cache (see build_val_cache).
+    - db_path: SQLite file the results are stored in.
+    - score_thresh: SCORE_THRESH_TEST used for evaluation.
+    - num_workers: Number of worker processes. Defaults to cpu_count // 4 (at least 1).
+
+    Returns:
+    - dict: {weights_path: results} for every candidate, including previously scored ones.
+    """
+    val_digest = build_val_cache(dataset_name, cache_dir, json_file)
+    num_workers = num_workers or max(1, (os.cpu_count() or 1) // 4)
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    conn = _open_results(db_path)
+    results = {}
+    pending = []
+    for (weights_path, config_path), key in zip(candidates, _result_keys(candidates, val_digest, score_thresh)):
+        row = conn.execute("SELECT results FROM val_results WHERE weights_digest = ? AND config_digest = ? "
+                           "AND val_digest = ? AND score_thresh = ?", key).fetchone()
+        if row is not None:
+            results[weights_path] = json.loads(row[0])
+        else:
+            pending.append((weights_path, config_path, key))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [(weights_path, config_path, key,
+                    executor.submit(_evaluate_checkpoint, weights_path, config_path, dataset_name, json_file,
+                                    image_root, cache_dir, score_thresh, num_threads))
+                   for weights_path, config_path, key in pending]
+        for weights_path, config_path, key, future in futures:
+            scores = future.result()
+            results[weights_path] = scores
+            conn.execute("INSERT OR REPLACE INTO val_results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (*key, weights_path, config_path, scores.get("segm", {}).get("AP"),
+                          scores.get("bbox", {}).get("AP"), json.dumps(scores), time.time()))
+            conn.commit()
+            print(f"{os.path.basename(weights_path)}: {scores}")
+
+    conn.close()
+    return results
+
+
+def find_best_model(db_path, candidates, cache_dir, metric="segm_ap", score_thresh=0.7):
+    """
+    Pick the best of the given checkpoints from the results database.
+    Only the results of these files as they are now, on the validation set the cache was
+    built from, are considered, so rows of earlier runs or of overwritten model_{n}.pth
+    files are never returned.
+
+    Parameters:
+    - candidates: The (weights_path, config_path) pairs passed to evaluate_checkpoints.
+    - cache_dir: Folder of the validation cache they were scored on.
+    - metric: "segm_ap" or "bbox_ap".
+    - score_thresh: SCORE_THRESH_TEST they were scored with.
+
+    Returns:
+    - (model_path, config_path, ap), or (None, None, -1) if none of them was scored.
+    """
+    if metric not in ("segm_ap", "bbox_ap"):
+        raise ValueError(f"Unknown metric: {metric}")
+    val_digest = read_val_digest(cache_dir)
+    conn = _open_results(db_path)
+    best = (None, None, -1)
+    for (weights_path, config_path), key in zip(candidates, _result_keys(candidates, val_digest, score_thresh)):
+        row = conn.execute(f"SELECT {metric} FROM val_results WHERE weights_digest = ? AND config_digest = ? "
+                           f"AND val_digest = ? AND score_thresh = ?", key).fetchone()
+        if row is not None and row[0] is not None and row[0] > best[2]:
+            best = (weights_path, config_path, row[0])
+    conn.close()
+    return best
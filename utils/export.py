@@ -0,0 +1,167 @@
+"""
+Export of a trained checkpoint for CPU inference, and a report of what it costs in accuracy.
+The model is traced to a TorchScript graph (detectron2's TracingAdapter), optionally with the
+fully connected layers of the box head quantized to int8 (dynamic quantization), and frozen
+and optimized for inference. inference.ExportedPredictor runs the exported file in place of
+DefaultPredictor, and InferenceEngine(cfg, exported=path) in the application loop.
+
+Usage:
+    python -m utils.export --best output/performance/best_performance.txt --sample data/tile_0_0.png \\
+        --output output/model_int8.ts --quantize
+    python -m utils.export --best output/performance/best_performance.txt --sample data/tile_0_0.png \\
+        --output output/model_int8.ts --quantize --val-json data/val/val.json --val-root data/val \\
+        --val-cache output/performance/val_cache
+"""
+
+import os, sys, json, time, argparse
+import cv2
+import numpy as np
+import torch
+from detectron2.data import DatasetCatalog
+from detectron2.data.datasets import register_coco_instances
+from detectron2.export import TracingAdapter
+from utils import helpers as hp
+from utils import evaluation as ev
+from utils.inference import BatchPredictor, ExportedPredictor
+from utils.prediction_cache import file_digest
+
+
+def _inference(model, inputs):
+    """Runs the model without pasting the masks (done by ExportedPredictor) and returns plain tensors."""
+    instances = model.inference(inputs, do_postprocess=False)[0]
+    return instances.pred_boxes.tensor, instances.scores, instances.pred_classes, instances.pred_masks
+
+
+def export_model(cfg, sample_image, output_path, quantize=False, optimize=True):
+    """
+    Trace a checkpoint into a TorchScript file for CPU inference.
+
+    Parameters:
+    - cfg: The detectron2 config with MODEL.WEIGHTS set. The score threshold is fixed at export.
+    - sample_image: BGR tile (or its path) to trace with; pick one with ponds in it, so that the
+      mask head is part of the traced graph.
+    - output_path: Path of the exported model (.ts).
+    - quantize: True to quantize the Linear layers to int8 with dynamic quantization.
+    - optimize: True to freeze the graph and apply torch.jit.optimize_for_inference.
+
+    Returns:
+    - The metadata stored with the model.
+    """
+    cfg = cfg.clone()
+    cfg.MODEL.DEVICE = "cpu"
+    predictor = BatchPredictor(cfg)
+    model = predictor.model
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if isinstance(sample_image, str):
+        sample_image = cv2.imread(sample_image)
+    image = predictor.preprocess(sample_image)["image"]
+    adapter = TracingAdapter(model, [{"image": image}], _inference)
+    with torch.no_grad():
+        traced = torch.jit.trace(adapter, adapter.flattened_inputs)
+        if optimize:
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+    meta = {"input_format": cfg.INPUT.FORMAT, "min_size": cfg.INPUT.MIN_SIZE_TEST,
+            "max_size": cfg.INPUT.MAX_SIZE_TEST, "score_thresh": cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST,
+            "quantized": quantize, "optimized": optimize, "weights": os.path.abspath(cfg.MODEL.WEIGHTS),
+            "weights_digest": file_digest(cfg.MODEL.WEIGHTS), "torch": torch.__version__}
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    torch.jit.save(traced, output_path, _extra_files={"meta.json": json.dumps(meta)})
+    return meta
+
+
+def _latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {"mean_ms": float(latencies.mean()), "median_ms": float(np.median(latencies)),
+            "p90_ms": float(np.percentile(latencies, 90)), "tiles": len(latencies)}
+
+
+def compare_exported(cfg, exported_path, dataset_name, json_file, image_root, cache_dir, num_threads=None):
+    """
+    Score the original checkpoint and the exported model on the same validation images.
+
+    Parameters:
+    - cfg: The detectron2 config the model was exported from.
+    - exported_path: Path of the exported model.
+    - dataset_name: Validation dataset, e.g. "pond_val".
+    - json_file, image_root: COCO json and image folder of the dataset, used to register it.
+    - cache_dir: Folder of the validation cache (see evaluation.build_val_cache).
+    - num_threads: torch intra-op threads, as on the inference nodes. Defaults to torch's default.
+
+    Returns:
+    - dict: segm/bbox AP and per-tile latency of "original" and "exported", the AP change and the speedup.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if dataset_name not in DatasetCatalog.list():
+        register_coco_instances(dataset_name, {}, json_file, image_root)
+    ev.build_val_cache(dataset_name, cache_dir, json_file)
+
+    cfg = cfg.clone()
+    cfg.MODEL.DEVICE = "cpu"
+    predictors = {"original": BatchPredictor(cfg), "exported": ExportedPredictor(exported_path)}
+    predictors["exported"].check_config(cfg)
+
+    report = {"exported_path": exported_path, "meta": predictors["exported"].meta,
+              "num_threads": torch.get_num_threads()}
+    for name, predictor in predictors.items():
+        output_dir = os.path.join(cache_dir, "evaluator", f"export_{name}")
+        results, latencies = ev.evaluate_predictor(predictor, dataset_name, cache_dir, output_dir)
+        report[name] = {"segm_ap": results.get("segm", {}).get("AP"), "bbox_ap": results.get("bbox", {}).get("AP"),
+                        "latency": _latency_summary(latencies), "results": results}
+
+    original, exported = report["original"], report["exported"]
+    if original["segm_ap"] is not None and exported["segm_ap"] is not None:
+        report["segm_ap_change"] = exported["segm_ap"] - original["segm_ap"]
+    report["speedup"] = original["latency"]["median_ms"] / exported["latency"]["median_ms"]
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a trained model to TorchScript for CPU inference.")
+    parser.add_argument("--best", help="best_performance.txt with the model path and config path")
+    parser.add_argument("--weights", help="trained model (.pth), instead of --best")
+    parser.add_argument("--config", help="model config (.pkl), instead of --best")
+    parser.add_argument("--sample", required=True, help="tile to trace with, preferably one with ponds")
+    parser.add_argument("--output", required=True, help="exported model (.ts)")
+    parser.add_argument("--score-thresh", type=float, default=0.7)
+    parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization of the Linear layers")
+    parser.add_argument("--no-optimize", action="store_true", help="skip freezing and optimize_for_inference")
+    parser.add_argument("--dataset", default="pond_val", help="validation dataset for the report")
+    parser.add_argument("--val-json", help="COCO json of the validation set; with it a report is written")
+    parser.add_argument("--val-root", help="image folder of the validation set")
+    parser.add_argument("--val-cache", help="validation cache folder (see evaluation.build_val_cache)")
+    parser.add_argument("--threads", type=int, help="torch threads for the latency measurement")
+    args = parser.parse_args(argv)
+
+    if args.best:
+        args.weights, args.config = hp.read_paths_from_file(args.best)[:2]
+    if not (args.weights and args.config):
+        parser.error("pass --best or both --weights and --config")
+    cfg = hp.load_from_cloudpickle(args.config)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh
+
+    start = time.perf_counter()
+    meta = export_model(cfg, args.sample, args.output, quantize=args.quantize, optimize=not args.no_optimize)
+    print(f'Model exported to "{args.output}" in {time.perf_counter() - start:.1f} s: {meta}')
+
+    if args.val_json:
+        cache_dir = args.val_cache or os.path.join(os.path.dirname(os.path.abspath(args.output)), "val_cache")
+        report = compare_exported(cfg, args.output, args.dataset, args.val_json, args.val_root or
+                                  os.path.dirname(args.val_json), cache_dir, args.threads)
+        report_path = os.path.splitext(args.output)[0] + "_report.json"
+        with open(report_path, "w") as file:
+            json.dump(report, file, indent=4)
+        for name in ("original", "exported"):
+            print(f'{name}: segm AP {report[name]["segm_ap"]}, bbox AP {report[name]["bbox_ap"]}, '
+                  f'{report[name]["latency"]["median_ms"]:.0f} ms per tile (median)')
+        print(f'Speedup {report["speedup"]:.2f}x, segm AP change {report.get("segm_ap_change")}. '
+              f'Report saved in "{report_path}".')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
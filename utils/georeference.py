@@ -1,5 +1,7 @@
+import os
 from osgeo import gdal, osr
 import numpy as np
+from utils import instrument
 
 def open_source_image(input_png):
     """
@@ -10,6 +12,7 @@ def open_source_image(input_png):
         raise FileNotFoundError(f"Unable to open input PNG file: {input_png}")
     return src_ds
 
+@instrument.traced()
 def create_geotiff_copy(input_png, output_geotiff):
     """
     Create a copy of the input PNG as a GeoTIFF.
@@ -40,9 +43,236 @@ def assign_geotransform_and_projection(dst_ds, geotransform):
     srs.ImportFromEPSG(4326)  # EPSG 4326 is the code for WGS84
     dst_ds.SetProjection(srs.ExportToWkt())
 
-def add_gcp():
+@instrument.traced()
+def write_georeferenced_mask(array, output_geotiff, top_left_x, top_left_y, bottom_right_x, bottom_right_y,
+                             cog=True, block_size=512, chunk_rows=4096, compress="DEFLATE"):
     """
-    Adding GCP to georeference
+    Write the merged mask straight to a georeferenced, tiled, compressed single-band GeoTIFF.
+    This replaces save_merged_image -> create_geotiff_copy -> assign_geotransform_and_projection,
+    so the raster is encoded once instead of going through a full-size RGBA PNG.
+    Ponds are written as 255 and the background as 0, as in the PNG path.
+
+    Parameters:
+    - array: The (height, width) merged array, e.g. the memory-mapped canvas from mosaic.create_canvas
+      or a packed mask_codec.PackedMask; it is read chunk_rows rows at a time.
+    - output_geotiff: Path of the GeoTIFF to write.
+    - top_left_x, top_left_y: NW corner (longitude, latitude).
+    - bottom_right_x, bottom_right_y: SE corner (longitude, latitude).
+    - cog: Write a cloud-optimized GeoTIFF (overviews first, readable by range requests).
+      Otherwise a tiled GeoTIFF with internal overviews is written in place.
+    - block_size: Internal tile size in pixels.
+    - chunk_rows: Number of rows written per step, which bounds memory use.
+    - compress: GDAL compression method.
+
+    Returns:
+    - The path of the written GeoTIFF.
+    """
+    height, width = array.shape
+    tiled_path = output_geotiff + ".tmp.tif" if cog else output_geotiff
+    options = ["TILED=YES", f"BLOCKXSIZE={block_size}", f"BLOCKYSIZE={block_size}", f"COMPRESS={compress}",
+               "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER", "SPARSE_OK=TRUE"]
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(tiled_path, width, height, 1, gdal.GDT_Byte, options)
+    if dst_ds is None:
+        raise Exception(f"Unable to create output GeoTIFF file: {tiled_path}")
+
+    geotransform = calculate_geotransform_parameters(dst_ds, top_left_x, top_left_y, bottom_right_x, bottom_right_y)
+    assign_geotransform_and_projection(dst_ds, geotransform)
+    band = dst_ds.GetRasterBand(1)
+    for start in range(0, height, chunk_rows):
+        chunk = np.asarray(array[start:start + chunk_rows])
+        # Leave all-zero chunks unwritten, SPARSE_OK keeps them out of the file
+        if chunk.any():
+            band.WriteArray(((chunk != 0) * 255).astype(np.uint8), 0, start)
+
+    if cog:
+        dst_ds = None
+        cog_ds = gdal.Translate(output_geotiff, tiled_path, format="COG",
+                                creationOptions=[f"COMPRESS={compress}", f"BLOCKSIZE={block_size}",
+                                                 "NUM_THREADS=ALL_CPUS", "OVERVIEWS=AUTO",
+                                                 "RESAMPLING=NEAREST", "BIGTIFF=IF_SAFER"])
+        if cog_ds is None:
+            raise Exception(f"Unable to create output GeoTIFF file: {output_geotiff}")
+        cog_ds = None
+        os.remove(tiled_path)
+    else:
+        # Overview options are GDAL config options; restore the caller's values afterwards
+        overview_options = {"COMPRESS_OVERVIEW": compress, "GDAL_NUM_THREADS": "ALL_CPUS"}
+        previous_options = {key: gdal.GetConfigOption(key) for key in overview_options}
+        try:
+            for key, value in overview_options.items():
+                gdal.SetConfigOption(key, value)
+            dst_ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32])
+        finally:
+            for key, value in previous_options.items():
+                gdal.SetConfigOption(key, value)
+        dst_ds = None
+
+    return output_geotiff
+
+def _polynomial_terms(xs, ys, order):
+    """
+    Build the polynomial design matrix [1, x, y, x^2, xy, y^2, ...] up to the given order.
+    """
+    return np.column_stack([xs ** (n - j) * ys ** j for n in range(order + 1) for j in range(n + 1)])
+
+def _tps_kernel(distances):
+    """
+    Thin-plate spline radial basis r^2 log r (0 at r = 0).
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kernel = distances ** 2 * np.log(distances)
+    return np.nan_to_num(kernel)
+
+def add_gcp(gcps, method="polynomial", order=1):
+    """
+    Fit a pixel -> map transform from Ground Control Points.
+    The transform is fitted once in NumPy and then applied to vector data (contour vertices
+    and centroids) with apply_gcp_transform, which is much cheaper than warping the raster.
+
+    Parameters:
+    - gcps: Sequence of (pixel_x, pixel_y, longitude, latitude) tuples.
+    - method: "polynomial" (least squares, like GDAL's -order) or "tps" (thin-plate spline,
+      passes exactly through every GCP).
+    - order: Polynomial order (1 to 3) when method is "polynomial".
+
+    Returns:
+    - dict: The fitted transform, to be passed to apply_gcp_transform.
+    """
+    gcps = np.asarray(gcps, dtype=np.float64)
+    pixels, coords = gcps[:, :2], gcps[:, 2:4]
+    # Normalize the pixel coordinates to keep the fit well conditioned
+    center = pixels.mean(axis=0)
+    scale = pixels.std(axis=0).max() or 1.0
+    xs, ys = ((pixels - center) / scale).T
+
+    if method == "polynomial":
+        if order not in (1, 2, 3):
+            raise ValueError("Polynomial order must be 1, 2 or 3.")
+        terms = _polynomial_terms(xs, ys, order)
+        if len(gcps) < terms.shape[1]:
+            raise ValueError(f"A polynomial of order {order} needs at least {terms.shape[1]} GCPs, got {len(gcps)}.")
+        coefficients, _, _, _ = np.linalg.lstsq(terms, coords, rcond=None)
+        residuals = terms @ coefficients - coords
+    elif method == "tps":
+        if len(gcps) < 3:
+            raise ValueError(f"A thin-plate spline needs at least 3 GCPs, got {len(gcps)}.")
+        points = np.column_stack((xs, ys))
+        kernel = _tps_kernel(np.linalg.norm(points[:, None] - points[None], axis=2))
+        affine = np.column_stack((np.ones(len(points)), points))
+        system = np.block([[kernel, affine], [affine.T, np.zeros((3, 3))]])
+        rhs = np.vstack((coords, np.zeros((3, 2))))
+        coefficients = np.linalg.solve(system, rhs)
+        residuals = np.zeros_like(coords)
+    else:
+        raise ValueError(f"Unknown GCP transform method: {method}")
+
+    return {"method": method, "order": order, "center": center, "scale": scale,
+            "control_points": np.column_stack((xs, ys)), "coefficients": coefficients,
+            "rms_error": float(np.sqrt((residuals ** 2).sum(axis=1).mean()))}
+
+def apply_gcp_transform(model, xs, ys, chunk_size=100000):
+    """
+    Apply a transform fitted with add_gcp to arrays of pixel coordinates in batches.
+
+    Returns:
+    - Two arrays: longitude and latitude.
+    """
+    points = (np.column_stack((np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)))
+              - model["center"]) / model["scale"]
+    result = np.empty_like(points)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        if model["method"] == "polynomial":
+            result[start:start + chunk_size] = _polynomial_terms(chunk[:, 0], chunk[:, 1], model["order"]) @ model["coefficients"]
+        else:
+            control_points = model["control_points"]
+            kernel = _tps_kernel(np.linalg.norm(chunk[:, None] - control_points[None], axis=2))
+            affine = np.column_stack((np.ones(len(chunk)), chunk))
+            result[start:start + chunk_size] = np.hstack((kernel, affine)) @ model["coefficients"]
+    return result[:, 0], result[:, 1]
+
+def _geodesic_polygon_areas(longs, lats, starts):
+    """
+    Areas in square meters of polygons given in degrees, using a local equirectangular
+    projection around each polygon (accurate for pond-sized objects).
+    The vertices of all polygons are handled at once: starts holds the index of the first
+    vertex of every polygon in longs and lats, and no polygon may be empty.
+    """
+    earth_radius = 6371008.8
+    if len(starts) == 0:
+        return np.zeros(0)
+    lengths = np.diff(np.append(starts, len(longs)))
+    polygon = np.repeat(np.arange(len(starts)), lengths)
+    lat0 = np.radians(np.add.reduceat(lats, starts) / lengths)
+    # Relative to the first vertex of each polygon, so the cross products do not cancel out
+    x = np.radians(longs - longs[starts][polygon]) * np.cos(lat0)[polygon] * earth_radius
+    y = np.radians(lats - lats[starts][polygon]) * earth_radius
+    # Next vertex of each vertex, wrapping around within its polygon
+    following = np.arange(1, len(longs) + 1)
+    following[starts + lengths - 1] = starts
+    cross = x * y[following] - y * x[following]
+    return 0.5 * np.abs(np.add.reduceat(cross, starts))
+
+@instrument.traced()
+def georeference_objects(data, model):
     """
+    Georeference the objects found by area_calculator without warping the raster.
+    All contour vertices and centers are transformed with one batched call and the real
+    areas are computed on the transformed outlines.
 
+    Parameters:
+    - data: Output of area_calculator.calculate_objects_data (needs the Contour column).
+    - model: GCP transform fitted with add_gcp.
 
+    Returns:
+    - dict: The same columns as calculate_objects_data, with Real_area in square meters and
+      Center_lat / Center_long from the GCP transform. Rows without a contour are left out.
+    """
+    present = [i for i, contour in enumerate(data["Contour"]) if contour is not None and len(contour)]
+    if len(present) < len(data["Contour"]):
+        data = {name: [values[i] for i in present] if name == "Contour" else np.asarray(values)[present]
+                for name, values in data.items()}
+    contours = [np.asarray(contour).reshape(-1, 2) for contour in data["Contour"]]
+    lengths = np.array([len(contour) for contour in contours])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(contours) else np.zeros(0, dtype=int)
+    vertices = np.concatenate(contours) if contours else np.zeros((0, 2))
+
+    longs, lats = apply_gcp_transform(model, vertices[:, 0], vertices[:, 1])
+    center_long, center_lat = apply_gcp_transform(model, data["Center_X"], data["Center_Y"])
+
+    result = dict(data)
+    result["Real_area"] = _geodesic_polygon_areas(longs, lats, starts)
+    result["Center_lat"] = center_lat
+    result["Center_long"] = center_long
+    return result
+
+@instrument.traced()
+def warp_with_gcps(input_path, output_geotiff, gcps, order=1, tps=False, warp_memory_mb=512):
+    """
+    Optional raster mode: attach the GCPs to the image and warp it to WGS84 with GDAL.
+    The warp runs chunk by chunk (bounded by warp_memory_mb) on all CPU cores and writes a
+    tiled, compressed GeoTIFF.
+
+    Parameters:
+    - input_path: The merged prediction image (PNG or GeoTIFF).
+    - output_geotiff: Path of the warped GeoTIFF.
+    - gcps: Sequence of (pixel_x, pixel_y, longitude, latitude) tuples.
+    - order: Polynomial order of the warp (ignored when tps is True).
+    - tps: Use a thin-plate spline instead of a polynomial.
+    - warp_memory_mb: Working memory of the warper, which sets the chunk size.
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    gdal_gcps = [gdal.GCP(lon, lat, 0, px, py) for px, py, lon, lat in gcps]
+    with_gcps = gdal.Translate("", open_source_image(input_path), format="VRT",
+                               GCPs=gdal_gcps, outputSRS=srs.ExportToWkt())
+    warped = gdal.Warp(output_geotiff, with_gcps, dstSRS="EPSG:4326", tps=tps,
+                       polynomialOrder=None if tps else order, resampleAlg="near",
+                       multithread=True, warpMemoryLimit=warp_memory_mb,
+                       warpOptions=["NUM_THREADS=ALL_CPUS"],
+                       creationOptions=["TILED=YES", "COMPRESS=DEFLATE", "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"])
+    if warped is None:
+        raise Exception(f"Unable to create output GeoTIFF file: {output_geotiff}")
+    warped = None
+    return output_geotiff
@@ -1,6 +1,4 @@
-import os, json, cv2, random, sys, re
-import cloudpickle
-from detectron2.config import CfgNode
+import os
 
 
 def check_and_create_folder(folder_path):
@@ -13,6 +11,9 @@ def check_and_create_folder(folder_path):
 
 
 def load_from_cloudpickle(file_path):
+    # Imported here so that the file helpers do not pull in cloudpickle (and detectron2
+    # through the pickled config) unless a config is actually loaded
+    import cloudpickle
     with open(file_path, 'rb') as f:
         data = cloudpickle.load(f)
     return data
@@ -27,5 +28,3 @@ def read_paths_from_file(file_path):
             if clean_path:  # Ensure the line is not empty
                 paths.append(clean_path)
     return paths
-
-
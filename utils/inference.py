@@ -0,0 +1,321 @@
+"""
+Batched CPU inference for the application step.
+The engine decodes and preprocesses the next batch of tiles on worker threads while the
+current batch runs through the model, and can run several model replicas side by side
+so that throughput scales with the number of CPU cores.
+The replicas are eager detectron2 models, or TorchScript models written by utils.export.
+"""
+
+import os, json, queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import transforms as T
+from detectron2.engine import DefaultPredictor
+from detectron2.modeling import build_model
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+from utils.prediction_cache import model_fingerprint, tile_key
+
+
+class BatchPredictor:
+    """
+    Same model and preprocessing as detectron2's DefaultPredictor, but runs a list of
+    images through the model in a single forward pass.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg.clone()
+        self.model = build_model(self.cfg)
+        self.model.eval()
+        DetectionCheckpointer(self.model).load(cfg.MODEL.WEIGHTS)
+        self.aug = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+        self.input_format = cfg.INPUT.FORMAT
+
+    def preprocess(self, original_image):
+        """
+        Turns a BGR image (as read by cv2.imread) into a model input dict.
+        """
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        return {"image": image, "height": height, "width": width}
+
+    def __call__(self, inputs):
+        """
+        Runs a batch of preprocessed inputs and returns one output dict per input.
+        """
+        with torch.no_grad():
+            return self.model(inputs)
+
+
+class ExportedPredictor:
+    """
+    Runs a model exported with export.export_model (a traced TorchScript graph, optionally
+    with int8 dynamic quantization) with the preprocessing and outputs of the eager model.
+    It can stand in for DefaultPredictor (predictor(image) with one BGR image) and for
+    BatchPredictor (predictor(inputs) with a list of preprocessed inputs).
+
+    Parameters:
+    - exported_path: Path of the exported model (.ts).
+    """
+
+    def __init__(self, exported_path):
+        extra_files = {"meta.json": ""}
+        self.model = torch.jit.load(exported_path, map_location="cpu", _extra_files=extra_files)
+        self.model.eval()
+        # Input format, resizing and score threshold of the config the model was exported with
+        self.meta = json.loads(extra_files["meta.json"])
+        self.aug = T.ResizeShortestEdge([self.meta["min_size"], self.meta["min_size"]], self.meta["max_size"])
+        self.input_format = self.meta["input_format"]
+
+    preprocess = BatchPredictor.preprocess
+
+    def predict(self, inputs):
+        """
+        Runs preprocessed inputs one by one (the traced graph takes a single image) and
+        returns one output dict per input, with masks pasted at the original tile size.
+        """
+        outputs = []
+        with torch.no_grad():
+            for model_input in inputs:
+                image = model_input["image"]
+                boxes, scores, classes, masks = self.model(image)
+                instances = Instances(tuple(image.shape[1:]))
+                instances.pred_boxes = Boxes(boxes)
+                instances.scores = scores
+                instances.pred_classes = classes
+                instances.pred_masks = masks
+                outputs.append({"instances": detector_postprocess(instances, model_input["height"],
+                                                                  model_input["width"])})
+        return outputs
+
+    def __call__(self, images):
+        if isinstance(images, list):
+            return self.predict(images)
+        return self.predict([self.preprocess(images)])[0]
+
+    def check_config(self, cfg):
+        """
+        Raises a ValueError if cfg asks for another score threshold than the one traced into
+        the graph, which would otherwise be ignored without notice.
+        """
+        if self.meta["score_thresh"] != cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST:
+            raise ValueError(f'The exported model was traced with score threshold {self.meta["score_thresh"]}, '
+                             f'but the config asks for {cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST}. '
+                             "Export the model again with that threshold.")
+
+
+def instances_from_prediction(prediction):
+    """
+    Rebuilds detectron2 Instances from a decoded cache entry (see prediction_cache).
+    """
+    masks = prediction["masks"]
+    instances = Instances(masks.shape[1:])
+    instances.pred_masks = torch.from_numpy(masks.copy())
+    instances.scores = torch.from_numpy(prediction["scores"].copy())
+    instances.pred_classes = torch.from_numpy(prediction["classes"].copy())
+    instances.pred_boxes = Boxes(torch.from_numpy(prediction["boxes"].copy()))
+    return instances
+
+
+class InferenceEngine:
+    """
+    Runs tiles through one or more BatchPredictor replicas with prefetching.
+
+    Parameters:
+    - cfg: The detectron2 config, as loaded with helpers.load_from_cloudpickle.
+    - batch_size: Number of tiles per forward pass.
+    - num_replicas: Number of model replicas running in parallel threads of this process.
+    - num_threads: torch intra-op threads (torch.set_num_threads). This is a process-wide
+      setting: the replicas share it rather than getting cores of their own, so the default
+      of cpu_count // num_replicas only keeps replicas running at the same time from
+      oversubscribing the cores.
+    - num_decode_workers: Threads that decode and preprocess upcoming tiles.
+    - prefetch_batches: Number of batches decoded ahead of the model.
+    - device: Device to run on, overrides cfg.MODEL.DEVICE.
+    - exported: Optional path of a model written by export.export_model, run on CPU instead of
+      the eager model of cfg. Its score threshold is fixed at export and must match
+      cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST.
+    """
+
+    def __init__(self, cfg, batch_size=4, num_replicas=1, num_threads=None, num_decode_workers=2,
+                 prefetch_batches=2, device="cpu", exported=None):
+        cfg = cfg.clone()
+        cfg.MODEL.DEVICE = device
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_replicas)
+        torch.set_num_threads(num_threads)
+
+        self.batch_size = batch_size
+        self.num_decode_workers = num_decode_workers
+        self.prefetch_batches = prefetch_batches
+        self.cfg = cfg
+        self.exported = exported
+        if exported:
+            self.replicas = [ExportedPredictor(exported) for _ in range(num_replicas)]
+            self.replicas[0].check_config(cfg)
+        else:
+            self.replicas = [BatchPredictor(cfg) for _ in range(num_replicas)]
+        self.outputs = {}
+        self.cache = None
+        self._fingerprint = None
+
+    def _load(self, item):
+        """
+        Decodes one (key, image) item; image may be a path or a BGR array.
+        Cached tiles come back as their stored prediction, the others preprocessed for the model.
+        """
+        key, image = item
+        if isinstance(image, str):
+            image = cv2.imread(image)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = tile_key(image, self._fingerprint)
+            prediction = self.cache.get(cache_key)
+            if prediction is not None:
+                return key, cache_key, instances_from_prediction(prediction)
+        return key, cache_key, self.replicas[0].preprocess(image)
+
+    def _produce(self, items, batches, results, stop):
+        """
+        Producer thread: decodes items batch by batch into a bounded queue.
+        Cache hits skip the model and go straight to the results.
+        Stops reading items once stop is set.
+        """
+        def submit(batch):
+            pending = []
+            for key, cache_key, loaded in decoder.map(self._load, batch):
+                if isinstance(loaded, Instances):
+                    results.put((key, loaded))
+                else:
+                    pending.append((key, cache_key, loaded))
+            if pending:
+                batches.put(pending)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_decode_workers) as decoder:
+                batch = []
+                for item in items:
+                    if stop.is_set():
+                        return
+                    batch.append(item)
+                    if len(batch) == self.batch_size:
+                        submit(batch)
+                        batch = []
+                if batch and not stop.is_set():
+                    submit(batch)
+        except Exception as e:
+            batches.put(e)
+        finally:
+            for _ in self.replicas:
+                batches.put(None)
+
+    def _consume(self, replica, batches, results, stop):
+        """
+        Replica thread: runs decoded batches through the model.
+        Once stop is set, the remaining batches are drained without running them.
+        """
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    results.put(batch)
+                    continue
+                if stop.is_set():
+                    continue
+                outputs = replica([inputs for _, _, inputs in batch])
+                for (key, cache_key, _), output in zip(batch, outputs):
+                    instances = output["instances"].to("cpu")
+                    if cache_key is not None:
+                        self.cache.put(cache_key, instances.pred_masks.numpy(), instances.scores.numpy(),
+                                       instances.pred_classes.numpy(), instances.pred_boxes.tensor.numpy())
+                    results.put((key, instances))
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    def run(self, items, keep_outputs=False, cache=None):
+        """
+        Runs inference over a stream of tiles.
+
+        Parameters:
+        - items: Iterable of (key, image) pairs, where image is a file path or a BGR array,
+          e.g. the (x, y, tile) stream of preprocess.iterate_tiles mapped to ((x, y), tile).
+        - keep_outputs: True to keep every output in self.outputs, or a collection of keys to
+          keep only those (e.g. the samples to visualize), so the model never runs twice.
+        - cache: Optional prediction_cache.PredictionCache. Tiles found in it are not run
+          through the model and new predictions are added to it.
+
+        Yields:
+        - (key, instances) pairs as batches finish. With several replicas the order may differ
+          from the input order.
+        """
+        self.cache = cache
+        if cache is not None and self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.cfg, self.exported)
+
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        results = queue.Queue()
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._produce, args=(items, batches, results, stop), daemon=True)]
+        threads += [threading.Thread(target=self._consume, args=(replica, batches, results, stop), daemon=True)
+                    for replica in self.replicas]
+        for thread in threads:
+            thread.start()
+
+        try:
+            finished = 0
+            while finished < len(self.replicas):
+                result = results.get()
+                if result is None:
+                    finished += 1
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+                key, instances = result
+                if keep_outputs is True or (keep_outputs and key in keep_outputs):
+                    self.outputs[key] = instances
+                yield key, instances
+        finally:
+            # Also reached when the caller closes the generator early (GeneratorExit) or on an error:
+            # the producer stops reading items and the replicas drain the queue without running it
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+def compare_throughput(cfg, image_paths, **engine_kwargs):
+    """
+    Measures tiles per second of the one-tile-at-a-time DefaultPredictor loop used in the
+    application notebook against the InferenceEngine on the same tiles.
+
+    Parameters:
+    - cfg: The detectron2 config.
+    - image_paths: Paths of the tiles to run.
+    - engine_kwargs: Arguments passed to InferenceEngine (batch_size, num_replicas, ...).
+
+    Returns:
+    - dict: Tiles per second for "default_predictor" and "engine".
+    """
+    device = engine_kwargs.get("device", "cpu")
+    baseline_cfg = cfg.clone()
+    baseline_cfg.MODEL.DEVICE = device
+    predictor = DefaultPredictor(baseline_cfg)
+    start = time.perf_counter()
+    for path in image_paths:
+        predictor(cv2.imread(path))
+    baseline = len(image_paths) / (time.perf_counter() - start)
+
+    engine = InferenceEngine(cfg, **engine_kwargs)
+    start = time.perf_counter()
+    for _ in engine.run([(path, path) for path in image_paths]):
+        pass
+    batched = len(image_paths) / (time.perf_counter() - start)
+
+    return {"default_predictor": baseline, "engine": batched}
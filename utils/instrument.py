@@ -0,0 +1,198 @@
+"""
+Lightweight per-stage instrumentation for the utils modules.
+Spans record wall time, CPU time, bytes read and written, item counts and resident memory
+(at the end of the span, its change over the span, and the process peak so far), and are
+exported as a JSON log and a Chrome trace (open in chrome://tracing or ui.perfetto.dev).
+
+Tracing is off by default and then costs one flag check per call. To switch it on for a
+single run without code changes, set an output prefix in the environment:
+    PONDS_TRACE=output/run1 jupyter nbconvert --execute ...
+which writes output/run1.json and output/run1.trace.json when the process exits.
+It can also be switched on from code with instrument.enable(prefix).
+"""
+
+import os, json, time, atexit, resource, threading, functools
+
+_enabled = False
+_output_prefix = None
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+_origin_ns = time.perf_counter_ns()
+
+
+def _io_counters():
+    """Bytes read and written by this process so far (Linux /proc/self/io), or zeros."""
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _rss_bytes():
+    """Current resident set size, or 0 where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class _Span:
+    """A timed region; created through span() or traced() only while tracing is enabled."""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.items = 0
+
+    def add_items(self, count):
+        self.items += count
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self._read, self._written = _io_counters()
+        self._rss = _rss_bytes()
+        self._children_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._cpu = time.process_time()
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        cpu = time.process_time() - self._cpu
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read, written = _io_counters()
+        rss = _rss_bytes()
+        _local.stack.pop()
+        event = {
+            "name": self.name,
+            "start_s": (self._start - _origin_ns) / 1e9,
+            "wall_s": (end - self._start) / 1e9,
+            "cpu_s": cpu,
+            "children_cpu_s": (children.ru_utime + children.ru_stime)
+                              - (self._children_cpu.ru_utime + self._children_cpu.ru_stime),
+            "bytes_read": read - self._read,
+            "bytes_written": written - self._written,
+            "items": self.items,
+            "rss_bytes": rss,
+            "rss_delta_bytes": rss - self._rss,
+            # ru_maxrss is the peak of the whole process so far (in kilobytes on Linux), not of
+            # this span: every span after the largest one reports the same value
+            "process_peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "error": exc_type.__name__ if exc_type else None,
+            "args": self.args,
+        }
+        with _lock:
+            _events.append(event)
+        return False
+
+
+class _NoopSpan:
+    """Shared stand-in returned while tracing is disabled."""
+
+    def add_items(self, count):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name, **args):
+    """Context manager timing a block: `with instrument.span("mosaic.merge", tiles=n): ...`."""
+    if not _enabled:
+        return _NOOP
+    return _Span(name, args)
+
+
+def traced(name=None):
+    """Decorator recording a span for every call of the function."""
+    def decorator(func):
+        span_name = name or f"{func.__module__.split('.')[-1]}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_items(count):
+    """Add to the item count of the innermost open span (no-op when disabled)."""
+    if _enabled:
+        stack = getattr(_local, "stack", None)
+        if stack:
+            stack[-1].add_items(count)
+
+
+def enable(output_prefix=None):
+    """Start recording spans; with an output prefix the trace is written at exit."""
+    global _enabled, _output_prefix
+    _enabled = True
+    if output_prefix and _output_prefix is None:
+        atexit.register(write_trace)
+    _output_prefix = output_prefix or _output_prefix
+
+
+def disable():
+    """Stop recording spans. Already recorded spans are kept."""
+    global _enabled
+    _enabled = False
+
+
+def events():
+    """Return a copy of the recorded spans."""
+    with _lock:
+        return list(_events)
+
+
+def write_trace(output_prefix=None):
+    """
+    Write the recorded spans to <prefix>.json and a Chrome trace to <prefix>.trace.json.
+
+    Returns:
+    - The two paths, or None if there is nothing to write.
+    """
+    output_prefix = output_prefix or _output_prefix
+    recorded = events()
+    if not output_prefix or not recorded:
+        return None
+    folder = os.path.dirname(output_prefix)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    log_path = output_prefix + ".json"
+    with open(log_path, "w") as f:
+        json.dump(recorded, f, indent=2)
+
+    trace = {"traceEvents": [{
+        "name": event["name"], "cat": event["name"].split(".")[0], "ph": "X",
+        "ts": event["start_s"] * 1e6, "dur": event["wall_s"] * 1e6,
+        "pid": event["pid"], "tid": event["tid"],
+        "args": {key: value for key, value in event.items()
+                 if key not in ("name", "start_s", "wall_s", "pid", "tid")},
+    } for event in recorded], "displayTimeUnit": "ms"}
+    trace_path = output_prefix + ".trace.json"
+    with open(trace_path, "w") as f:
+        json.dump(trace, f)
+    return log_path, trace_path
+
+
+if os.environ.get("PONDS_TRACE"):
+    enable(os.environ["PONDS_TRACE"])
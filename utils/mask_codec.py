@@ -0,0 +1,156 @@
+"""
+Compact binary mask representation shared by the prediction cache, the tile store and mosaic merging.
+Masks are bit-packed along their rows (8 pixels per byte, np.packbits on the last axis) and
+zlib-compressed for storage. Because every row starts on a byte boundary, packed masks can be
+ORed into a packed canvas byte by byte, so merging never expands a tile to one byte per pixel.
+"""
+
+import zlib
+import numpy as np
+
+# Number of set bits of every byte value
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def packed_width(width):
+    """Number of bytes holding one packed row of width pixels."""
+    return (width + 7) // 8
+
+
+def pack_mask(mask):
+    """
+    Bit-packs a binary mask (or a stack of masks) along its rows.
+
+    Parameters:
+    - mask: Array of shape (..., height, width); nonzero pixels are set.
+
+    Returns:
+    - A uint8 array of shape (..., height, ceil(width / 8)).
+    """
+    return np.packbits(np.asarray(mask, dtype=bool), axis=-1)
+
+
+def unpack_mask(packed, width):
+    """
+    Restores masks packed with pack_mask as uint8 arrays of 0 and 1.
+    """
+    return np.unpackbits(packed, axis=-1, count=width)
+
+
+def union_masks(masks):
+    """
+    ORs a stack of instance masks into one packed mask without a per-instance loop.
+
+    Parameters:
+    - masks: Array of shape (num_instances, height, width), e.g. pred_masks of one tile.
+
+    Returns:
+    - The packed (height, ceil(width / 8)) union; all zeros when there are no instances.
+    """
+    return np.bitwise_or.reduce(pack_mask(masks), axis=0)
+
+
+def compress_mask(mask):
+    """
+    Packs and zlib-compresses a mask (or a stack of masks) to bytes.
+    """
+    return zlib.compress(np.ascontiguousarray(pack_mask(mask)).tobytes(), 1)
+
+
+def decompress_packed(blob, shape):
+    """
+    Inflates bytes from compress_mask to the packed array, still 8 pixels per byte.
+
+    Parameters:
+    - blob: The compressed bytes.
+    - shape: Shape of the original (unpacked) mask, e.g. (height, width) or (num, height, width).
+    """
+    packed_shape = (*shape[:-1], packed_width(shape[-1]))
+    return np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(packed_shape)
+
+
+def decompress_mask(blob, shape):
+    """
+    Restores a mask compressed with compress_mask as a uint8 array of 0 and 1.
+    """
+    return unpack_mask(decompress_packed(blob, shape), shape[-1])
+
+
+def or_packed(canvas, packed, x, y):
+    """
+    ORs a packed mask into a packed canvas at pixel offset (x, y), clipping at the canvas edge.
+    Offsets that are not a multiple of 8 are handled by shifting the packed bytes.
+
+    Parameters:
+    - canvas: Packed (height, ceil(width / 8)) uint8 array, modified in place.
+    - packed: Packed mask as returned by pack_mask.
+    - x, y: Top left corner of the mask on the canvas, in pixels.
+    """
+    shift = x % 8
+    if shift:
+        shifted = np.zeros((packed.shape[0], packed.shape[1] + 1), dtype=np.uint8)
+        shifted[:, :-1] = packed >> shift
+        shifted[:, 1:] |= packed << np.uint8(8 - shift)
+        packed = shifted
+    column = x // 8
+    window = canvas[y:y + packed.shape[0], column:column + packed.shape[1]]
+    window |= packed[:window.shape[0], :window.shape[1]]
+
+
+class PackedMask:
+    """
+    A (height, width) binary mask held 8 pixels per byte.
+    Row slices are unpacked on access (mask[start:stop] gives uint8 rows of 0 and 1), so it
+    can be passed wherever a merged canvas is read in row chunks, e.g. to
+    mosaic.save_merged_image_chunked or georeference.write_georeferenced_mask.
+
+    Parameters:
+    - packed: Packed (height, ceil(width / 8)) uint8 array, possibly memory-mapped.
+    - width: Width of the mask in pixels.
+    """
+
+    def __init__(self, packed, width):
+        self.packed = packed
+        self.width = width
+
+    @classmethod
+    def create(cls, canvas_size, canvas_path=None):
+        """
+        Creates an empty packed canvas of (width, height) pixels, in memory or backed by a .npy file.
+        """
+        canvas_width, canvas_height = canvas_size
+        shape = (canvas_height, packed_width(canvas_width))
+        if canvas_path is None:
+            return cls(np.zeros(shape, dtype=np.uint8), canvas_width)
+        return cls(np.lib.format.open_memmap(canvas_path, mode="w+", dtype=np.uint8, shape=shape), canvas_width)
+
+    @property
+    def shape(self):
+        return self.packed.shape[0], self.width
+
+    def __getitem__(self, rows):
+        return unpack_mask(self.packed[rows], self.width)
+
+    def __array__(self, dtype=None, copy=None):
+        array = unpack_mask(self.packed, self.width)
+        return array if dtype is None else array.astype(dtype)
+
+    def or_tile(self, packed, x, y):
+        """ORs a packed tile into the mask at pixel offset (x, y)."""
+        or_packed(self.packed, packed, x, y)
+
+    def count_nonzero(self, chunk_rows=4096):
+        """Number of set pixels, counted on the packed bytes."""
+        # Bits past the right edge can be set by tiles that overhang it
+        tail_bits = self.width % 8
+        tail_mask = np.uint8((0xFF << (8 - tail_bits)) & 0xFF) if tail_bits else np.uint8(0xFF)
+        total = 0
+        for start in range(0, self.packed.shape[0], chunk_rows):
+            chunk = np.array(self.packed[start:start + chunk_rows])
+            chunk[:, -1] &= tail_mask
+            total += int(_POPCOUNT[chunk].sum(dtype=np.int64))
+        return total
+
+    def flush(self):
+        if isinstance(self.packed, np.memmap):
+            self.packed.flush()
@@ -0,0 +1,375 @@
+"""
+Multi-date monitoring of a region: incremental processing of a new acquisition.
+Every date is processed on the tile grid of the first run. The new scene is registered to
+that grid (from the geotransforms, or by phase correlation of overviews), and each tile gets
+a cheap signature (a 64x64 thumbnail). Tiles whose signature differs from the previous date
+by more than a brightness/contrast change are run through the model. The others reuse the
+previous date's masks, copied from its tile store without decoding, and keep the signature
+of the date those masks were inferred on. The ponds are
+vectorized (vector_mosaic) and matched with the previous date's ponds to give per-pond
+change records (new, vanished, grown, shrunk, unchanged).
+
+A run folder holds grid.json, signatures.npz, masks.tiles, ponds.npz, area_estimate.csv and,
+from the second date on, changes.csv and summary.json.
+
+Usage:
+    python -m utils.monitor --image data/2023_kharif.tif --run output/monitor/2023_kharif --best output/performance/best_performance.txt
+    python -m utils.monitor --image data/2024_rabi.tif --run output/monitor/2024_rabi --previous output/monitor/2023_kharif \\
+        --best output/performance/best_performance.txt
+"""
+
+import os, sys, json, time, argparse
+import cv2
+import numpy as np
+import pandas as pd
+import shapely
+from utils import instrument
+from utils import mosaic as mosc
+
+SIGNATURE_SIZE = 64
+
+
+def tile_signature(tile, size=SIGNATURE_SIZE):
+    """
+    Thumbnail of a BGR tile (block means), the signature compared across dates.
+    """
+    return cv2.resize(tile.astype(np.float32), (size, size), interpolation=cv2.INTER_AREA).astype(np.float16)
+
+
+def _fit_residual(source, target):
+    """Per-pixel difference left after fitting target = gain * source + offset per tile and band."""
+    source = source - source.mean(axis=(1, 2), keepdims=True)
+    target = target - target.mean(axis=(1, 2), keepdims=True)
+    gain = (source * target).sum(axis=(1, 2), keepdims=True) / np.maximum((source ** 2).sum(axis=(1, 2),
+                                                                                           keepdims=True), 1e-6)
+    return np.abs(target - gain * source).mean(axis=-1)
+
+
+def change_scores(previous, current):
+    """
+    How much each tile changed between two dates, in grey levels.
+    A brightness and contrast change of the whole tile (season, sun, sensor) is fitted per
+    band and removed first. The fit goes both ways, since a pond that disappears from an
+    otherwise flat tile is absorbed by a near-zero gain in one direction. The score is the
+    largest remaining difference over 2x2 thumbnail blocks, so a change has to cover about
+    a pond's area to count.
+
+    Parameters:
+    - previous, current: (num_tiles, size, size, bands) signatures of the same tiles.
+
+    Returns:
+    - A score per tile.
+    """
+    previous = np.asarray(previous, dtype=np.float32)
+    current = np.asarray(current, dtype=np.float32)
+    residual = np.maximum(_fit_residual(previous, current), _fit_residual(current, previous))
+    pooled = (residual[:, :-1, :-1] + residual[:, 1:, :-1] + residual[:, :-1, 1:] + residual[:, 1:, 1:]) / 4
+    return pooled.max(axis=(1, 2))
+
+
+def phase_offset(previous_overview, current_overview, factor):
+    """
+    Translation between two overviews of the same region by phase correlation.
+
+    Returns:
+    - (dx, dy) in full-resolution pixels: grid pixel (x, y) is pixel (x + dx, y + dy) of the current scene.
+    """
+    height = min(previous_overview.shape[0], current_overview.shape[0])
+    width = min(previous_overview.shape[1], current_overview.shape[1])
+    previous_overview = np.float32(previous_overview[:height, :width])
+    current_overview = np.float32(current_overview[:height, :width])
+    window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+    (shift_x, shift_y), _ = cv2.phaseCorrelate(previous_overview, current_overview, window)
+    return int(round(shift_x * factor)), int(round(shift_y * factor))
+
+
+def _grey(array):
+    """Mean of the first three bands of a (bands, height, width) read."""
+    return array[:3].mean(axis=0) if array.ndim == 3 else array
+
+
+def _open(image_path):
+    from osgeo import gdal
+    dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Unable to open input image: {image_path}")
+    return dataset
+
+
+def register_scene(grid, image_path, geotransform=None, factor=16, window=1024):
+    """
+    Offset of a new scene on the grid of the first run.
+    From the geotransforms when both scenes are georeferenced; otherwise by phase correlation
+    of overviews of the two scenes, refined at full resolution on a window in the middle.
+
+    Parameters:
+    - grid: grid.json of the previous run.
+    - image_path: The new scene.
+    - geotransform: Geotransform of the new scene, if it is georeferenced.
+    - factor: Overview reduction for the coarse phase correlation.
+    - window: Size of the full-resolution window for the refinement.
+
+    Returns:
+    - (dx, dy): grid pixel (x, y) is pixel (x + dx, y + dy) of the new scene.
+    """
+    from utils import preprocess as prep
+    grid_geotransform = grid["geotransform"]
+    if geotransform is not None and grid_geotransform is not None:
+        if not np.isclose(geotransform[1], grid_geotransform[1], rtol=0.01) or \
+                not np.isclose(geotransform[5], grid_geotransform[5], rtol=0.01):
+            raise ValueError(f"{image_path} has a different pixel size than the previous run; resample it first.")
+        return (int(round((grid_geotransform[0] - geotransform[0]) / grid_geotransform[1])),
+                int(round((grid_geotransform[3] - geotransform[3]) / grid_geotransform[5])))
+
+    reference, scene = _open(grid["image"]), _open(image_path)
+    overviews = [_grey(dataset.ReadAsArray(buf_xsize=max(1, dataset.RasterXSize // factor),
+                                           buf_ysize=max(1, dataset.RasterYSize // factor)))
+                 for dataset in (reference, scene)]
+    dx, dy = phase_offset(overviews[0], overviews[1], factor)
+    x, y = max((grid["width"] - window) // 2, 0), max((grid["height"] - window) // 2, 0)
+    windows = [prep.read_tile_window(reference, x, y, window, window),
+               prep.read_tile_window(scene, x + dx, y + dy, window, window)]
+    fine_x, fine_y = phase_offset(*[_grey(np.moveaxis(tile, -1, 0)) for tile in windows], 1)
+    return dx + fine_x, dy + fine_y
+
+
+def _read_grid_tiles(image_path, grid, offset, positions=None, min_nonzero_fraction=0.01):
+    """
+    Reads the tiles of the grid from a scene registered at offset.
+
+    Yields:
+    - (x, y, tile) with (x, y) on the grid and the tile as read by preprocess.read_tile_window.
+    """
+    from utils import preprocess as prep
+    dataset = _open(image_path)
+    tile_size = grid["tile_size"]
+    if positions is None:
+        positions = prep.tile_offsets(grid["width"], grid["height"], tile_size, tile_size, grid["stride"])
+    for x, y in positions:
+        tile = prep.read_tile_window(dataset, x + offset[0], y + offset[1], tile_size, tile_size)
+        if not prep.is_blank_tile(tile, min_nonzero_fraction):
+            yield x, y, tile
+
+
+def _load_signatures(run_dir):
+    with np.load(os.path.join(run_dir, "signatures.npz")) as archive:
+        return {(int(x), int(y)): signature
+                for x, y, signature in zip(archive["x"], archive["y"], archive["signatures"])}
+
+
+@instrument.traced()
+def match_ponds(previous, current, min_iou=0.3, area_tolerance=0.1):
+    """
+    Matches the ponds of two dates one to one by outline overlap (best IoU first).
+
+    Parameters:
+    - previous, current: pond_store.PondStore of the two dates, in the same coordinates.
+    - min_iou: Outlines overlapping less than this are different ponds.
+    - area_tolerance: Relative area change below which a matched pond is "unchanged".
+
+    Returns:
+    - A DataFrame with one row per pond of either date: status (new, vanished, grown, shrunk,
+      unchanged), label and previous_label, area and previous_area (Real_area), area_change,
+      area_change_fraction, iou and the pond center.
+    """
+    current_indices, previous_indices = previous.tree.query(current.geometries, predicate="intersects")
+    intersection = shapely.area(shapely.intersection(current.geometries[current_indices],
+                                                     previous.geometries[previous_indices]))
+    union = shapely.area(current.geometries[current_indices]) + shapely.area(previous.geometries[previous_indices]) \
+        - intersection
+    iou = intersection / np.maximum(union, 1e-12)
+
+    matched_current = np.full(len(current), -1)
+    matched_iou = np.zeros(len(current))
+    used = np.zeros(len(previous), dtype=bool)
+    for k in np.argsort(-iou, kind="stable"):
+        if iou[k] < min_iou:
+            break
+        c, p = current_indices[k], previous_indices[k]
+        if matched_current[c] < 0 and not used[p]:
+            matched_current[c], matched_iou[c], used[p] = p, iou[k], True
+
+    area = current.columns["Real_area"]
+    previous_area = previous.columns["Real_area"]
+    # Unmatched ponds (-1) pick the appended placeholder
+    current_rows = pd.DataFrame({
+        "label": current.columns["Label"],
+        "previous_label": np.append(previous.columns["Label"], -1)[matched_current],
+        "area": area,
+        "previous_area": np.append(previous_area, 0.0)[matched_current],
+        "iou": matched_iou,
+        "center_lat": current.columns["Center_lat"], "center_long": current.columns["Center_long"],
+    })
+    vanished = ~used
+    vanished_rows = pd.DataFrame({
+        "label": -1, "previous_label": previous.columns["Label"][vanished], "area": 0.0,
+        "previous_area": previous_area[vanished], "iou": 0.0,
+        "center_lat": previous.columns["Center_lat"][vanished], "center_long": previous.columns["Center_long"][vanished],
+    })
+    records = pd.concat([current_rows, vanished_rows], ignore_index=True)
+    records["area_change"] = records["area"] - records["previous_area"]
+    records["area_change_fraction"] = records["area_change"] / records["previous_area"].where(records["previous_area"] > 0)
+    status = np.select([records["previous_label"] < 0, records["label"] < 0,
+                        records["area_change_fraction"] > area_tolerance,
+                        records["area_change_fraction"] < -area_tolerance],
+                       ["new", "vanished", "grown", "shrunk"], "unchanged")
+    records.insert(0, "status", status)
+    return records
+
+
+@instrument.traced()
+def process_date(image_path, run_dir, engine, previous_run=None, tile_size=1024, stride=0.25, bounds=None,
+                 offset=None, change_threshold=15.0, min_pond_size=2400, cache=None):
+    """
+    Processes one acquisition, reusing the previous date's detections on unchanged tiles.
+
+    Parameters:
+    - image_path: The new scene.
+    - run_dir: Folder for this date's outputs.
+    - engine: inference.InferenceEngine used for the changed tiles.
+    - previous_run: Run folder of the previous date, or None for the first date (every tile is inferred).
+    - tile_size, stride: Tile grid of the first date; later dates take it from previous_run.
+    - bounds: NW and SE corners of the scene if it is not georeferenced (see pipeline.scene_geotransform).
+    - offset: Optional (dx, dy) of the scene on the grid, instead of registering it.
+    - change_threshold: Change score (see change_scores) above which a tile is run again.
+    - min_pond_size: Minimum object size kept in the tile masks (see mosaic.clean_mask).
+    - cache: Optional prediction_cache.PredictionCache passed to the engine.
+
+    Returns:
+    - dict: The run summary, also written to summary.json.
+    """
+    from utils import preprocess as prep
+    from utils import vector_mosaic as vmosc
+    from utils.pipeline import raster_size, scene_geotransform
+    from utils.pond_store import PondStore
+
+    os.makedirs(run_dir, exist_ok=True)
+    geotransform = scene_geotransform(image_path, bounds)
+    if previous_run is None:
+        width, height = raster_size(image_path)
+        grid = {"image": os.path.abspath(image_path), "width": width, "height": height, "tile_size": tile_size,
+                "stride": stride, "geotransform": geotransform}
+        offset = (0, 0)
+        previous_signatures = {}
+    else:
+        with open(os.path.join(previous_run, "grid.json")) as file:
+            grid = json.load(file)
+        if offset is None:
+            offset = register_scene(grid, image_path, geotransform)
+        previous_signatures = _load_signatures(previous_run)
+    print(f"{image_path} registered at offset {tuple(offset)} on the grid.")
+
+    # Signatures of every tile, and the tiles that changed since the previous date
+    start = time.perf_counter()
+    positions, signatures = [], []
+    for x, y, tile in _read_grid_tiles(image_path, grid, offset):
+        positions.append((x, y))
+        signatures.append(tile_signature(prep.to_bgr(tile)))
+    signatures = np.array(signatures, dtype=np.float16).reshape(-1, SIGNATURE_SIZE, SIGNATURE_SIZE, 3)
+    changed = np.ones(len(positions), dtype=bool)
+    known = np.array([position in previous_signatures for position in positions], dtype=bool)
+    if known.any():
+        previous = np.array([previous_signatures[position] for position, k in zip(positions, known) if k])
+        changed[known] = change_scores(previous, signatures[known]) > change_threshold
+        # Reused tiles keep the signature of the date their masks were inferred on, so that
+        # slow drift over several dates adds up until the tile is run again
+        reused_signatures = signatures[known].copy()
+        reused_signatures[~changed[known]] = previous[~changed[known]]
+        signatures[known] = reused_signatures
+    np.savez(os.path.join(run_dir, "signatures.npz"), x=np.array([x for x, _ in positions], dtype=np.int64),
+             y=np.array([y for _, y in positions], dtype=np.int64), signatures=signatures)
+    signature_seconds = time.perf_counter() - start
+
+    # Masks: copied from the previous tile store for unchanged tiles, inferred for the others
+    changed_positions = [position for position, c in zip(positions, changed) if c]
+    reused = set(position for position, c in zip(positions, changed) if not c)
+    start = time.perf_counter()
+
+    def records():
+        if reused:
+            for record in mosc.iterate_tile_store_records(os.path.join(previous_run, "masks.tiles")):
+                if record[:2] in reused:
+                    yield record
+        items = (((x, y), prep.to_bgr(tile)) for x, y, tile in
+                 _read_grid_tiles(image_path, grid, offset, changed_positions, min_nonzero_fraction=0))
+        for (x, y), instances in engine.run(items, cache=cache):
+            yield mosc.pack_prediction(x, y, instances.pred_masks.numpy(), min_pond_size)
+
+    store_path = os.path.join(run_dir, "masks.tiles")
+    mosc.write_tile_store(records(), store_path)
+    inference_seconds = time.perf_counter() - start
+
+    # Ponds in the grid's coordinates, so every date lines up
+    start = time.perf_counter()
+    grid_geotransform = grid["geotransform"] or (0, 1, 0, 0, 0, 1)
+    ponds = vmosc.polygons_to_store(vmosc.vectorize_tile_store(store_path), grid_geotransform)
+    ponds.save(os.path.join(run_dir, "ponds.npz"))
+    ponds.to_dataframe().to_csv(os.path.join(run_dir, "area_estimate.csv"), index=False)
+    vectorize_seconds = time.perf_counter() - start
+
+    with open(os.path.join(run_dir, "grid.json"), "w") as file:
+        json.dump(grid, file, indent=4)
+
+    summary = {"image": os.path.abspath(image_path), "previous_run": previous_run, "offset": list(offset),
+               "tiles": len(positions), "tiles_inferred": len(changed_positions), "tiles_reused": len(reused),
+               "ponds": len(ponds), "signature_seconds": signature_seconds,
+               "inference_seconds": inference_seconds, "vectorize_seconds": vectorize_seconds}
+    if previous_run is not None:
+        changes = match_ponds(PondStore.load(os.path.join(previous_run, "ponds.npz")), ponds)
+        changes.to_csv(os.path.join(run_dir, "changes.csv"), index=False)
+        summary["changes"] = changes["status"].value_counts().to_dict()
+        summary["area_change"] = float(changes["area_change"].sum())
+    with open(os.path.join(run_dir, "summary.json"), "w") as file:
+        json.dump(summary, file, indent=4)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a new acquisition of a monitored region incrementally.")
+    parser.add_argument("--image", required=True, help="scene of this date")
+    parser.add_argument("--run", required=True, help="output folder for this date")
+    parser.add_argument("--previous", help="output folder of the previous date; omit for the first date")
+    parser.add_argument("--best", help="best_performance.txt with the model path and config path")
+    parser.add_argument("--weights", help="trained model (.pth), instead of --best")
+    parser.add_argument("--config", help="model config (.pkl), instead of --best")
+    parser.add_argument("--exported", help="TorchScript model from utils.export to run instead of the eager model; "
+                        "it must have been exported with the same --score-thresh")
+    parser.add_argument("--bounds", type=float, nargs=4, metavar=("TOP_LEFT_X", "TOP_LEFT_Y", "BOTTOM_RIGHT_X",
+                                                                  "BOTTOM_RIGHT_Y"),
+                        help="NW and SE corners (longitude, latitude); default: the scene's geotransform")
+    parser.add_argument("--offset", type=int, nargs=2, metavar=("DX", "DY"),
+                        help="position of the grid in the new scene, instead of registering it")
+    parser.add_argument("--tile-size", type=int, default=1024, help="first date only")
+    parser.add_argument("--stride", type=float, default=0.25,
+                        help="step between tiles as a fraction of --tile-size; first date only")
+    parser.add_argument("--change-threshold", type=float, default=15.0,
+                        help="change score (grey levels) above which a tile is run again")
+    parser.add_argument("--score-thresh", type=float, default=0.7)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args(argv)
+
+    if not 0 < args.stride <= 1:
+        parser.error(f"--stride is a fraction of the tile size in (0, 1], got {args.stride}")
+
+    from utils import helpers as hp
+    from utils.inference import InferenceEngine
+    if args.best:
+        args.weights, args.config = hp.read_paths_from_file(args.best)[:2]
+    if not (args.weights and args.config):
+        parser.error("pass --best or both --weights and --config")
+    cfg = hp.load_from_cloudpickle(args.config)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh
+    engine = InferenceEngine(cfg, batch_size=args.batch_size, num_replicas=args.replicas, device=args.device,
+                             exported=args.exported)
+
+    summary = process_date(args.image, args.run, engine, args.previous, args.tile_size, args.stride, args.bounds,
+                           args.offset, args.change_threshold)
+    print(json.dumps(summary, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
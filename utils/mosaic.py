@@ -1,8 +1,14 @@
 import os
 import shutil
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import numpy as np
 from skimage import io, color, morphology, segmentation
+from utils import instrument
+from utils import mask_codec
 
 
 def process_image(input_path, threshold=0.5, min_object_size=2400):
@@ -29,6 +35,19 @@ def process_image(input_path, threshold=0.5, min_object_size=2400):
     # Convert the image to binary
     binary_image = image > threshold
 
+    return clean_mask(binary_image, min_object_size)
+
+def clean_mask(binary_image, min_object_size=2400):
+    """
+    Clears the border and removes small objects from a binary mask.
+
+    Parameters:
+    - binary_image: Boolean NumPy array of a tile mask.
+    - min_object_size: Minimum size of objects to retain in the image.
+
+    Returns:
+    - cleared_image: The cleaned binary mask.
+    """
     # Remove objects touching the border
     cleared_image = segmentation.clear_border(binary_image)
 
@@ -48,6 +67,7 @@ def save_processed_image(image, output_path):
     # Convert boolean array to uint8 and save as .npy file
     np.save(output_path, image.astype(np.uint8))
 
+@instrument.traced()
 def process_directory(input_folder_path, output_folder_path):
     """
     Processes all images in a directory and saves the processed images to another directory.
@@ -62,6 +82,7 @@ def process_directory(input_folder_path, output_folder_path):
     # List all PNG images in the input directory
     image_files = [f for f in os.listdir(input_folder_path) if f.lower().endswith('.png')]
 
+    instrument.add_items(len(image_files))
     # Process each image
     for image_file in image_files:
         input_image_path = os.path.join(input_folder_path, image_file)
@@ -92,7 +113,26 @@ def load_and_sort_filenames(directory):
     
     return sorted(os.listdir(directory), key=custom_sort)
 
-def merge_tiles(filenames, input_dir, canvas_size):
+def create_canvas(canvas_size, canvas_path=None):
+    """
+    Creates an empty uint8 canvas for merging tiles.
+    
+    Parameters:
+    - canvas_size: Tuple of (width, height) for the canvas size.
+    - canvas_path: Optional path of a .npy file to back the canvas. The canvas is then a
+      memory-mapped array, so only the blocks being merged are held in RAM.
+    
+    Returns:
+    - A NumPy array (or np.memmap) of shape (height, width).
+    """
+    canvas_width, canvas_height = canvas_size
+    if canvas_path is None:
+        return np.zeros((canvas_height, canvas_width), dtype=np.uint8)
+    # open_memmap creates a sparse file, so untouched blocks cost neither RAM nor write time
+    return np.lib.format.open_memmap(canvas_path, mode="w+", dtype=np.uint8, shape=(canvas_height, canvas_width))
+
+@instrument.traced()
+def merge_tiles(filenames, input_dir, canvas_size, canvas_path=None):
     """
     Merges tiles into a single large array based on their filenames.
     
@@ -100,14 +140,15 @@ def merge_tiles(filenames, input_dir, canvas_size):
     - filenames: A list of sorted filenames.
     - input_dir: Directory containing the npy files.
     - canvas_size: Tuple of (width, height) for the canvas size.
+    - canvas_path: Optional .npy path for a memory-mapped canvas (see create_canvas).
     
     Returns:
     - The merged array and a list of filenames that failed to merge.
     """
-    canvas_width, canvas_height = canvas_size
-    merged_array = np.zeros((canvas_height, canvas_width), dtype=np.uint8)
+    merged_array = create_canvas(canvas_size, canvas_path)
     failed_list = []
 
+    instrument.add_items(len(filenames))
     for filename in filenames:
         if filename.endswith(".npy"):
             tile = np.load(os.path.join(input_dir, filename))
@@ -125,8 +166,373 @@ def merge_tiles(filenames, input_dir, canvas_size):
             else: 
                 failed_list.append(filename)
     
+    if isinstance(merged_array, np.memmap):
+        merged_array.flush()
     return merged_array, failed_list
 
+@instrument.traced()
+def merge_tile_stream(tiles, canvas_size, min_object_size=2400, canvas_path=None):
+    """
+    Merges masks arriving in memory, e.g. straight from the predictor, into a single array.
+    This replaces the process_directory -> load_and_sort_filenames -> merge_tiles round trip.
+    Tiles that run past the canvas edge are clipped instead of being rejected.
+    
+    Parameters:
+    - tiles: Iterable of (x, y, mask) tuples, where (x, y) is the top left corner of the tile.
+    - canvas_size: Tuple of (width, height) for the canvas size.
+    - min_object_size: Minimum size of objects to retain in each tile, as in process_image.
+    - canvas_path: Optional .npy path for a memory-mapped canvas (see create_canvas).
+    
+    Returns:
+    - The merged array and a list of (x, y) offsets that fell outside the canvas.
+    """
+    canvas_width, canvas_height = canvas_size
+    merged_array = create_canvas(canvas_size, canvas_path)
+    failed_list = []
+
+    for x, y, mask in tiles:
+        if x >= canvas_width or y >= canvas_height:
+            failed_list.append((x, y))
+            continue
+        tile = clean_mask(np.asarray(mask) > 0, min_object_size)
+        window = merged_array[y:y + tile.shape[0], x:x + tile.shape[1]]
+        window |= tile[:window.shape[0], :window.shape[1]].astype(np.uint8)
+
+    if isinstance(merged_array, np.memmap):
+        merged_array.flush()
+    return merged_array, failed_list
+
+# chunked tile store
+
+TILE_STORE_MAGIC = b"PONDTILES2"
+TILE_STORE_INDEX_DTYPE = np.dtype([("x", "<i8"), ("y", "<i8"), ("height", "<i4"), ("width", "<i4"),
+                                   ("offset", "<i8"), ("length", "<i8")])
+
+def parse_tile_offset(filename):
+    """
+    Returns the (x, y) offset encoded in a tile_{x}_{y} filename.
+    """
+    x, y = map(int, os.path.splitext(os.path.basename(filename))[0].split("_")[1:])
+    return x, y
+
+def pack_tile(tile):
+    """
+    Compresses a binary tile to row-wise bit-packed, zlib-compressed bytes (see mask_codec).
+    """
+    return mask_codec.compress_mask(tile)
+
+def unpack_tile(blob, height, width):
+    """
+    Restores a tile compressed with pack_tile as a uint8 array of 0 and 1.
+    """
+    return mask_codec.decompress_mask(blob, (height, width))
+
+def pack_prediction(x, y, masks, min_object_size=2400):
+    """
+    Turns the instance masks predicted for one tile into a tile store record, the same
+    tile that process_image produces from the mask PNG, without writing the PNG.
+    The instances are ORed bit-packed, so there is no loop over instances.
+    
+    Parameters:
+    - x, y: Top left corner of the tile in the scene.
+    - masks: Array of shape (num_instances, height, width), e.g. pred_masks from the predictor.
+    - min_object_size: Minimum size of objects to retain (see clean_mask).
+    
+    Returns:
+    - An (x, y, height, width, packed_bytes) record for write_tile_store.
+    """
+    masks = np.asarray(masks)
+    height, width = masks.shape[-2:]
+    union = mask_codec.unpack_mask(mask_codec.union_masks(masks), width).astype(bool)
+    return x, y, height, width, pack_tile(clean_mask(union, min_object_size))
+
+def _process_and_pack(input_path):
+    """
+    Worker task: processes one mask tile and returns its index fields and packed bytes.
+    """
+    cleared_image = process_image(input_path)
+    x, y = parse_tile_offset(input_path)
+    return x, y, cleared_image.shape[0], cleared_image.shape[1], pack_tile(cleared_image)
+
+def write_tile_store(records, store_path):
+    """
+    Writes packed tiles into a single container file.
+    The file holds the compressed tiles back to back, followed by an index of the tile
+    offsets and a footer pointing to the index, so the offsets never have to be parsed
+    from filenames again.
+    
+    Parameters:
+    - records: Iterable of (x, y, height, width, packed_bytes) tuples.
+    - store_path: Path of the container file.
+    
+    Returns:
+    - The number of tiles written.
+    """
+    index = []
+    with open(store_path, "wb") as file:
+        file.write(TILE_STORE_MAGIC)
+        for x, y, height, width, blob in records:
+            index.append((x, y, height, width, file.tell(), len(blob)))
+            file.write(blob)
+        index_offset = file.tell()
+        np.save(file, np.array(index, dtype=TILE_STORE_INDEX_DTYPE))
+        file.write(struct.pack("<q", index_offset))
+    return len(index)
+
+def read_tile_store_index(store_path):
+    """
+    Reads the tile index of a container written by write_tile_store.
+    
+    Returns:
+    - A structured NumPy array with the fields x, y, height, width, offset and length.
+    """
+    with open(store_path, "rb") as file:
+        if file.read(len(TILE_STORE_MAGIC)) != TILE_STORE_MAGIC:
+            raise ValueError(f"Not a tile store: {store_path}")
+        file.seek(-8, os.SEEK_END)
+        index_offset, = struct.unpack("<q", file.read(8))
+        file.seek(index_offset)
+        return np.load(file)
+
+def iterate_tile_store_records(store_path, buffer_size=64 * 1024 * 1024):
+    """
+    Reads every tile of a container sequentially, in file order, without decompressing it.
+    The records can be written to another container as they are (see write_tile_store).
+    
+    Yields:
+    - (x, y, height, width, packed_bytes) tuples.
+    """
+    index = read_tile_store_index(store_path)
+    with open(store_path, "rb", buffering=buffer_size) as file:
+        for entry in np.sort(index, order="offset"):
+            file.seek(entry["offset"])
+            yield (int(entry["x"]), int(entry["y"]), int(entry["height"]), int(entry["width"]),
+                   file.read(entry["length"]))
+
+def iterate_tile_store(store_path, buffer_size=64 * 1024 * 1024, packed=False):
+    """
+    Reads every tile of a container sequentially, in file order.
+    
+    Parameters:
+    - store_path: Path of the container file.
+    - buffer_size: Size of the read buffer, so the tiles are fetched with large sequential reads.
+    - packed: True to yield the tiles still bit-packed (8 pixels per byte, see mask_codec).
+    
+    Yields:
+    - (x, y, tile) tuples.
+    """
+    for x, y, height, width, blob in iterate_tile_store_records(store_path, buffer_size):
+        if packed:
+            tile = mask_codec.decompress_packed(blob, (height, width))
+        else:
+            tile = unpack_tile(blob, height, width)
+        yield x, y, tile
+
+def map_bounded(executor, function, items, max_in_flight):
+    """
+    Like executor.map, but keeps at most max_in_flight tasks submitted ahead of the consumer,
+    so results cannot pile up faster than they are used. Results come in input order.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
+
+@instrument.traced()
+def process_directory_to_store(input_folder_path, store_path, num_workers=None, max_in_flight=None):
+    """
+    Processes all images in a directory like process_directory, but on a worker pool and
+    into a single compressed container instead of one .npy file per tile.
+
+    Parameters:
+    - input_folder_path: Path to the folder containing input images.
+    - store_path: Path of the container file to write.
+    - num_workers: Number of worker processes. Defaults to the number of CPUs.
+    - max_in_flight: Maximum number of tiles processed ahead of the writer. Defaults to 4 * num_workers.
+    
+    Returns:
+    - The number of tiles written.
+    """
+    image_files = sorted(f for f in os.listdir(input_folder_path) if f.lower().endswith('.png'))
+    input_paths = [os.path.join(input_folder_path, f) for f in image_files]
+
+    num_workers = num_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        records = map_bounded(executor, _process_and_pack, input_paths, max_in_flight or 4 * num_workers)
+        return write_tile_store(records, store_path)
+
+@instrument.traced()
+def merge_tile_store(store_path, canvas_size, canvas_path=None, packed=False):
+    """
+    Merges the tiles of a container into a single large array, reading it sequentially.
+    Tiles that run past the canvas edge are clipped instead of being rejected.
+    
+    Parameters:
+    - store_path: Path of the container written by process_directory_to_store.
+    - canvas_size: Tuple of (width, height) for the canvas size.
+    - canvas_path: Optional .npy path for a memory-mapped canvas (see create_canvas).
+    - packed: True to merge into a mask_codec.PackedMask instead of a uint8 canvas. The tiles
+      are then ORed while still bit-packed, and the canvas takes 1/8 of the memory.
+    
+    Returns:
+    - The merged array and a list of (x, y) offsets that fell outside the canvas.
+    """
+    canvas_width, canvas_height = canvas_size
+    if packed:
+        merged_array = mask_codec.PackedMask.create(canvas_size, canvas_path)
+    else:
+        merged_array = create_canvas(canvas_size, canvas_path)
+    failed_list = []
+
+    for x, y, tile in iterate_tile_store(store_path, packed=packed):
+        if x >= canvas_width or y >= canvas_height:
+            failed_list.append((x, y))
+            continue
+        if packed:
+            merged_array.or_tile(tile, x, y)
+            continue
+        window = merged_array[y:y + tile.shape[0], x:x + tile.shape[1]]
+        window |= tile[:window.shape[0], :window.shape[1]]
+
+    if isinstance(merged_array, (np.memmap, mask_codec.PackedMask)):
+        merged_array.flush()
+    return merged_array, failed_list
+
+# instance-level merging
+
+def tile_instances_to_scene(x, y, masks, scores=None):
+    """
+    Moves the per-tile instance masks of one tile into scene coordinates.
+    Each instance is cropped to its bounding box so that only its own pixels are kept.
+    
+    Parameters:
+    - x, y: Top left corner of the tile in the scene.
+    - masks: Array of shape (num_instances, height, width), e.g. pred_masks from the predictor.
+    - scores: Optional confidence score per instance.
+    
+    Returns:
+    - A list of instance dicts with the keys x0, y0, mask, area, score, edge and centrality.
+    """
+    masks = np.asarray(masks).astype(bool)
+    if masks.ndim == 2:
+        masks = masks[None]
+    num_instances, tile_height, tile_width = masks.shape
+    if scores is None:
+        scores = np.ones(num_instances)
+    half_diagonal = np.hypot(tile_width, tile_height) / 2
+
+    instances = []
+    for i in range(num_instances):
+        rows = np.flatnonzero(masks[i].any(axis=1))
+        cols = np.flatnonzero(masks[i].any(axis=0))
+        if rows.size == 0:
+            continue
+        r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        mask = masks[i, r0:r1, c0:c1]
+        center_distance = np.hypot((c0 + c1) / 2 - tile_width / 2, (r0 + r1) / 2 - tile_height / 2)
+        instances.append({
+            "x0": x + int(c0),
+            "y0": y + int(r0),
+            "mask": mask,
+            "area": int(mask.sum()),
+            "score": float(scores[i]),
+            # Instances cut by the tile edge are only a part of the pond
+            "edge": bool(r0 == 0 or c0 == 0 or r1 == tile_height or c1 == tile_width),
+            "centrality": float(1 - center_distance / half_diagonal),
+        })
+    return instances
+
+def _instance_overlap(a, b):
+    """
+    Returns the number of pixels shared by two instances in scene coordinates.
+    """
+    x0, y0 = max(a["x0"], b["x0"]), max(a["y0"], b["y0"])
+    x1 = min(a["x0"] + a["mask"].shape[1], b["x0"] + b["mask"].shape[1])
+    y1 = min(a["y0"] + a["mask"].shape[0], b["y0"] + b["mask"].shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return 0
+    window_a = a["mask"][y0 - a["y0"]:y1 - a["y0"], x0 - a["x0"]:x1 - a["x0"]]
+    window_b = b["mask"][y0 - b["y0"]:y1 - b["y0"], x0 - b["x0"]:x1 - b["x0"]]
+    return int(np.count_nonzero(window_a & window_b))
+
+@instrument.traced()
+def merge_instances(tile_outputs, iou_threshold=0.5, containment_threshold=0.8, keep="score", cell_size=256):
+    """
+    Deduplicates instances detected in overlapping tiles.
+    Instances are visited best first and an instance is dropped when it overlaps an already
+    kept one by mask IoU >= iou_threshold, or when at least containment_threshold of its own
+    pixels are covered by it (a pond cut by a tile edge next to its complete copy).
+    Instances cut by a tile edge are always visited after complete ones.
+    
+    Parameters:
+    - tile_outputs: Iterable of (x, y, masks, scores) tuples, one per tile.
+    - iou_threshold: Mask IoU above which two instances are considered the same pond.
+    - containment_threshold: Fraction of an instance covered by a kept one above which it is dropped.
+    - keep: "score" keeps the most confident duplicate, "central" keeps the one closest to its tile centre.
+    - cell_size: Size in pixels of the grid cells used to find neighbouring instances.
+    
+    Returns:
+    - The list of kept instances in scene coordinates (see tile_instances_to_scene).
+    """
+    if keep not in ("score", "central"):
+        raise ValueError(f"Unknown keep strategy: {keep}")
+    rank = "score" if keep == "score" else "centrality"
+
+    instances = []
+    for x, y, masks, scores in tile_outputs:
+        instances.extend(tile_instances_to_scene(x, y, masks, scores))
+    instances.sort(key=lambda inst: (inst["edge"], -inst[rank], -inst["area"]))
+
+    grid = {}
+    kept = []
+    for inst in instances:
+        cells = [(cx, cy)
+                 for cy in range(inst["y0"] // cell_size, (inst["y0"] + inst["mask"].shape[0] - 1) // cell_size + 1)
+                 for cx in range(inst["x0"] // cell_size, (inst["x0"] + inst["mask"].shape[1] - 1) // cell_size + 1)]
+        candidates = {id(other): other for cell in cells for other in grid.get(cell, [])}
+
+        duplicate = False
+        for other in candidates.values():
+            intersection = _instance_overlap(inst, other)
+            if intersection == 0:
+                continue
+            union = inst["area"] + other["area"] - intersection
+            if intersection / union >= iou_threshold or intersection / inst["area"] >= containment_threshold:
+                duplicate = True
+                break
+        if duplicate:
+            continue
+
+        kept.append(inst)
+        for cell in cells:
+            grid.setdefault(cell, []).append(inst)
+
+    return kept
+
+@instrument.traced()
+def paint_instances(instances, canvas_size, canvas_path=None):
+    """
+    Paints deduplicated instances onto a canvas like the one built by merge_tiles.
+    
+    Parameters:
+    - instances: Instances in scene coordinates, as returned by merge_instances.
+    - canvas_size: Tuple of (width, height) for the canvas size.
+    - canvas_path: Optional .npy path for a memory-mapped canvas (see create_canvas).
+    
+    Returns:
+    - The merged array.
+    """
+    merged_array = create_canvas(canvas_size, canvas_path)
+    for inst in instances:
+        x0, y0, mask = inst["x0"], inst["y0"], inst["mask"]
+        window = merged_array[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]]
+        window |= mask[:window.shape[0], :window.shape[1]].astype(np.uint8)
+    return merged_array
+
+@instrument.traced()
 def save_merged_image(array, output_path):
     """
     Saves a NumPy array as a PNG image.
@@ -142,6 +548,42 @@ def save_merged_image(array, output_path):
     image = Image.fromarray(rgba_array, 'RGBA')
     image.save(output_path)
 
+def _png_chunk(chunk_type, data):
+    """
+    Encodes a single PNG chunk (length, type, data, CRC).
+    """
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+@instrument.traced()
+def save_merged_image_chunked(array, output_path, chunk_rows=1024):
+    """
+    Saves a NumPy array as the same RGBA PNG as save_merged_image, but streams it
+    chunk_rows rows at a time, so only one chunk of RGBA pixels is held in memory.
+    Works with memory-mapped canvases from create_canvas and with packed mask_codec.PackedMask canvases.
+    
+    Parameters:
+    - array: The (height, width) array to save, e.g. a memory-mapped canvas.
+    - output_path: The output file path for the image.
+    - chunk_rows: Number of rows converted and compressed per step.
+    """
+    height, width = array.shape
+    compressor = zlib.compressobj(6)
+    with open(output_path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bit depth, color type 6 (RGBA), default compression, filter and interlace
+        file.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        for start in range(0, height, chunk_rows):
+            block = np.asarray(array[start:start + chunk_rows])
+            rows = np.zeros((block.shape[0], 1 + 4 * width), dtype=np.uint8)
+            rgba = rows[:, 1:].reshape(block.shape[0], width, 4)
+            rgba[:, :, :3] = (block * 255).astype(np.uint8)[:, :, None]
+            rgba[:, :, 3] = (block == 1) * 255
+            data = compressor.compress(rows.tobytes())
+            if data:
+                file.write(_png_chunk(b"IDAT", data))
+        file.write(_png_chunk(b"IDAT", compressor.flush()))
+        file.write(_png_chunk(b"IEND", b""))
+
 def save_failed_list(failed_list, output_path):
     """
     Saves the list of filenames that failed to merge to a text file.
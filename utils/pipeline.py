@@ -0,0 +1,332 @@
+"""
+Command-line runner for the application pipeline: tile -> screen -> infer -> mosaic -> georeference -> count.
+The stages form a dependency graph. Every stage writes into its own folder named after a
+hash of its parameters, of the input files it reads and of the keys of the stages it depends
+on, so a re-run skips stages whose inputs did not change and a failed run resumes at the
+stage that failed (inference additionally resumes tile by tile through the prediction cache).
+Heavy libraries (GDAL, detectron2, torch, skimage, ...) are only imported by the stages that use them.
+With --until vectorize the tile masks are turned into pond polygons directly (see vector_mosaic)
+and the full-scene raster of the mosaic, georeference and count stages is never built.
+
+Usage:
+    python -m utils.pipeline --image data/test.tif --best output/performance/best_performance.txt --work output/run
+    python -m utils.pipeline --image data/test.png --weights model_3.pth --config config_3.pkl \\
+        --bounds 75.97936 19.946435 76.021714 19.88961 --work output/run --until mosaic
+    python -m utils.pipeline --image data/test.tif --best output/performance/best_performance.txt --work output/run \\
+        --until vectorize
+"""
+
+import os, sys, json, time, shutil, hashlib, argparse
+from utils.prediction_cache import file_digest
+
+
+def raster_size(image_path):
+    """
+    Width and height of a raster, read from its header only.
+
+    Returns:
+    - (width, height), the canvas_size expected by the mosaic functions.
+    """
+    from osgeo import gdal
+    dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Unable to open input image: {image_path}")
+    return dataset.RasterXSize, dataset.RasterYSize
+
+
+def raster_bounds(image_path):
+    """
+    NW and SE corners of a georeferenced raster.
+
+    Returns:
+    - (top_left_x, top_left_y, bottom_right_x, bottom_right_y), or None if the raster has no geotransform.
+    """
+    from osgeo import gdal
+    dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Unable to open input image: {image_path}")
+    geotransform = dataset.GetGeoTransform(can_return_null=True)
+    if geotransform is None or geotransform == (0, 1, 0, 0, 0, 1):
+        return None
+    top_left_x, pixel_width, _, top_left_y, _, pixel_height = geotransform
+    return (top_left_x, top_left_y,
+            top_left_x + dataset.RasterXSize * pixel_width, top_left_y + dataset.RasterYSize * pixel_height)
+
+
+def scene_geotransform(image_path, bounds=None):
+    """
+    GDAL geotransform of a scene, from its NW and SE corners or from its own georeferencing.
+
+    Parameters:
+    - image_path: The scene.
+    - bounds: Optional (top_left_x, top_left_y, bottom_right_x, bottom_right_y), as --bounds.
+
+    Returns:
+    - The geotransform as in georeference.calculate_geotransform_parameters, or None if the
+      scene is not georeferenced and no bounds are given.
+    """
+    bounds = tuple(bounds) if bounds else raster_bounds(image_path)
+    if bounds is None:
+        return None
+    width, height = raster_size(image_path)
+    top_left_x, top_left_y, bottom_right_x, bottom_right_y = bounds
+    return (top_left_x, (bottom_right_x - top_left_x) / width, 0,
+            top_left_y, 0, -abs((top_left_y - bottom_right_y) / height))
+
+
+# Stages: each gets the parsed arguments, the output folders of the stages it depends on
+# and its own (empty) output folder.
+
+def run_tile(args, inputs, output_dir):
+    from utils import preprocess as prep
+    tiles_dir = os.path.join(output_dir, "tiles")
+    prep.divide_and_save_image_windowed(args.image, tiles_dir, args.tile_size, args.tile_size, stride=args.stride)
+    prep.filter_tiles_by_size(tiles_dir, args.min_tile_bytes)
+
+
+def run_screen(args, inputs, output_dir):
+    tiles_dir = os.path.join(inputs["tile"], "tiles")
+    if args.prescreen:
+        from utils.prescreen import PreScreen, screen_tiles
+        kept, skipped, scores = screen_tiles(tiles_dir, PreScreen.load(args.prescreen), args.recall)
+    else:
+        kept, skipped, scores = sorted(f for f in os.listdir(tiles_dir) if f.lower().endswith(".png")), [], {}
+    with open(os.path.join(output_dir, "kept.txt"), "w") as file:
+        file.writelines(f"{name}\n" for name in kept)
+    with open(os.path.join(output_dir, "screen.json"), "w") as file:
+        json.dump({"kept": len(kept), "skipped": skipped, "scores": scores}, file, indent=4)
+    print(f"{len(skipped)} of {len(kept) + len(skipped)} tiles skipped by the pre-screen.")
+
+
+def run_infer(args, inputs, output_dir):
+    from utils import helpers as hp
+    from utils import mosaic as mosc
+    from utils.inference import InferenceEngine
+    from utils.prediction_cache import PredictionCache
+
+    cfg = hp.load_from_cloudpickle(args.config)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.score_thresh
+    engine = InferenceEngine(cfg, batch_size=args.batch_size, num_replicas=args.replicas, device=args.device,
+                             exported=args.exported)
+    # Shared by all runs in the work folder, so an interrupted stage only recomputes the missing tiles
+    cache = PredictionCache(os.path.join(args.work, "prediction_cache.sqlite"))
+
+    tiles_dir = os.path.join(inputs["tile"], "tiles")
+    kept = hp.read_paths_from_file(os.path.join(inputs["screen"], "kept.txt"))
+    items = [(f, os.path.join(tiles_dir, f)) for f in kept]
+    # The cleaned tile masks go bit-packed straight into the tile store, no mask PNGs
+    records = (mosc.pack_prediction(*mosc.parse_tile_offset(name), instances.pred_masks.numpy())
+               for name, instances in engine.run(items, cache=cache))
+    mosc.write_tile_store(records, os.path.join(output_dir, "masks.tiles"))
+    print(cache.stats())
+    cache.close()
+
+
+def run_mosaic(args, inputs, output_dir):
+    from utils import mosaic as mosc
+    _, failed_list = mosc.merge_tile_store(os.path.join(inputs["infer"], "masks.tiles"), raster_size(args.image),
+                                           canvas_path=os.path.join(output_dir, "merged_packed.npy"), packed=True)
+    mosc.save_failed_list([f"tile_{x}_{y}.png" for x, y in failed_list],
+                          os.path.join(output_dir, "tiles_failed_to_count.txt"))
+
+
+def run_georeference(args, inputs, output_dir):
+    import numpy as np
+    from utils import georeference as georef
+    from utils.mask_codec import PackedMask
+    bounds = tuple(args.bounds) if args.bounds else raster_bounds(args.image)
+    if bounds is None:
+        raise Exception(f"{args.image} is not georeferenced, pass its corners with --bounds.")
+    width, _ = raster_size(args.image)
+    merged = PackedMask(np.load(os.path.join(inputs["mosaic"], "merged_packed.npy"), mmap_mode="r"), width)
+    georef.write_georeferenced_mask(merged, os.path.join(output_dir, "georeferenced.tif"), *bounds)
+
+
+def run_count(args, inputs, output_dir):
+    import pandas as pd
+    from utils import area_calculator as ac
+    data = ac.count_objects_blockwise(os.path.join(inputs["georeference"], "georeferenced.tif"),
+                                      block_size=args.block_size)
+    df = pd.DataFrame(data)
+    df["Label"] = range(1, len(df) + 1)
+    output_csv_path = os.path.join(output_dir, "area_estimate.csv")
+    df.to_csv(output_csv_path, index=False)
+    print(f'{len(df)} objects saved in "{output_csv_path}".')
+
+
+def run_vectorize(args, inputs, output_dir):
+    from utils import vector_mosaic as vmosc
+    geotransform = scene_geotransform(args.image, args.bounds)
+    if geotransform is None:
+        raise Exception(f"{args.image} is not georeferenced, pass its corners with --bounds.")
+    polygons = vmosc.vectorize_tile_store(os.path.join(inputs["infer"], "masks.tiles"), tolerance=args.simplify)
+    store = vmosc.polygons_to_store(polygons, geotransform)
+    store.save(os.path.join(output_dir, "ponds.npz"))
+    output_csv_path = os.path.join(output_dir, "area_estimate.csv")
+    store.to_dataframe().to_csv(output_csv_path, index=False)
+    print(f'{len(store)} objects saved in "{output_csv_path}".')
+
+
+# "inputs" are argument names of files the stage reads, "params" the arguments that change
+# its outputs. Arguments that only change speed (batch size, workers, ...) are left out of the key.
+STAGES = {
+    "tile": {"deps": (), "inputs": ("image",), "params": ("tile_size", "stride", "min_tile_bytes"),
+             "run": run_tile},
+    # Without --prescreen the screen stage keeps every tile
+    "screen": {"deps": ("tile",), "inputs": ("prescreen",), "params": ("recall",), "run": run_screen},
+    "infer": {"deps": ("tile", "screen"), "inputs": ("weights", "config", "exported"), "params": ("score_thresh",),
+              "run": run_infer},
+    "mosaic": {"deps": ("infer",), "inputs": (), "params": (), "run": run_mosaic},
+    "georeference": {"deps": ("mosaic",), "inputs": (), "params": ("bounds",), "run": run_georeference},
+    "count": {"deps": ("georeference",), "inputs": (), "params": (), "run": run_count},
+    # Vector-first alternative to mosaic -> georeference -> count
+    "vectorize": {"deps": ("infer",), "inputs": (), "params": ("bounds", "simplify"), "run": run_vectorize},
+}
+
+
+def stage_order(target):
+    """
+    The stages needed to produce target, dependencies first.
+    """
+    order = []
+
+    def visit(stage):
+        for dep in STAGES[stage]["deps"]:
+            visit(dep)
+        if stage not in order:
+            order.append(stage)
+
+    visit(target)
+    return order
+
+
+def _load_manifest(work):
+    path = os.path.join(work, "pipeline.json")
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    return {"digests": {}, "stages": {}}
+
+
+def _save_manifest(work, manifest):
+    path = os.path.join(work, "pipeline.json")
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def input_digest(path, manifest):
+    """
+    Content digest of an input file. Digests are remembered with the file size and
+    modification time, so an unchanged multi-gigabyte scene is hashed only once.
+    """
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    entry = manifest["digests"].get(path)
+    if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": file_digest(path)}
+        manifest["digests"][path] = entry
+    return entry["digest"]
+
+
+def stage_key(stage, args, dep_keys, manifest):
+    """
+    Hash of the stage name, its parameters, the contents of its input files and the keys of its dependencies.
+    """
+    spec = STAGES[stage]
+    payload = {"stage": stage,
+               "params": {name: getattr(args, name) for name in spec["params"]},
+               "inputs": {name: input_digest(getattr(args, name), manifest) for name in spec["inputs"]
+                          if getattr(args, name) is not None},
+               "deps": {dep: dep_keys[dep] for dep in spec["deps"]}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def run_pipeline(args, until="count", force=()):
+    """
+    Run the stages up to and including until, skipping the ones whose outputs already exist.
+
+    Parameters:
+    - args: Parsed command-line arguments (see main).
+    - until: Last stage to run.
+    - force: Stages to run again even if their outputs exist. The stages after them run again too.
+
+    Returns:
+    - dict: {stage: output folder}.
+    """
+    os.makedirs(args.work, exist_ok=True)
+    manifest = _load_manifest(args.work)
+    keys = {}
+    outputs = {}
+    ran = set()
+    for stage in stage_order(until):
+        keys[stage] = stage_key(stage, args, keys, manifest)
+        output_dir = os.path.join(args.work, stage, keys[stage][:16])
+        outputs[stage] = output_dir
+        # A folder only gets its final name once the stage has finished
+        if os.path.isdir(output_dir) and stage not in force and not ran & set(STAGES[stage]["deps"]):
+            print(f"[{stage}] up to date: {output_dir}")
+            continue
+
+        partial_dir = output_dir + ".partial"
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        os.makedirs(partial_dir)
+        print(f"[{stage}] running")
+        start = time.perf_counter()
+        STAGES[stage]["run"](args, {dep: outputs[dep] for dep in STAGES[stage]["deps"]}, partial_dir)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.rename(partial_dir, output_dir)
+        seconds = time.perf_counter() - start
+        ran.add(stage)
+        print(f"[{stage}] finished in {seconds:.1f} s: {output_dir}")
+
+        manifest["stages"][stage] = {"key": keys[stage], "output": output_dir, "seconds": seconds,
+                                     "finished": time.time()}
+        _save_manifest(args.work, manifest)
+    _save_manifest(args.work, manifest)
+    return outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the pond detection pipeline on a scene.")
+    parser.add_argument("--image", required=True, help="scene to process (GeoTIFF recommended)")
+    parser.add_argument("--work", default="output/pipeline", help="folder for the stage outputs")
+    parser.add_argument("--best", help="best_performance.txt with the model path and config path")
+    parser.add_argument("--weights", help="trained model (.pth), instead of --best")
+    parser.add_argument("--config", help="model config (.pkl), instead of --best")
+    parser.add_argument("--bounds", type=float, nargs=4, metavar=("TOP_LEFT_X", "TOP_LEFT_Y", "BOTTOM_RIGHT_X",
+                                                                  "BOTTOM_RIGHT_Y"),
+                        help="NW and SE corners (longitude, latitude); default: the scene's geotransform")
+    parser.add_argument("--tile-size", type=int, default=1024)
+    parser.add_argument("--stride", type=float, default=0.25, help="step between tiles as a fraction of --tile-size")
+    parser.add_argument("--min-tile-bytes", type=int, default=100000, help="smaller (empty) tiles are dropped")
+    parser.add_argument("--prescreen", help="pre-screen model from utils.prescreen; tiles it rejects are not inferred")
+    parser.add_argument("--recall", type=float, default=0.99, help="pond recall the pre-screen threshold is set for")
+    parser.add_argument("--score-thresh", type=float, default=0.7)
+    parser.add_argument("--exported", help="TorchScript model from utils.export to run instead of the eager model; "
+                        "it must have been exported with the same --score-thresh")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--block-size", type=int, default=4096)
+    parser.add_argument("--simplify", type=float, default=1.0, help="outline simplification in pixels (vectorize)")
+    parser.add_argument("--until", choices=list(STAGES), default="count", help="last stage to run")
+    parser.add_argument("--force", nargs="+", choices=list(STAGES), default=[], help="stages to run again")
+    args = parser.parse_args(argv)
+
+    if not 0 < args.stride <= 1:
+        parser.error(f"--stride is a fraction of the tile size in (0, 1], got {args.stride}")
+    if args.best:
+        from utils import helpers as hp
+        args.weights, args.config = hp.read_paths_from_file(args.best)[:2]
+    if "infer" in stage_order(args.until) and not (args.weights and args.config):
+        parser.error("the infer stage needs --best or both --weights and --config")
+
+    outputs = run_pipeline(args, args.until, args.force)
+    print(json.dumps(outputs, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Columnar store and spatial queries for detected ponds.
+The pond table is saved as one compressed .npz file: one array per column (Area, Real_area,
+centers, ...) plus the outlines as flat coordinate arrays with ring and polygon offsets
+(shapely's ragged layout), instead of a CSV with one OpenCV contour printed per cell.
+Loading rebuilds all polygons in one vectorized call, and an STRtree (R-tree) over them
+answers bounding-box, containment, nearest-neighbour and per-region queries without scanning.
+Outlines are stored in the coordinates of the georeferenced raster (longitude/latitude for
+the GeoTIFFs written by georeference), so query geometries must use the same CRS.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+import shapely
+from utils import instrument
+
+COLUMNS = ("Area", "Real_area", "Center_X", "Center_Y", "Center_lat", "Center_long")
+
+
+def contours_to_polygons(contours, to_world):
+    """
+    Turns OpenCV contours in pixel coordinates into shapely polygons in world coordinates.
+    All vertices are transformed in one call.
+
+    Parameters:
+    - contours: Sequence of (n, 1, 2) contours as found by area_calculator.find_contours;
+      None entries give a None geometry.
+    - to_world: Function mapping pixel (xs, ys) arrays to world (xs, ys) arrays.
+
+    Returns:
+    - A NumPy array of shapely polygons.
+    """
+    rings = [np.asarray(contour, dtype=np.float64).reshape(-1, 2) if contour is not None else np.zeros((0, 2))
+             for contour in contours]
+    lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+    vertices = np.concatenate(rings) if rings else np.zeros((0, 2))
+    world_x, world_y = to_world(vertices[:, 0], vertices[:, 1])
+
+    polygons = np.full(len(rings), None, dtype=object)
+    # A ring needs at least 3 vertices; shapely closes it
+    valid = lengths >= 3
+    keep = np.repeat(valid, lengths)
+    if valid.any():
+        ring_index = np.repeat(np.arange(valid.sum()), lengths[valid])
+        polygons[valid] = shapely.polygons(shapely.linearrings(world_x[keep], world_y[keep], indices=ring_index))
+    return polygons
+
+
+def affine_to_world(geotransform):
+    """Pixel to world mapping of a GDAL geotransform, for contours_to_polygons."""
+    def to_world(xs, ys):
+        return (geotransform[0] + xs * geotransform[1] + ys * geotransform[2],
+                geotransform[3] + xs * geotransform[4] + ys * geotransform[5])
+    return to_world
+
+
+def gcp_to_world(model):
+    """Pixel to world mapping of a GCP transform fitted with georeference.add_gcp."""
+    from utils import georeference as georef
+
+    def to_world(xs, ys):
+        return georef.apply_gcp_transform(model, xs, ys)
+    return to_world
+
+
+class PondStore:
+    """
+    Pond table with outlines and a lazily built STRtree spatial index.
+
+    Parameters:
+    - columns: dict of equally long column arrays (see COLUMNS).
+    - geometries: Array of shapely polygons, one per pond (None where the outline is unknown).
+    - crs: Optional WKT of the coordinate system of the outlines.
+    """
+
+    def __init__(self, columns, geometries, crs=""):
+        self.columns = {name: np.asarray(values) for name, values in columns.items()}
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.crs = crs
+        self._tree = None
+        self._centers = None
+
+    def __len__(self):
+        return len(self.geometries)
+
+    @classmethod
+    def from_objects_data(cls, data, geotransform=None, gcp_model=None, crs=""):
+        """
+        Builds the store from the output of area_calculator.calculate_objects_data (or its
+        vectorized variant). The contours are placed with the raster geotransform, or with a
+        GCP model from georeference.add_gcp.
+        """
+        if (geotransform is None) == (gcp_model is None):
+            raise ValueError("Pass either a geotransform or a gcp_model.")
+        to_world = affine_to_world(geotransform) if gcp_model is None else gcp_to_world(gcp_model)
+        columns = {name: np.asarray(data[name]) for name in COLUMNS if name in data}
+        columns["Label"] = np.arange(1, len(data["Contour"]) + 1)
+        return cls(columns, contours_to_polygons(data["Contour"], to_world), crs)
+
+    @instrument.traced()
+    def save(self, path):
+        """Writes the store to a compressed .npz file."""
+        present = ~shapely.is_missing(self.geometries)
+        _, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(self.geometries[present])
+        meta = {"columns": list(self.columns), "crs": self.crs, "count": len(self)}
+        np.savez_compressed(path, coords=coords, ring_offsets=ring_offsets, polygon_offsets=polygon_offsets,
+                            present=present, meta=np.array(json.dumps(meta)),
+                            **{f"column_{name}": values for name, values in self.columns.items()})
+
+    @classmethod
+    @instrument.traced()
+    def load(cls, path):
+        """Reads a store written by save."""
+        with np.load(path) as archive:
+            meta = json.loads(str(archive["meta"]))
+            columns = {name: archive[f"column_{name}"] for name in meta["columns"]}
+            present = archive["present"]
+            geometries = np.full(meta["count"], None, dtype=object)
+            if present.any():
+                geometries[present] = shapely.from_ragged_array(
+                    shapely.GeometryType.POLYGON, archive["coords"],
+                    (archive["ring_offsets"], archive["polygon_offsets"]))
+        return cls(columns, geometries, meta["crs"])
+
+    @property
+    def tree(self):
+        """STRtree over the outlines, built on first use."""
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geometries)
+        return self._tree
+
+    @property
+    def centers(self):
+        """Pond centers (centroids of the outlines) as x and y arrays, and their STRtree."""
+        if self._centers is None:
+            points = shapely.centroid(self.geometries)
+            self._centers = shapely.get_x(points), shapely.get_y(points), shapely.STRtree(points)
+        return self._centers
+
+    def query_bbox(self, min_x, min_y, max_x, max_y):
+        """
+        Indices of the ponds intersecting a bounding box.
+        """
+        return np.sort(self.tree.query(shapely.box(min_x, min_y, max_x, max_y), predicate="intersects"))
+
+    def query_polygon(self, polygon, predicate="contains"):
+        """
+        Indices of the ponds in a polygon, e.g. a village boundary.
+
+        Parameters:
+        - polygon: A shapely geometry in the store's CRS.
+        - predicate: "contains" for ponds entirely inside, "intersects" for ponds touching it.
+        """
+        return np.sort(self.tree.query(polygon, predicate=predicate))
+
+    def nearest(self, points, max_distance=None):
+        """
+        Nearest pond to each point, e.g. to wells.
+
+        Parameters:
+        - points: A shapely geometry or an array of them, or an (n, 2) array of coordinates.
+        - max_distance: Optional search radius; points with no pond within it are left out.
+
+        Returns:
+        - (point_indices, pond_indices, distances), distances in the units of the CRS.
+        """
+        if isinstance(points, np.ndarray) and points.dtype != object:
+            points = shapely.points(points)
+        points = np.atleast_1d(np.asarray(points, dtype=object))
+        (point_indices, pond_indices), distances = self.tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True, all_matches=False)
+        return point_indices, pond_indices, distances
+
+    def aggregate_by_region(self, regions, column="Real_area"):
+        """
+        Number of ponds and total of a column per region; a pond belongs to the region
+        containing its center, so ponds on a boundary are counted once.
+
+        Parameters:
+        - regions: Sequence of shapely polygons, e.g. from load_regions.
+        - column: Column to sum, Real_area by default.
+
+        Returns:
+        - A DataFrame with one row per region: count and <column>_sum.
+        """
+        regions = np.asarray(regions, dtype=object)
+        center_x, center_y, tree = self.centers
+        # Bounding-box candidates from the index, then one vectorized test on the prepared regions
+        region_indices, pond_indices = tree.query(regions)
+        shapely.prepare(regions)
+        inside = shapely.contains_xy(regions[region_indices], center_x[pond_indices], center_y[pond_indices])
+        region_indices, pond_indices = region_indices[inside], pond_indices[inside]
+        # Where regions overlap, a pond is counted in the first region only
+        _, first = np.unique(pond_indices, return_index=True)
+        region_indices, pond_indices = region_indices[first], pond_indices[first]
+        values = self.columns[column][pond_indices].astype(np.float64)
+        return pd.DataFrame({"count": np.bincount(region_indices, minlength=len(regions)),
+                             f"{column}_sum": np.bincount(region_indices, weights=values, minlength=len(regions))})
+
+    def to_dataframe(self, indices=None, wkt=False):
+        """
+        The pond table (optionally only some rows) as a DataFrame, with the outlines as WKT if asked.
+        """
+        indices = slice(None) if indices is None else indices
+        df = pd.DataFrame({name: values[indices] for name, values in self.columns.items()})
+        if wkt:
+            df["Outline"] = shapely.to_wkt(self.geometries[indices], rounding_precision=7)
+        return df
+
+
+def load_regions(geojson_path, name_field=None):
+    """
+    Reads region polygons (villages, admin units) from a GeoJSON file.
+
+    Returns:
+    - (names, polygons): The name_field property of each feature (or its position) and the geometries.
+    """
+    with open(geojson_path) as file:
+        features = json.load(file)["features"]
+    names = [feature["properties"].get(name_field) if name_field else i for i, feature in enumerate(features)]
+    polygons = shapely.from_geojson([json.dumps(feature["geometry"]) for feature in features])
+    return names, polygons
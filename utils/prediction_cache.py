@@ -0,0 +1,189 @@
+"""
+Persistent, content-addressed cache of tile predictions.
+A prediction is stored under a hash of the tile pixels and of the model (weights file,
+SCORE_THRESH_TEST and the rest of the config), so re-running a scene only recomputes
+tiles whose pixels or model actually changed, and an interrupted run resumes where it stopped.
+"""
+
+import hashlib, sqlite3, threading, time
+import numpy as np
+from utils import mask_codec
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_fingerprint(cfg, exported_path=None):
+    """
+    Fingerprint of everything in the model that changes predictions: the weights file
+    contents, the score threshold and the full config, and the exported model file when
+    inference runs on one (see export.export_model).
+    """
+    digest = hashlib.sha256()
+    digest.update(file_digest(cfg.MODEL.WEIGHTS).encode())
+    digest.update(repr(cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST).encode())
+    digest.update(cfg.dump().encode())
+    if exported_path:
+        digest.update(file_digest(exported_path).encode())
+    return digest.hexdigest()
+
+
+def tile_key(image, fingerprint):
+    """Cache key of one tile: hash of its shape, dtype and pixels plus the model fingerprint."""
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha256(fingerprint.encode())
+    digest.update(f"{image.shape}{image.dtype}".encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+def encode_prediction(masks, scores, classes=None, boxes=None):
+    """
+    Encode instance predictions compactly: masks are bit-packed and zlib-compressed (see mask_codec).
+
+    Parameters:
+    - masks: Boolean array of shape (num_instances, height, width).
+    - scores: Score per instance.
+    - classes: Optional class id per instance.
+    - boxes: Optional (num_instances, 4) XYXY boxes.
+
+    Returns:
+    - A dict of plain values ready to be stored.
+    """
+    masks = np.asarray(masks, dtype=bool)
+    num_instances = masks.shape[0]
+    return {
+        "shape": masks.shape,
+        "masks": mask_codec.compress_mask(masks),
+        "scores": np.asarray(scores, dtype=np.float32).tobytes(),
+        "classes": np.asarray(classes if classes is not None else np.zeros(num_instances), dtype=np.int64).tobytes(),
+        "boxes": np.asarray(boxes if boxes is not None else np.zeros((num_instances, 4)), dtype=np.float32).tobytes(),
+    }
+
+
+def decode_prediction(record):
+    """
+    Decode a record from encode_prediction.
+
+    Returns:
+    - dict: masks (bool array), scores, classes and boxes as NumPy arrays.
+    """
+    masks = mask_codec.decompress_mask(record["masks"], record["shape"]).astype(bool)
+    return {
+        "masks": masks,
+        "scores": np.frombuffer(record["scores"], dtype=np.float32),
+        "classes": np.frombuffer(record["classes"], dtype=np.int64),
+        "boxes": np.frombuffer(record["boxes"], dtype=np.float32).reshape(-1, 4),
+    }
+
+
+class PredictionCache:
+    """
+    SQLite-backed prediction cache with least-recently-used eviction by total size.
+    The total size is kept in memory, and last-access times of hits are written in batches,
+    so neither put nor get scans or commits more than the entries they touch. The cache is
+    meant for one connection at a time.
+
+    Parameters:
+    - db_path: Path of the cache database; created if it does not exist.
+    - max_bytes: Total size of the stored predictions above which the least recently
+      used entries are evicted.
+    - flush_every: Number of hits whose last-access times are buffered before being written.
+    """
+
+    def __init__(self, db_path, max_bytes=10 * 1024 ** 3, flush_every=256):
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key TEXT PRIMARY KEY, height INTEGER, width INTEGER, num INTEGER, "
+            "masks BLOB, scores BLOB, classes BLOB, boxes BLOB, size INTEGER, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS predictions_access ON predictions (last_access)")
+        self._conn.commit()
+        self._bytes, = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()
+
+    def get(self, key):
+        """Return the decoded prediction for key, or None on a miss."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT num, height, width, masks, scores, classes, boxes FROM predictions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= self.flush_every:
+                self._flush_accesses()
+                self._conn.commit()
+        num, height, width, masks, scores, classes, boxes = row
+        return decode_prediction({"shape": (num, height, width), "masks": masks,
+                                  "scores": scores, "classes": classes, "boxes": boxes})
+
+    def put(self, key, masks, scores, classes=None, boxes=None):
+        """Store the prediction of one tile and evict old entries if the cache is over budget."""
+        record = encode_prediction(masks, scores, classes, boxes)
+        num, height, width = record["shape"]
+        size = sum(len(record[name]) for name in ("masks", "scores", "classes", "boxes"))
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM predictions WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, height, width, num, record["masks"], record["scores"], record["classes"],
+                 record["boxes"], size, time.time()),
+            )
+            self._accessed.pop(key, None)
+            self._bytes += size - (previous[0] if previous else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _flush_accesses(self):
+        """Write the buffered last-access times of hits."""
+        if self._accessed:
+            self._conn.executemany("UPDATE predictions SET last_access = ? WHERE key = ?",
+                                   [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    def _evict(self, batch_size=64):
+        """Delete least recently used entries until the total size fits in max_bytes."""
+        # Eviction order depends on the buffered hits
+        self._flush_accesses()
+        while self._bytes > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM predictions ORDER BY last_access LIMIT ?",
+                                      (batch_size,)).fetchall()
+            if not rows:
+                self._bytes = 0
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM predictions WHERE key = ?", (key,))
+                self.evictions += 1
+                self._bytes -= size
+                if self._bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        """Return hit/miss/eviction counters and the current number and size of entries."""
+        with self._lock:
+            entries, = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": entries, "bytes": self._bytes}
+
+    def close(self):
+        with self._lock:
+            self._flush_accesses()
+            self._conn.commit()
+        self._conn.close()
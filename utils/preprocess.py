@@ -6,11 +6,42 @@ The output is a folder of images ready for model application.
 """
 
 import os, random, shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 from PIL import Image, ImageOps 
+from osgeo import gdal
+from utils import instrument
 
 
 
-def divide_and_save_image(input_image_path, output_folder, tile_width, tile_height):
+def tile_offsets(image_width, image_height, tile_width, tile_height, stride=0.25, overlap=None):
+    """
+    Lists the top left corners of the tiles covering an image.
+
+    Parameters:
+    - image_width, image_height: Size of the image in pixels.
+    - tile_width, tile_height: Size of each tile in pixels.
+    - stride: Step between tiles as a fraction of the tile size, in (0, 1]. 0.25 gives the
+      original tile_width // 4 step, where each pixel lands in up to 16 tiles; 0.5 gives 4.
+    - overlap: Fixed margin in pixels shared by neighbouring tiles. Overrides stride when set.
+
+    Returns:
+    - A list of (x, y) offsets in row-major order.
+    """
+    if overlap is not None:
+        step_x, step_y = tile_width - int(overlap), tile_height - int(overlap)
+    elif 0 < stride <= 1:
+        step_x, step_y = max(1, int(tile_width * stride)), max(1, int(tile_height * stride))
+    else:
+        raise ValueError(f"stride is a fraction of the tile size in (0, 1], got {stride}; "
+                         "use overlap for a margin in pixels.")
+    if step_x <= 0 or step_y <= 0:
+        raise ValueError(f"Tile step must be positive, got ({step_x}, {step_y}).")
+    return [(x, y) for y in range(0, image_height, step_y) for x in range(0, image_width, step_x)]
+
+
+@instrument.traced()
+def divide_and_save_image(input_image_path, output_folder, tile_width, tile_height, stride=0.25, overlap=None):
     """
     Divides the input image into smaller tiles of specified width and height.
     
@@ -19,6 +50,7 @@ def divide_and_save_image(input_image_path, output_folder, tile_width, tile_heig
     - output_folder: The folder where the tiles will be saved.
     - tile_width: The width of each tile.
     - tile_height: The height of each tile.
+    - stride, overlap: Spacing of the tiles, see tile_offsets.
     """
     # Create the output folder if it doesn't exist
     if not os.path.exists(output_folder):
@@ -26,17 +58,192 @@ def divide_and_save_image(input_image_path, output_folder, tile_width, tile_heig
     try:
         with Image.open(input_image_path) as img:
             image_width, image_height = img.size
-            slider_width = tile_width // 4
-            slider_height = tile_height // 4
-            for y in range(0, image_height, slider_height):
-                for x in range(0, image_width, slider_width):
-                    tile = img.crop((x, y, x + tile_width, y + tile_height))
-                    tile.save(os.path.join(output_folder, f"tile_{x}_{y}.png"))
+            for x, y in tile_offsets(image_width, image_height, tile_width, tile_height, stride, overlap):
+                tile = img.crop((x, y, x + tile_width, y + tile_height))
+                tile.save(os.path.join(output_folder, f"tile_{x}_{y}.png"))
+                instrument.add_items(1)
 
     except Exception as e:
         print(f"Error dividing and saving image: {str(e)}")
 
 
+# windowed tiling
+
+_window_dataset = None
+
+
+def _open_window_dataset(input_image_path):
+    """
+    Opens the source raster once per worker process so each tile only reads its own window.
+    """
+    global _window_dataset
+    _window_dataset = gdal.Open(input_image_path, gdal.GA_ReadOnly)
+
+
+def read_tile_window(dataset, x, y, tile_width, tile_height):
+    """
+    Reads a single tile window from a GDAL dataset as an (height, width, bands) array.
+    Windows that run past the right or bottom edge are padded with zeros, the same way
+    PIL's crop pads the tiles produced by divide_and_save_image. Windows may also start
+    before the left or top edge (negative x or y), e.g. on a scene registered to another grid.
+
+    Parameters:
+    - dataset: An open GDAL dataset.
+    - x, y: Top left corner of the window in pixels.
+    - tile_width: The width of the tile.
+    - tile_height: The height of the tile.
+
+    Returns:
+    - The tile as a uint8 NumPy array. Rasters with other data types raise a ValueError.
+    """
+    x0, y0 = max(x, 0), max(y, 0)
+    x1 = min(x + tile_width, dataset.RasterXSize)
+    y1 = min(y + tile_height, dataset.RasterYSize)
+    tile = np.zeros((tile_height, tile_width, dataset.RasterCount), dtype=np.uint8)
+    if x1 <= x0 or y1 <= y0:
+        return tile
+    window = dataset.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    if window.dtype != np.uint8:
+        # Casting would wrap 16-bit or float values around instead of scaling them
+        raise ValueError(f"Expected an 8-bit raster, got {window.dtype} values; convert it first, "
+                         "e.g. gdal_translate -ot Byte -scale.")
+    if window.ndim == 2:
+        window = window[None, :, :]
+    tile[y0 - y:y1 - y, x0 - x:x1 - x] = np.moveaxis(window, 0, -1)
+    return tile
+
+
+def to_bgr(tile):
+    """
+    Converts an (height, width, bands) tile read from the raster to the 3-channel BGR array
+    that cv2.imread gives the predictor.
+    """
+    if tile.shape[2] < 3:
+        tile = np.repeat(tile[:, :, :1], 3, axis=2)
+    return np.ascontiguousarray(tile[:, :, 2::-1])
+
+
+def _tile_to_image(tile):
+    """
+    Converts an (height, width, bands) array to a PIL image with a matching mode.
+    """
+    bands = tile.shape[2]
+    if bands == 1:
+        return Image.fromarray(tile[:, :, 0], "L")
+    if bands == 2:
+        return Image.fromarray(tile, "LA")
+    if bands == 3:
+        return Image.fromarray(tile, "RGB")
+    return Image.fromarray(tile[:, :, :4], "RGBA")
+
+
+def _save_tile_window(x, y, tile_width, tile_height, output_folder):
+    """
+    Worker task: reads one window from the worker's dataset and encodes it as a PNG tile.
+    """
+    tile = read_tile_window(_window_dataset, x, y, tile_width, tile_height)
+    _tile_to_image(tile).save(os.path.join(output_folder, f"tile_{x}_{y}.png"))
+    return x, y
+
+
+@instrument.traced()
+def divide_and_save_image_windowed(input_image_path, output_folder, tile_width, tile_height,
+                                   num_workers=None, max_in_flight=None, stride=0.25, overlap=None):
+    """
+    Divides the input image into tiles like divide_and_save_image, but without loading the
+    whole scene. Each tile is read as a raster window through GDAL (block reads on a GeoTIFF)
+    and encoded to PNG on a process pool, so peak memory is bounded by the number of
+    windows in flight rather than by the scene size. Tiles keep the tile_{x}_{y}.png names.
+
+    Parameters:
+    - input_image_path: The path to the input image (GeoTIFF recommended, any GDAL format works).
+    - output_folder: The folder where the tiles will be saved.
+    - tile_width: The width of each tile.
+    - tile_height: The height of each tile.
+    - num_workers: Number of worker processes. Defaults to the number of CPUs.
+    - max_in_flight: Maximum number of windows submitted at once. Defaults to 2 * num_workers.
+    - stride, overlap: Spacing of the tiles, see tile_offsets.
+
+    Returns:
+    - The number of tiles written.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    dataset = gdal.Open(input_image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Unable to open input image: {input_image_path}")
+    image_width, image_height = dataset.RasterXSize, dataset.RasterYSize
+    dataset = None
+
+    num_workers = num_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * num_workers
+    offsets = tile_offsets(image_width, image_height, tile_width, tile_height, stride, overlap)
+
+    written = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_open_window_dataset,
+                             initargs=(input_image_path,)) as executor:
+        pending = set()
+        for x, y in offsets:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    written += 1
+            pending.add(executor.submit(_save_tile_window, x, y, tile_width, tile_height, output_folder))
+        for future in pending:
+            future.result()
+            written += 1
+
+    instrument.add_items(written)
+    return written
+
+
+def is_blank_tile(tile, min_nonzero_fraction=0.01):
+    """
+    In-memory stand-in for filter_tiles_by_size: a tile is blank when fewer than
+    min_nonzero_fraction of its pixels carry any data.
+    """
+    nonzero = np.any(tile != 0, axis=-1) if tile.ndim == 3 else tile != 0
+    return nonzero.mean() < min_nonzero_fraction
+
+
+def iterate_tiles(input_image_path, tile_width, tile_height, min_nonzero_fraction=0.01,
+                  as_bgr=True, debug_folder=None, stride=0.25, overlap=None):
+    """
+    Streams tiles straight from the source raster without writing them to disk.
+    Windows are read through GDAL one at a time and blank tiles are skipped in memory,
+    so the tiles can be handed directly to the predictor.
+
+    Parameters:
+    - input_image_path: The path to the input image.
+    - tile_width: The width of each tile.
+    - tile_height: The height of each tile.
+    - min_nonzero_fraction: Tiles with less data than this fraction are skipped (see is_blank_tile).
+    - as_bgr: Yield 3-channel BGR arrays, matching what cv2.imread gives the predictor.
+    - debug_folder: If set, each yielded tile is also saved there as tile_{x}_{y}.png.
+    - stride, overlap: Spacing of the tiles, see tile_offsets.
+
+    Yields:
+    - (x, y, tile) tuples, where (x, y) is the top left corner of the tile in the scene.
+    """
+    dataset = gdal.Open(input_image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Unable to open input image: {input_image_path}")
+    if debug_folder is not None:
+        os.makedirs(debug_folder, exist_ok=True)
+
+    for x, y in tile_offsets(dataset.RasterXSize, dataset.RasterYSize, tile_width, tile_height, stride, overlap):
+        tile = read_tile_window(dataset, x, y, tile_width, tile_height)
+        if is_blank_tile(tile, min_nonzero_fraction):
+            continue
+        if debug_folder is not None:
+            _tile_to_image(tile).save(os.path.join(debug_folder, f"tile_{x}_{y}.png"))
+        if as_bgr:
+            tile = to_bgr(tile)
+        yield x, y, tile
+
+
+@instrument.traced()
 def filter_tiles_by_size(folder_path, min_file_size):
     """
     Filters out tiles smaller than a specified file size.
@@ -59,6 +266,7 @@ def filter_tiles_by_size(folder_path, min_file_size):
             print(f"Error while processing '{file_name}': {e}")
 
 
+@instrument.traced()
 def process_training_data(train_folder, train_mask_folder, train_not_used_folder):
     """
     Process training data by comparing files in the training and mask folders,
@@ -92,6 +300,7 @@ def process_training_data(train_folder, train_mask_folder, train_not_used_folder
             moved_files.append(train_file)
 
 
+@instrument.traced()
 def create_validation_set(train_folder, train_mask_folder, val_folder, val_mask_folder, num_images_to_select):
     """
     Randomly selects a specified number of images and their corresponding masks from training folders,
@@ -138,6 +347,7 @@ def create_validation_set(train_folder, train_mask_folder, val_folder, val_mask_
 
 
 
+@instrument.traced()
 def invert_image_colors(folder_path, file_extension=".png"):
     """
     Invert the colors of images within a specified folder that match the given file extension.
@@ -0,0 +1,291 @@
+"""
+Cheap pre-screening of tiles before Mask R-CNN.
+Each tile is reduced to a few colour and texture statistics (percentiles of water-like colour
+indices and of the local brightness variation over 8x8 pixel blocks), and a small logistic
+regression trained on the train / train_mask / train_not_used tiles scores how likely the
+tile is to contain a pond. Tiles scoring below a threshold are not sent to the model.
+The threshold is chosen on the validation tiles for a target pond recall (the share of
+validation ponds whose tile is kept), so the accuracy cost can be tuned against the savings.
+
+Usage:
+    python -m utils.prescreen --train data/train --train-mask data/train_mask --negatives data/train_not_used \\
+        --val data/val --val-mask data/val_mask --output output/prescreen.json --recall 0.99
+"""
+
+import os, sys, json, time, argparse
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from utils import instrument
+
+INDICES = ("green_red", "blue_red", "brightness", "saturation", "texture")
+PERCENTILES = (1, 10, 50, 90, 99)
+FEATURE_NAMES = tuple(f"{index}_p{p}" for index in INDICES for p in PERCENTILES) + ("blank_fraction",)
+
+
+def tile_features(image, block=8):
+    """
+    Colour and texture statistics of one tile, computed on block means so that a pond of a few
+    thousand pixels still covers dozens of blocks.
+
+    Parameters:
+    - image: BGR tile (as read by cv2.imread).
+    - block: Block size in pixels.
+
+    Returns:
+    - A float32 vector, one value per FEATURE_NAMES.
+    """
+    height, width = image.shape[:2]
+    height, width = height - height % block, width - width % block
+    image = image[:height, :width]
+    # INTER_AREA with a whole-number factor averages each block, much faster than NumPy reductions
+    size = (width // block, height // block)
+    blue, green, red = np.moveaxis(cv2.resize(image.astype(np.float32), size, interpolation=cv2.INTER_AREA), -1, 0)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    brightness = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    texture = np.sqrt(np.maximum(cv2.resize(gray ** 2, size, interpolation=cv2.INTER_AREA) - brightness ** 2, 0))
+    channels = np.stack((blue, green, red))
+    indices = np.stack((
+        (green - red) / (green + red + 1),
+        (blue - red) / (blue + red + 1),
+        brightness / 255,
+        (channels.max(axis=0) - channels.min(axis=0)) / (channels.max(axis=0) + 1),
+        texture / 255,
+    )).reshape(len(INDICES), -1)
+    # Blocks without data (outside the scene) would otherwise look like dark water
+    valid = channels.max(axis=0).ravel() > 0
+    blank_fraction = 1 - valid.mean()
+    if not valid.any():
+        return np.concatenate((np.zeros(len(INDICES) * len(PERCENTILES)), [blank_fraction])).astype(np.float32)
+    percentiles = np.percentile(indices[:, valid], PERCENTILES, axis=1).T
+    return np.concatenate((percentiles.ravel(), [blank_fraction])).astype(np.float32)
+
+
+def _file_features(image_path):
+    """Worker task: features of one tile file."""
+    return tile_features(cv2.imread(image_path))
+
+
+def count_ponds(mask_path, min_pixels=100):
+    """
+    Number of ponds in a mask tile (white ponds on black, as after invert_image_colors).
+    Specks below min_pixels are not counted.
+    """
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    _, _, stats, _ = cv2.connectedComponentsWithStats((mask > 127).astype(np.uint8), connectivity=8)
+    return int(np.count_nonzero(stats[1:, cv2.CC_STAT_AREA] >= min_pixels))
+
+
+def _list_tiles(folder):
+    return sorted(f for f in os.listdir(folder) if f.lower().endswith(".png"))
+
+
+@instrument.traced()
+def folder_features(folder, files=None, num_workers=None):
+    """
+    Features of the tiles in a folder, computed on a process pool.
+
+    Returns:
+    - (file names, (num_tiles, num_features) array).
+    """
+    files = _list_tiles(folder) if files is None else list(files)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        features = list(executor.map(_file_features, [os.path.join(folder, f) for f in files], chunksize=8))
+    instrument.add_items(len(files))
+    return files, np.array(features, dtype=np.float32).reshape(len(files), len(FEATURE_NAMES))
+
+
+def fit_logistic(features, labels, l2=1.0, iterations=50):
+    """
+    L2-regularized logistic regression fitted with Newton steps, with the two classes
+    weighted equally however unbalanced they are.
+
+    Returns:
+    - (mean, std, weights, bias): The feature standardization and the model.
+    """
+    mean = features.mean(axis=0)
+    std = features.std(axis=0) + 1e-6
+    x = np.column_stack(((features - mean) / std, np.ones(len(features))))
+    labels = np.asarray(labels, dtype=np.float64)
+    sample_weight = np.where(labels > 0, 0.5 / max(labels.sum(), 1), 0.5 / max((1 - labels).sum(), 1))
+    penalty = np.full(x.shape[1], l2 / len(features))
+    penalty[-1] = 0
+    theta = np.zeros(x.shape[1])
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-x @ theta))
+        gradient = x.T @ (sample_weight * (p - labels)) + penalty * theta
+        hessian = (x * (sample_weight * p * (1 - p))[:, None]).T @ x + np.diag(penalty + 1e-9)
+        step = np.linalg.solve(hessian, gradient)
+        theta -= step
+        if np.abs(step).max() < 1e-6:
+            break
+    return mean, std, theta[:-1], theta[-1]
+
+
+class PreScreen:
+    """
+    Trained pre-screening model with its recall calibration.
+
+    Parameters:
+    - mean, std: Feature standardization.
+    - weights, bias: Logistic regression coefficients.
+    - calibration: Optional (scores, ponds) of the calibration tiles with ponds, see calibrate.
+    """
+
+    def __init__(self, mean, std, weights, bias, calibration=None):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.calibration = calibration
+
+    def score(self, features):
+        """Probability-like score per tile; higher means more likely to hold a pond."""
+        z = ((np.atleast_2d(features) - self.mean) / self.std) @ self.weights + self.bias
+        return 1 / (1 + np.exp(-z))
+
+    def calibrate(self, scores, ponds):
+        """
+        Stores the scores and pond counts of calibration tiles (validation tiles with ponds),
+        from which threshold_for_recall picks thresholds.
+        """
+        scores, ponds = np.asarray(scores, dtype=np.float64), np.asarray(ponds)
+        if len(scores) != len(ponds):
+            raise ValueError(f"Got {len(scores)} calibration scores for {len(ponds)} pond counts.")
+        if not (ponds > 0).any():
+            raise ValueError(f"None of the {len(ponds)} calibration tiles holds a pond, so no threshold can be "
+                             "set for a pond recall. Check that the validation masks are white ponds on black "
+                             "(invert_image_colors) and hold more than specks.")
+        self.calibration = (scores[ponds > 0], ponds[ponds > 0])
+
+    def threshold_for_recall(self, recall):
+        """
+        Highest threshold that keeps the tiles of at least recall of the calibration ponds.
+        recall=1 keeps every calibration pond, recall=0 disables screening.
+        """
+        if recall <= 0:
+            return 0.0
+        if self.calibration is None:
+            raise ValueError("The pre-screen model is not calibrated, see PreScreen.calibrate.")
+        scores, ponds = self.calibration
+        order = np.argsort(-scores)
+        kept_share = np.cumsum(ponds[order]) / ponds.sum()
+        return float(scores[order][np.searchsorted(kept_share, min(recall, 1.0) - 1e-9)])
+
+    def keep(self, features, recall=0.99):
+        """Mask of the tiles to send to the model."""
+        return self.score(features) >= self.threshold_for_recall(recall)
+
+    def save(self, path):
+        model = {"features": list(FEATURE_NAMES), "mean": self.mean.tolist(), "std": self.std.tolist(),
+                 "weights": self.weights.tolist(), "bias": self.bias,
+                 "calibration": None if self.calibration is None else [values.tolist() for values in self.calibration]}
+        with open(path, "w") as file:
+            json.dump(model, file, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            model = json.load(file)
+        if model["features"] != list(FEATURE_NAMES):
+            raise ValueError(f"{path} was trained on different features.")
+        prescreen = cls(model["mean"], model["std"], model["weights"], model["bias"])
+        if model["calibration"] is not None:
+            prescreen.calibrate(*model["calibration"])
+        return prescreen
+
+
+@instrument.traced()
+def train_prescreen(train_folder, train_mask_folder, negative_folder, val_folder, val_mask_folder,
+                    holdout=0.2, recalls=(0.95, 0.98, 0.99, 1.0), seed=0, num_workers=None):
+    """
+    Trains the pre-screen on the training tiles, calibrates it on the validation tiles and
+    reports what each recall target would skip and miss.
+    train_folder holds the tiles kept for training (masks in train_mask_folder), negative_folder
+    the tiles filtered out as pond-free (train_not_used). A holdout share of the negatives is
+    kept out of training to measure how many pond-free tiles are skipped.
+
+    Returns:
+    - (PreScreen, report dict).
+    """
+    train_files, train_features = folder_features(train_folder, num_workers=num_workers)
+    negative_files, negative_features = folder_features(negative_folder, num_workers=num_workers)
+    val_files, val_features = folder_features(val_folder, num_workers=num_workers)
+    train_ponds = np.array([count_ponds(os.path.join(train_mask_folder, f)) for f in train_files])
+    val_ponds = np.array([count_ponds(os.path.join(val_mask_folder, f)) for f in val_files])
+
+    rng = np.random.default_rng(seed)
+    heldout = np.zeros(len(negative_files), dtype=bool)
+    heldout[rng.permutation(len(negative_files))[:int(round(holdout * len(negative_files)))]] = True
+    features = np.concatenate((train_features, negative_features[~heldout]))
+    # Training tiles whose mask only holds specks count as pond-free
+    labels = np.concatenate(((train_ponds > 0).astype(np.float64), np.zeros(int((~heldout).sum()))))
+    model = PreScreen(*fit_logistic(features, labels))
+
+    val_scores = model.score(val_features)
+    model.calibrate(val_scores, val_ponds)
+    heldout_scores = model.score(negative_features[heldout])
+    report = {"train_tiles": len(train_files), "train_tiles_with_ponds": int((train_ponds > 0).sum()),
+              "negative_tiles": int((~heldout).sum()),
+              "val_tiles": len(val_files), "val_ponds": int(val_ponds.sum()),
+              "heldout_negative_tiles": int(heldout.sum()), "recalls": []}
+    for recall in recalls:
+        threshold = model.threshold_for_recall(recall)
+        skipped = val_scores < threshold
+        report["recalls"].append({
+            "recall": recall, "threshold": threshold,
+            "val_tiles_skipped": int(skipped.sum()),
+            "val_ponds_missed": int(val_ponds[skipped].sum()),
+            "heldout_negatives_skipped": int((heldout_scores < threshold).sum()),
+            "heldout_negative_skip_rate": float((heldout_scores < threshold).mean()) if heldout.any() else None,
+        })
+    return model, report
+
+
+@instrument.traced()
+def screen_tiles(folder, model, recall=0.99, num_workers=None):
+    """
+    Splits the tiles of a folder into those to run through the model and those to skip.
+
+    Returns:
+    - (kept file names, skipped file names, scores of all tiles by file name).
+    """
+    files, features = folder_features(folder, num_workers=num_workers)
+    scores = model.score(features) if files else np.zeros(0)
+    keep = scores >= model.threshold_for_recall(recall)
+    kept = [f for f, k in zip(files, keep) if k]
+    skipped = [f for f, k in zip(files, keep) if not k]
+    return kept, skipped, dict(zip(files, scores.tolist()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train and calibrate the tile pre-screen.")
+    parser.add_argument("--train", required=True, help="training tiles with ponds")
+    parser.add_argument("--train-mask", required=True, help="masks of the training tiles (white ponds on black)")
+    parser.add_argument("--negatives", required=True, help="tiles without ponds, e.g. data/train_not_used")
+    parser.add_argument("--val", required=True, help="validation tiles")
+    parser.add_argument("--val-mask", required=True, help="validation masks (white ponds on black)")
+    parser.add_argument("--output", required=True, help="model file (.json)")
+    parser.add_argument("--recall", type=float, nargs="+", default=[0.95, 0.98, 0.99, 1.0],
+                        help="pond recall targets to report")
+    parser.add_argument("--holdout", type=float, default=0.2, help="share of negatives kept out of training")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    model, report = train_prescreen(args.train, args.train_mask, args.negatives, args.val, args.val_mask,
+                                    holdout=args.holdout, recalls=args.recall)
+    model.save(args.output)
+    report_path = os.path.splitext(args.output)[0] + "_report.json"
+    with open(report_path, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f'Pre-screen trained in {time.perf_counter() - start:.1f} s and saved in "{args.output}".')
+    for row in report["recalls"]:
+        print(f'recall {row["recall"]}: threshold {row["threshold"]:.3f}, '
+              f'{row["val_tiles_skipped"]}/{report["val_tiles"]} validation tiles skipped, '
+              f'{row["val_ponds_missed"]}/{report["val_ponds"]} ponds missed, '
+              f'{row["heldout_negatives_skipped"]}/{report["heldout_negative_tiles"]} pond-free tiles skipped')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+Training data sampled straight from the scene instead of from tile files.
+train.png and train_mask.png are decoded once into memory-mapped .npy arrays. Crops are
+taken on the tile grid of divide_and_save_image, blank crops are dropped with the
+in-memory blank rule of iterate_tiles, and the polygons of every kept crop are computed
+once and cached. The crops are registered as detectron2 datasets whose images are read
+from the memory map by SceneCropMapper, so no tile, mask or moved file is ever written.
+
+Usage (replaces steps 3-6 of generate-training.ipynb):
+    train_name, val_name = scene_dataset.register_scene_dataset(
+        "pond_scene", train_image_path, train_mask_path, cache_folder, num_val=150)
+    # then train with scene_dataset.SceneTrainer(cfg) and cfg.DATASETS.TRAIN = (train_name,)
+"""
+
+import os, copy, json, random, hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from osgeo import gdal
+from detectron2.data import DatasetCatalog, MetadataCatalog, DatasetMapper
+from detectron2.data import build_detection_train_loader, build_detection_test_loader
+from detectron2.data import transforms as T
+from detectron2.engine import DefaultTrainer
+from detectron2.structures import BoxMode
+from utils import preprocess as prep
+from utils import instrument
+from utils.create_annotations import mask_objects
+
+
+def _source_stamp(image_path, as_mask):
+    stat = os.stat(image_path)
+    return {"source": os.path.abspath(image_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "as_mask": as_mask}
+
+
+@instrument.traced()
+def cache_scene(image_path, cache_path, as_mask=False, strip_rows=1024):
+    """
+    Decodes a scene once into a .npy file and opens it memory-mapped.
+    The file is rebuilt only when the source image changes.
+
+    Parameters:
+    - image_path: train.png, train_mask.png or any GDAL-readable raster.
+    - cache_path: Path of the .npy file.
+    - as_mask: Store a (height, width) mask with the colors inverted, as invert_image_colors
+      does to the mask tiles (ponds drawn black become 255, the background 0).
+      Otherwise a (height, width, 3) RGB image is stored.
+    - strip_rows: Number of rows decoded at a time, which bounds memory use.
+
+    Returns:
+    - The read-only memory-mapped array.
+    """
+    stamp = _source_stamp(image_path, as_mask)
+    stamp_path = cache_path + ".json"
+    if os.path.exists(cache_path) and os.path.exists(stamp_path):
+        with open(stamp_path) as file:
+            if json.load(file) == stamp:
+                return np.load(cache_path, mmap_mode="r")
+
+    dataset = gdal.Open(image_path, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise FileNotFoundError(f"Unable to open input image: {image_path}")
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    shape = (height, width) if as_mask else (height, width, 3)
+    partial_path = cache_path + ".partial.npy"
+    array = np.lib.format.open_memmap(partial_path, mode="w+", dtype=np.uint8, shape=shape)
+    for start in range(0, height, strip_rows):
+        strip = prep.read_tile_window(dataset, 0, start, width, min(strip_rows, height - start)).astype(np.uint32)
+        if strip.shape[2] < 3:
+            strip = np.repeat(strip[:, :, :1], 3, axis=2)
+        if as_mask:
+            # Same luminance as PIL's convert("L"), then inverted like ImageOps.invert
+            gray = (strip[:, :, 0] * 19595 + strip[:, :, 1] * 38470 + strip[:, :, 2] * 7471 + 0x8000) >> 16
+            array[start:start + strip.shape[0]] = 255 - gray
+        else:
+            array[start:start + strip.shape[0]] = strip[:, :, :3]
+    array.flush()
+    del array
+    os.replace(partial_path, cache_path)
+    with open(stamp_path, "w") as file:
+        json.dump(stamp, file)
+    return np.load(cache_path, mmap_mode="r")
+
+
+_scenes = {}
+
+
+def _open_scene(cache_path):
+    """Memory-maps a cached scene once per process."""
+    if cache_path not in _scenes:
+        _scenes[cache_path] = np.load(cache_path, mmap_mode="r")
+    return _scenes[cache_path]
+
+
+def crop_scene(scene, x, y, tile_width, tile_height):
+    """
+    Copies one crop out of a (memory-mapped) scene, zero-padded past the edge like the edge tiles.
+    """
+    crop = np.zeros((tile_height, tile_width) + scene.shape[2:], dtype=scene.dtype)
+    window = scene[y:y + tile_height, x:x + tile_width]
+    crop[:window.shape[0], :window.shape[1]] = window
+    return crop
+
+
+def read_crop(record, image_format="BGR"):
+    """
+    Reads the image of a scene-crop dataset record from the memory-mapped scene.
+
+    Returns:
+    - The crop as a (height, width, 3) array in image_format ("BGR" like cv2.imread, or "RGB").
+    """
+    x, y = record["crop"]
+    crop = crop_scene(_open_scene(record["scene"]), x, y, record["width"], record["height"])
+    return np.ascontiguousarray(crop[:, :, ::-1]) if image_format == "BGR" else crop
+
+
+def select_crops(mask, tile_width, tile_height, stride=0.25, min_pond_fraction=0.002):
+    """
+    Offsets of the crops that contain ponds, on the same grid as divide_and_save_image.
+    This replaces filter_tiles_by_size on the mask tiles and process_training_data.
+
+    Parameters:
+    - mask: The inverted scene mask from cache_scene(..., as_mask=True).
+    - tile_width, tile_height: Crop size.
+    - stride: Spacing of the crops, see preprocess.tile_offsets.
+    - min_pond_fraction: Crops with a smaller fraction of pond pixels are blank (see preprocess.is_blank_tile).
+
+    Returns:
+    - A list of (x, y) offsets.
+    """
+    height, width = mask.shape
+    return [(x, y) for x, y in prep.tile_offsets(width, height, tile_width, tile_height, stride)
+            if not prep.is_blank_tile(crop_scene(mask, x, y, tile_width, tile_height), min_pond_fraction)]
+
+
+_annotation_mask = None
+
+
+def _open_annotation_mask(mask_cache_path):
+    global _annotation_mask
+    _annotation_mask = np.load(mask_cache_path, mmap_mode="r")
+
+
+def _crop_annotations(x, y, tile_width, tile_height, category_colors, multipolygon_ids):
+    """
+    Worker task: polygons of one crop of the worker's mask, in the layout of create_annotation_format.
+    """
+    crop = crop_scene(_annotation_mask, x, y, tile_width, tile_height)
+    annotations = []
+    for polygon, segmentation, category_id in mask_objects(Image.fromarray(crop, "L").convert("RGB"),
+                                                           category_colors, multipolygon_ids):
+        min_x, min_y, max_x, max_y = polygon.bounds
+        annotations.append({"segmentation": segmentation, "area": polygon.area, "iscrowd": 0,
+                            "bbox": [min_x, min_y, max_x - min_x, max_y - min_y], "category_id": category_id})
+    return annotations
+
+
+def crop_annotations(mask_cache_path, offsets, tile_width, tile_height, category_colors, multipolygon_ids=(),
+                     cache_path=None, num_workers=None):
+    """
+    Computes the annotations of every crop, reusing the ones already in the cache file.
+
+    Parameters:
+    - mask_cache_path: The .npy mask written by cache_scene(..., as_mask=True).
+    - offsets: (x, y) offsets of the crops.
+    - tile_width, tile_height: Crop size.
+    - category_colors, multipolygon_ids: As for create_annotations.images_annotations_info.
+    - cache_path: Optional JSON file of cached annotations, keyed by crop offset.
+    - num_workers: Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+    - dict: {(x, y): list of annotations}.
+    """
+    cached = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as file:
+            cached = json.load(file)
+    missing = [(x, y) for x, y in offsets if f"{x}_{y}" not in cached]
+
+    if missing:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_open_annotation_mask,
+                                 initargs=(mask_cache_path,)) as executor:
+            xs, ys = zip(*missing)
+            results = executor.map(_crop_annotations, xs, ys, [tile_width] * len(missing),
+                                   [tile_height] * len(missing), [category_colors] * len(missing),
+                                   [tuple(multipolygon_ids)] * len(missing), chunksize=8)
+            for (x, y), annotations in zip(missing, results):
+                cached[f"{x}_{y}"] = annotations
+        if cache_path is not None:
+            with open(cache_path, "w") as file:
+                json.dump(cached, file)
+    return {(x, y): cached[f"{x}_{y}"] for x, y in offsets}
+
+
+@instrument.traced()
+def register_scene_dataset(name, image_path, mask_path, cache_folder, tile_width=1024, tile_height=1024,
+                           stride=0.25, min_pond_fraction=0.002, num_val=150, category_ids=None,
+                           category_colors=None, multipolygon_ids=(), seed=0, num_workers=None):
+    """
+    Registers "<name>_train" and "<name>_val" datasets of crops sampled from the scene.
+    The records are detectron2 dataset dicts; "file_name" is the scene and the crop is given
+    by "crop" (x, y) and "scene" (the memory-mapped image), which SceneCropMapper reads.
+
+    Parameters:
+    - name: Dataset name prefix.
+    - image_path, mask_path: train.png and train_mask.png.
+    - cache_folder: Folder for the memory-mapped scenes and the annotation cache.
+    - tile_width, tile_height, stride: Crop size and spacing, as for divide_and_save_image.
+    - min_pond_fraction: Blank rule, see select_crops.
+    - num_val: Number of random crops held out for validation, as in create_validation_set.
+    - category_ids: {name: id} of the categories. Defaults to {"pond": 1}.
+    - category_colors: {"(r, g, b)": id} of the inverted mask. Defaults to white ponds.
+    - multipolygon_ids: Category ids annotated as one multipolygon.
+    - seed: Seed of the train/val split.
+    - num_workers: Worker processes for the annotations.
+
+    Returns:
+    - (train_name, val_name)
+    """
+    category_ids = category_ids or {"pond": 1}
+    category_colors = category_colors or {"(255, 255, 255)": 1}
+    os.makedirs(cache_folder, exist_ok=True)
+    image_cache = os.path.join(cache_folder, "scene_image.npy")
+    mask_cache = os.path.join(cache_folder, "scene_mask.npy")
+    cache_scene(image_path, image_cache)
+    mask = cache_scene(mask_path, mask_cache, as_mask=True)
+
+    offsets = select_crops(mask, tile_width, tile_height, stride, min_pond_fraction)
+    if num_val > len(offsets):
+        raise ValueError("Number of images to select exceeds available images.")
+    key = hashlib.sha256(json.dumps([_source_stamp(mask_path, True), tile_width, tile_height, category_colors,
+                                     list(multipolygon_ids)], sort_keys=True).encode()).hexdigest()[:16]
+    annotations = crop_annotations(mask_cache, offsets, tile_width, tile_height, category_colors, multipolygon_ids,
+                                   os.path.join(cache_folder, f"annotations_{key}.json"), num_workers)
+
+    # Contiguous class ids in the order of the category ids, as register_coco_instances does
+    dataset_ids = sorted(category_ids.values())
+    contiguous_id = {dataset_id: i for i, dataset_id in enumerate(dataset_ids)}
+    records = []
+    for image_id, (x, y) in enumerate(offsets):
+        records.append({
+            "file_name": image_path, "scene": image_cache, "crop": (x, y),
+            "image_id": image_id, "height": tile_height, "width": tile_width,
+            "annotations": [{**annotation, "bbox_mode": BoxMode.XYWH_ABS,
+                             "category_id": contiguous_id[annotation["category_id"]]}
+                            for annotation in annotations[(x, y)]],
+        })
+    val_ids = set(random.Random(seed).sample(range(len(records)), num_val))
+    splits = {f"{name}_train": [r for r in records if r["image_id"] not in val_ids],
+              f"{name}_val": [r for r in records if r["image_id"] in val_ids]}
+
+    thing_classes = [n for n, _ in sorted(category_ids.items(), key=lambda item: item[1])]
+    for split_name, split in splits.items():
+        if split_name in DatasetCatalog.list():
+            DatasetCatalog.remove(split_name)
+            MetadataCatalog.remove(split_name)
+        DatasetCatalog.register(split_name, lambda split=split: copy.deepcopy(split))
+        MetadataCatalog.get(split_name).set(thing_classes=thing_classes, evaluator_type="coco",
+                                            thing_dataset_id_to_contiguous_id=contiguous_id)
+        print(f"Registered {split_name} with {len(split)} crops.")
+    return f"{name}_train", f"{name}_val"
+
+
+class SceneCropMapper(DatasetMapper):
+    """
+    detectron2's DatasetMapper, but records with a "crop" read their image from the
+    memory-mapped scene. Other records are mapped as usual.
+    """
+
+    def __call__(self, dataset_dict):
+        if "crop" not in dataset_dict:
+            return super().__call__(dataset_dict)
+        dataset_dict = copy.deepcopy(dataset_dict)
+        image = read_crop(dataset_dict, self.image_format)
+
+        aug_input = T.AugInput(image)
+        transforms = self.augmentations(aug_input)
+        image = aug_input.image
+        image_shape = image.shape[:2]
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+        if not self.is_train:
+            dataset_dict.pop("annotations", None)
+            return dataset_dict
+        if "annotations" in dataset_dict:
+            self._transform_annotations(dataset_dict, transforms, image_shape)
+        return dataset_dict
+
+
+class SceneTrainer(DefaultTrainer):
+    """
+    DefaultTrainer whose data loaders use SceneCropMapper, for datasets from register_scene_dataset.
+    """
+
+    @classmethod
+    def build_train_loader(cls, cfg):
+        return build_detection_train_loader(cfg, mapper=SceneCropMapper(cfg, True))
+
+    @classmethod
+    def build_test_loader(cls, cfg, dataset_name):
+        return build_detection_test_loader(cfg, dataset_name, mapper=SceneCropMapper(cfg, False))
@@ -0,0 +1,217 @@
+"""
+Early-stopping hyperparameter search for network selection.
+Trials are trained in local worker processes on an asynchronous successive-halving (ASHA)
+schedule: every trial is scored (segm AP on a validation subset) at rung checkpoints and
+only the best 1/eta of the trials at each rung are trained further, so little compute is
+spent on obviously bad learning-rate/batch-size pairs.
+"""
+
+import os, re, json, math, random, shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from detectron2 import model_zoo
+from detectron2.config import get_cfg, LazyConfig
+from detectron2.data import DatasetCatalog, MetadataCatalog, build_detection_test_loader
+from detectron2.data.datasets import register_coco_instances
+from detectron2.engine import DefaultTrainer
+from detectron2.evaluation import COCOEvaluator, inference_on_dataset
+from utils import helpers as hp
+
+
+def make_trial_config(pretrained_model_path, learning_rate, batch_size, output_dir, device=None):
+    """
+    Build a trial config the same way as the random search in network_selection.ipynb.
+    """
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file(pretrained_model_path))
+    cfg.DATASETS.TRAIN = ("pond_train",)
+    cfg.DATASETS.TEST = ()
+    cfg.DATALOADER.NUM_WORKERS = batch_size
+    cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url(pretrained_model_path)
+    cfg.SOLVER.IMS_PER_BATCH = 2
+    cfg.SOLVER.BASE_LR = learning_rate
+    cfg.SOLVER.STEPS = []
+    cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 128
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1
+    cfg.OUTPUT_DIR = output_dir
+    if device is not None:
+        cfg.MODEL.DEVICE = device
+    return cfg
+
+
+def rung_iterations(min_iter, max_iter, eta):
+    """
+    Training budgets of the rungs: min_iter, min_iter * eta, ... up to max_iter.
+    """
+    rungs = []
+    budget = min_iter
+    while budget < max_iter:
+        rungs.append(budget)
+        budget *= eta
+    rungs.append(max_iter)
+    return rungs
+
+
+def register_val_subset(dataset_name, json_file, image_root, subset_size):
+    """
+    Register "<dataset_name>_subset", the first subset_size images of the validation set.
+    """
+    if dataset_name not in DatasetCatalog.list():
+        register_coco_instances(dataset_name, {}, json_file, image_root)
+    subset_name = f"{dataset_name}_subset"
+    if subset_name not in DatasetCatalog.list():
+        DatasetCatalog.register(subset_name, lambda: DatasetCatalog.get(dataset_name)[:subset_size])
+        MetadataCatalog.get(subset_name).set(thing_classes=MetadataCatalog.get(dataset_name).thing_classes,
+                                             evaluator_type="coco")
+    return subset_name
+
+
+def _train_to_rung(config_path, target_iter, datasets, subset_size, num_threads):
+    """
+    Worker task: resume a trial from its last checkpoint, train it up to target_iter and
+    return its segm AP on the validation subset.
+    """
+    import torch
+    torch.set_num_threads(num_threads)
+    train_name, train_json, train_root, val_name, val_json, val_root = datasets
+    if train_name not in DatasetCatalog.list():
+        register_coco_instances(train_name, {}, train_json, train_root)
+    subset_name = register_val_subset(val_name, val_json, val_root, subset_size)
+
+    cfg = hp.load_from_cloudpickle(config_path)
+    cfg.SOLVER.MAX_ITER = target_iter
+    os.makedirs(cfg.OUTPUT_DIR, exist_ok=True)
+    trainer = DefaultTrainer(cfg)
+    trainer.resume_or_load(resume=True)
+    trainer.train()
+
+    evaluator = COCOEvaluator(subset_name, output_dir=cfg.OUTPUT_DIR)
+    results = inference_on_dataset(trainer.model, build_detection_test_loader(cfg, subset_name), evaluator)
+    segm_ap = results.get("segm", {}).get("AP", float("nan"))
+    return -1.0 if math.isnan(segm_ap) else segm_ap
+
+
+def _next_free_number(parameter_folder, model_folder):
+    """
+    First n with no config_{n}.pkl and no model_{n}.pth after the existing ones, so the
+    random search's files are never overwritten.
+    """
+    pattern = re.compile(r"(?:config|model)_(\d+)\.(?:pkl|pth)$")
+    numbers = [int(match.group(1)) for folder in (parameter_folder, model_folder) if os.path.isdir(folder)
+               for match in map(pattern.match, os.listdir(folder)) if match]
+    return max(numbers, default=0) + 1
+
+
+def emit_completed_trials(trials, parameter_folder, model_folder):
+    """
+    Copies the trials trained to the full budget as model_{n}.pth / config_{n}.pkl pairs,
+    numbered after the existing ones, which is what validate.ipynb scores.
+
+    Returns:
+    - The trials, with model_path and validate_config_path set on the copied ones.
+    """
+    os.makedirs(model_folder, exist_ok=True)
+    num = _next_free_number(parameter_folder, model_folder)
+    for trial in trials:
+        model_final = os.path.join(trial["output_dir"], "model_final.pth")
+        if trial["state"] != "completed" or not os.path.exists(model_final):
+            continue
+        trial["model_path"] = os.path.join(model_folder, f"model_{num}.pth")
+        trial["validate_config_path"] = os.path.join(parameter_folder, f"config_{num}.pkl")
+        shutil.copyfile(model_final, trial["model_path"])
+        shutil.copyfile(trial["config_path"], trial["validate_config_path"])
+        num += 1
+    return trials
+
+
+def asha_search(parameter_folder, model_folder, datasets, pretrained_model_path, num_trials=8,
+                lr_range=(0.0001, 0.001), batch_size_range=(2, 16), min_iter=500, max_iter=16000, eta=4,
+                num_workers=2, subset_size=30, device=None, seed=None):
+    """
+    Run an ASHA hyperparameter search.
+    Each trial's config is saved with LazyConfig.save as asha_config_{n}.pkl in parameter_folder,
+    apart from the random search's config_{n}.pkl, and trial n trains in model_folder/trial_{n}.
+    Whenever a worker is free, the scheduler promotes a trial that is in the top 1/eta of its
+    rung, or otherwise starts a new trial. At the end the trials trained to max_iter are
+    copied to model_{n}.pth / config_{n}.pkl for validate.ipynb (see emit_completed_trials).
+
+    Parameters:
+    - parameter_folder, model_folder: Output folders, as in the notebooks.
+    - datasets: (train_name, train_json, train_root, val_name, val_json, val_root).
+    - pretrained_model_path: Model zoo config, e.g. "COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml".
+    - num_trials: Number of sampled learning-rate/batch-size pairs.
+    - lr_range, batch_size_range: Sampling ranges, as in the notebook.
+    - min_iter, max_iter, eta: First rung budget, full budget and reduction factor.
+    - num_workers: Trials trained concurrently.
+    - subset_size: Number of validation images used to score the rungs.
+    - device: Overrides cfg.MODEL.DEVICE, e.g. "cpu" for a quick test with a tiny budget.
+    - seed: Seed of the hyperparameter sampling.
+
+    Returns:
+    - list: One record per trial with its hyperparameters, rung scores and final state.
+      The records are also written to search_results.json in parameter_folder.
+    """
+    rng = random.Random(seed)
+    rungs = rung_iterations(min_iter, max_iter, eta)
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    os.makedirs(parameter_folder, exist_ok=True)
+
+    trials = []
+    rung_scores = [dict() for _ in rungs]  # rung -> {trial: AP}
+    promoted = [set() for _ in rungs]
+
+    def new_trial():
+        num = len(trials) + 1
+        learning_rate = rng.uniform(*lr_range)
+        batch_size = rng.randint(*batch_size_range)
+        cfg = make_trial_config(pretrained_model_path, learning_rate, batch_size,
+                                os.path.join(model_folder, f"trial_{num}"), device)
+        LazyConfig.save(cfg, os.path.join(parameter_folder, f"asha_config_{num}"))
+        trials.append({"trial": num, "learning_rate": learning_rate, "batch_size": batch_size,
+                       "config_path": os.path.join(parameter_folder, f"asha_config_{num}.pkl"),
+                       "output_dir": cfg.OUTPUT_DIR, "scores": {}, "state": "running"})
+        return num - 1, 0
+
+    def next_job():
+        # Promote from the highest rung first
+        for rung in reversed(range(len(rungs) - 1)):
+            scores = rung_scores[rung]
+            top_k = len(scores) // eta
+            ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+            for index in ranked:
+                if index not in promoted[rung]:
+                    promoted[rung].add(index)
+                    return index, rung + 1
+        if len(trials) < num_trials:
+            return new_trial()
+        return None
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while True:
+            while len(running) < num_workers:
+                job = next_job()
+                if job is None:
+                    break
+                index, rung = job
+                trials[index]["state"] = "running"
+                future = executor.submit(_train_to_rung, trials[index]["config_path"], rungs[rung],
+                                         datasets, subset_size, num_threads)
+                running[future] = job
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, rung = running.pop(future)
+                segm_ap = future.result()
+                rung_scores[rung][index] = segm_ap
+                trials[index]["scores"][rungs[rung]] = segm_ap
+                trials[index]["state"] = "completed" if rung == len(rungs) - 1 else "paused"
+                print(f"trial {index + 1} rung {rungs[rung]} iters: segm AP {segm_ap:.2f}")
+
+    for trial in trials:
+        if trial["state"] == "paused":
+            trial["state"] = "stopped"
+    emit_completed_trials(trials, parameter_folder, model_folder)
+    with open(os.path.join(parameter_folder, "search_results.json"), "w") as file:
+        json.dump(trials, file, indent=4)
+    return trials
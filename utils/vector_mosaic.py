@@ -0,0 +1,169 @@
+"""
+Vector-first alternative to the raster mosaic.
+Instead of ORing every tile into a full-scene canvas, writing it as a GeoTIFF and finding the
+contours again, each cleaned tile mask is vectorized on its own (the find_contours + simplify
+of create_annotations.create_sub_mask_annotation), the polygons are moved into scene pixel
+coordinates, and polygons of the same pond coming from overlapping tiles are unioned. Pairs
+to union are found with an STRtree, so time and memory grow with the number of ponds rather
+than with the scene area.
+"""
+
+import os
+import functools
+import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from utils import instrument
+from utils import mask_codec
+from utils import mosaic as mosc
+from utils.create_annotations import create_sub_mask_annotation
+from utils.pond_store import PondStore, affine_to_world
+
+
+def mask_polygons(mask, tolerance=1.0):
+    """
+    Vectorizes a binary mask into polygons in its pixel coordinates.
+    find_contours returns the outlines of holes as separate contours; a contour lying inside
+    an odd number of others is a hole and is cut out of the contour directly around it.
+
+    Parameters:
+    - mask: (height, width) binary mask, e.g. one cleaned tile.
+    - tolerance: Simplification tolerance in pixels (create_sub_mask_annotation uses 1.0).
+
+    Returns:
+    - A NumPy array of shapely polygons, one per object.
+    """
+    # create_sub_mask_annotation expects one pixel of padding and removes it again
+    padded = np.pad(np.asarray(mask, dtype=bool), 1)
+    polygons, _ = create_sub_mask_annotation(padded, tolerance)
+    polygons = shapely.get_parts(shapely.make_valid(np.array(polygons, dtype=object)))
+    polygons = polygons[shapely.get_type_id(polygons) == shapely.GeometryType.POLYGON]
+    if len(polygons) < 2:
+        return polygons
+
+    # Nesting depth of every contour: outlines are even, holes odd
+    outer, inner = shapely.STRtree(polygons).query(polygons, predicate="contains_properly")
+    depth = np.bincount(inner, minlength=len(polygons))
+    if not depth.any():
+        return polygons
+    objects = []
+    for i in np.flatnonzero(depth % 2 == 0):
+        holes = inner[(outer == i) & (depth[inner] == depth[i] + 1)]
+        objects.append(shapely.difference(polygons[i], shapely.union_all(polygons[holes])) if holes.size
+                       else polygons[i])
+    return shapely.get_parts(np.array(objects, dtype=object))
+
+
+def tile_polygons(x, y, tile, tolerance=1.0):
+    """
+    Vectorizes one tile and moves its polygons into scene pixel coordinates.
+
+    Parameters:
+    - x, y: Top left corner of the tile in the scene.
+    - tile: The cleaned tile mask, as stored by mosaic.write_tile_store.
+    - tolerance: Simplification tolerance in pixels.
+
+    Returns:
+    - A NumPy array of shapely polygons.
+    """
+    polygons = mask_polygons(tile, tolerance)
+    return shapely.transform(polygons, lambda coords: coords + (x, y))
+
+
+def _vectorize_packed(record):
+    """Worker task: inflates and vectorizes one compressed tile of a tile store."""
+    x, y, height, width, blob, tolerance = record
+    packed = mask_codec.decompress_packed(blob, (height, width))
+    if not packed.any():
+        return np.empty(0, dtype=object)
+    return tile_polygons(x, y, mask_codec.unpack_mask(packed, width), tolerance)
+
+
+def union_overlapping(polygons):
+    """
+    Merges polygons that overlap, e.g. the same pond seen by neighbouring tiles.
+    Overlapping pairs come from an STRtree query, the groups from connected components over
+    those pairs, and only the polygons of one group are unioned together.
+
+    Parameters:
+    - polygons: Array of shapely polygons in one coordinate system.
+
+    Returns:
+    - A NumPy array of the merged polygons.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    if len(polygons) == 0:
+        return polygons
+    left, right = shapely.STRtree(polygons).query(polygons, predicate="intersects")
+    graph = coo_matrix((np.ones(len(left)), (left, right)), shape=(len(polygons), len(polygons)))
+    num_groups, groups = connected_components(graph, directed=False)
+
+    order = np.argsort(groups, kind="stable")
+    boundaries = np.flatnonzero(np.diff(groups[order])) + 1
+    merged = np.empty(num_groups, dtype=object)
+    for group, members in enumerate(np.split(order, boundaries)):
+        merged[group] = polygons[members[0]] if len(members) == 1 else shapely.union_all(polygons[members])
+    # A union can come out as a multipolygon where outlines only touch at a corner
+    return shapely.get_parts(merged)
+
+
+@functools.lru_cache(maxsize=16)
+def _empty_blob(height, width):
+    """Compressed bytes of an empty tile, to skip empty tiles without inflating them."""
+    return mask_codec.compress_mask(np.zeros((height, width), dtype=bool))
+
+
+@instrument.traced()
+def vectorize_tile_store(store_path, tolerance=1.0, num_workers=None, max_in_flight=None):
+    """
+    Vectorizes every tile of a tile store and merges the polygons across tiles.
+    This replaces mosaic.merge_tile_store -> georeference -> area_calculator.find_contours.
+
+    Parameters:
+    - store_path: Path of the container written by mosaic.write_tile_store.
+    - tolerance: Simplification tolerance in pixels.
+    - num_workers: Number of worker processes. Defaults to the number of CPUs.
+    - max_in_flight: Maximum number of tiles queued to the workers. Defaults to 4 * num_workers.
+
+    Returns:
+    - A NumPy array of pond polygons in scene pixel coordinates.
+    """
+    # Tiles go to the workers still compressed, and empty ones are not sent at all
+    records = ((x, y, height, width, blob, tolerance)
+               for x, y, height, width, blob in mosc.iterate_tile_store_records(store_path)
+               if blob != _empty_blob(height, width))
+    num_workers = num_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        parts = list(mosc.map_bounded(executor, _vectorize_packed, records, max_in_flight or 4 * num_workers))
+    polygons = np.concatenate(parts) if parts else np.empty(0, dtype=object)
+    instrument.add_items(len(polygons))
+    return union_overlapping(polygons)
+
+
+def polygons_to_store(polygons, geotransform, crs=""):
+    """
+    Builds the pond table from polygons in scene pixel coordinates, with the columns of
+    area_calculator.calculate_objects_data, and the outlines placed with the geotransform.
+
+    Parameters:
+    - polygons: Pond polygons as returned by vectorize_tile_store.
+    - geotransform: GDAL geotransform of the scene.
+    - crs: Optional WKT of the scene's coordinate system.
+
+    Returns:
+    - A pond_store.PondStore.
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    pixel_area = shapely.area(polygons)
+    centers = shapely.centroid(polygons)
+    center_x = shapely.get_x(centers).astype(int)
+    center_y = shapely.get_y(centers).astype(int)
+    to_world = affine_to_world(geotransform)
+    center_long, center_lat = to_world(center_x, center_y)
+    columns = {"Area": pixel_area, "Real_area": pixel_area * geotransform[1] * abs(geotransform[5]),
+               "Center_X": center_x, "Center_Y": center_y, "Center_lat": center_lat, "Center_long": center_long,
+               "Label": np.arange(1, len(polygons) + 1)}
+    geometries = shapely.transform(polygons, lambda coords: np.column_stack(to_world(coords[:, 0], coords[:, 1])))
+    return PondStore(columns, geometries, crs)